@@ -0,0 +1,209 @@
+"""
+In-process stand-in for the part of the Firestore client the watcher uses:
+documents with update times, collection streams and on_snapshot listeners,
+batches (with last-update-time preconditions), and transactions good enough
+for firestore.transactional. Assign an instance to main._DB before anything
+calls get_db().
+"""
+
+import itertools
+import queue
+import threading
+from types import SimpleNamespace
+
+from firebase_admin import firestore
+
+
+class Conflict(Exception):
+    """A precondition failed or the document is missing."""
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.docs = {}  # (collection, doc_id) -> (fields, update_time)
+        self.clock = itertools.count(1)
+        self.listeners = {}  # collection -> [queue of change lists]
+        self.stats = {"reads": 0, "writes": 0}
+
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self):
+        return Transaction(self)
+
+    def write_option(self, last_update_time=None):
+        return SimpleNamespace(last_update_time=last_update_time)
+
+    # everything below runs under self.lock
+    def _snapshot(self, collection, doc_id):
+        self.stats["reads"] += 1
+        data, updated = self.docs.get((collection, doc_id), (None, None))
+        return DocumentSnapshot(DocumentReference(self, collection, doc_id), data, updated)
+
+    def _check(self, collection, doc_id, option=None):
+        current = self.docs.get((collection, doc_id))
+        if current is None:
+            raise Conflict(f"no document {collection}/{doc_id}")
+        if option is not None and current[1] != option.last_update_time:
+            raise Conflict(f"{collection}/{doc_id} changed since {option.last_update_time}")
+
+    def _write(self, collection, doc_id, fields, merge):
+        old = self.docs.get((collection, doc_id))
+        data = dict(old[0]) if old is not None and merge else {}
+        for key, value in fields.items():
+            if value is firestore.DELETE_FIELD:
+                data.pop(key, None)
+            else:
+                data[key] = value
+        self.docs[(collection, doc_id)] = (data, next(self.clock))
+        self.stats["writes"] += 1
+        self._emit(collection, doc_id, "ADDED" if old is None else "MODIFIED")
+
+    def _delete(self, collection, doc_id):
+        if self.docs.pop((collection, doc_id), None) is not None:
+            self.stats["writes"] += 1
+            self._emit(collection, doc_id, "REMOVED")
+
+    def _emit(self, collection, doc_id, kind):
+        for changes in self.listeners.get(collection, ()):
+            changes.put(_change(kind, self._snapshot(collection, doc_id)))
+
+
+def _change(kind, snapshot):
+    return SimpleNamespace(type=SimpleNamespace(name=kind), document=snapshot)
+
+
+class CollectionReference:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def document(self, doc_id):
+        return DocumentReference(self.db, self.name, doc_id)
+
+    def stream(self):
+        with self.db.lock:
+            return [self.db._snapshot(c, d) for c, d in list(self.db.docs) if c == self.name]
+
+    def on_snapshot(self, callback):
+        """Deliver the current documents as ADDED, then changes as they happen, from a thread."""
+        changes = queue.Queue()
+        with self.db.lock:
+            for snapshot in self.stream():
+                changes.put(_change("ADDED", snapshot))
+            self.db.listeners.setdefault(self.name, []).append(changes)
+
+        def deliver():
+            while True:
+                pending = [changes.get()]
+                while True:  # everything that piled up goes in one callback, as Firestore does
+                    try:
+                        pending.append(changes.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in pending:
+                    return
+                callback(None, pending, None)
+
+        threading.Thread(target=deliver, name=f"snapshot-{self.name}", daemon=True).start()
+
+        def unsubscribe():
+            with self.db.lock:
+                self.db.listeners[self.name].remove(changes)
+            changes.put(None)
+
+        return SimpleNamespace(unsubscribe=unsubscribe)
+
+
+class DocumentReference:
+    def __init__(self, db, collection, doc_id):
+        self.db = db
+        self.collection = collection
+        self.id = doc_id
+
+    def get(self, transaction=None):
+        with self.db.lock:
+            return self.db._snapshot(self.collection, self.id)
+
+    def set(self, fields):
+        with self.db.lock:
+            self.db._write(self.collection, self.id, fields, merge=False)
+
+    def update(self, fields, option=None):
+        with self.db.lock:
+            self.db._check(self.collection, self.id, option)
+            self.db._write(self.collection, self.id, fields, merge=True)
+
+    def delete(self):
+        with self.db.lock:
+            self.db._delete(self.collection, self.id)
+
+
+class WriteBatch:
+    """Updates applied all together, or none if any document is missing or changed."""
+
+    def __init__(self, db):
+        self.db = db
+        self.updates = []
+
+    def update(self, reference, fields, option=None):
+        self.updates.append((reference, fields, option))
+
+    def commit(self):
+        with self.db.lock:
+            for ref, _, option in self.updates:
+                self.db._check(ref.collection, ref.id, option)
+            for ref, fields, _ in self.updates:
+                self.db._write(ref.collection, ref.id, fields, merge=True)
+
+
+class Transaction:
+    """Holds the store lock from begin to commit, so transactions simply serialise."""
+
+    _read_only = False
+    _max_attempts = 5
+    _id = b"fake"
+
+    def __init__(self, db):
+        self.db = db
+        self.updates = []
+        self.held = False
+
+    def update(self, reference, fields):
+        self.updates.append((reference, fields))
+
+    def _clean_up(self):
+        self.updates = []
+
+    def _begin(self, retry_id=None):
+        self.db.lock.acquire()
+        self.held = True
+
+    def _commit(self):
+        try:
+            for ref, fields in self.updates:
+                self.db._check(ref.collection, ref.id)
+                self.db._write(ref.collection, ref.id, fields, merge=True)
+        finally:
+            self._rollback()
+
+    def _rollback(self):
+        if self.held:
+            self.held = False
+            self.db.lock.release()
@@ -0,0 +1,63 @@
+// Stand-in for Amazon's own scripts: the location popover on the home page
+// and the all-offers panel (AOD) on product pages, which loads its first page
+// on demand and further pages of offers as its scroller reaches the bottom.
+(function () {
+    const asin = document.body.dataset.asin;
+    const byId = (id) => document.getElementById(id);
+
+    document.addEventListener('click', (e) => {
+        if (e.target.closest('#sp-cc-rejectall-link, #sp-cc-accept')) {
+            e.preventDefault();
+            byId('sp-cc').remove();
+        } else if (e.target.closest('#nav-global-location-popover-link')) {
+            e.preventDefault();
+            const popover = byId('a-popover-1');
+            if (popover) { popover.hidden = false; }
+        } else if (e.target.closest('.a-popover-footer')) {
+            window.location.reload();
+        } else if (e.target.closest('#buybox-see-all-buying-choices, #aod-ingress-link')) {
+            e.preventDefault();
+            openOffers();
+        }
+    });
+
+    document.addEventListener('keydown', (e) => {
+        if (e.key === 'Enter' && e.target.id === 'GLUXZipUpdateInput') {
+            fetch('/portal-migration/hz/glow/address-change', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/x-www-form-urlencoded'},
+                body: 'zipCode=' + encodeURIComponent(e.target.value),
+            }).then(() => {
+                byId('GLUXHiddenSuccessSelectedAddressPlaceholder').textContent = e.target.value;
+            });
+        }
+    });
+
+    function openOffers() {
+        const container = byId('aod-container');
+        fetch(`/gp/product/ajax/aodAjaxMain/?asin=${asin}&pc=dp`)
+            .then((r) => r.text())
+            .then((html) => {
+                container.innerHTML = html;
+                container.hidden = false;
+                const scroller = byId('all-offers-display-scroller');
+                let page = 1, loading = false, done = false;
+                scroller.addEventListener('scroll', () => {
+                    const bottom = scroller.scrollTop + scroller.clientHeight >= scroller.scrollHeight - 50;
+                    if (!bottom || loading || done) { return; }
+                    loading = true;
+                    page += 1;
+                    fetch(`/gp/aod/ajax/?asin=${asin}&pageno=${page}`)
+                        .then((r) => r.text())
+                        .then((more) => {
+                            if (more.trim()) {
+                                byId('aod-offer-list').insertAdjacentHTML('beforeend', more);
+                            } else {
+                                done = true;
+                            }
+                            loading = false;
+                        });
+                });
+            });
+    }
+})();
@@ -0,0 +1,346 @@
+"""
+Load test of the whole watcher process: run_watcher() as in production
+(snapshot listener, scheduler, worker pool, state writer, notifier) against
+an in-process fake Firestore, a synthetic store whose products flip in and
+out of stock, and a local Telegram stub. Reports checks per minute, the
+latency from a product coming back in stock to its alert, scheduler lag,
+and the peak process count and memory of the process tree.
+
+    python -m bench.load [--links 500] [--products 250] [--duration 600] [--flip-every 900]
+    python -m bench.load --links 5000 --workers 40 --save many
+    python -m bench.load --compare bench/results/load-before.json bench/results/load-after.json
+
+Checks go through the static HTTP tier, so no Chrome is needed; --chrome
+turns the tier off and drives real browsers. Other watcher settings
+(TABS_PER_BROWSER, MEMORY_LIMIT_MB, …) are taken from the environment.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import re
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from bench.run import git_revision, percentile
+from bench.server import _DP_PATH, Handler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, "bench", "results")
+TARGET_PRICE = 95.0  # above the in-stock fixture's €89.99, so every restock alerts
+
+_LINK_REF = re.compile(r"[?&]ref=(link\d+)")
+
+
+class Catalog(threading.Thread):
+    """Synthetic products, all out of stock at first; each flips after an exponential wait of mean `flip_every`."""
+
+    def __init__(self, products: int, flip_every: float, seed: int = 0):
+        super().__init__(name="catalog", daemon=True)
+        self.asins = [f"B0LOAD{i:04d}" for i in range(products)]
+        self.flip_every = flip_every
+        self.random = random.Random(seed)
+        self.in_stock = {asin: False for asin in self.asins}
+        self.flips = {asin: [] for asin in self.asins}  # [(time, in_stock)]
+
+    def run(self):
+        tick = 0.5
+        chance = 1 - math.exp(-tick / self.flip_every)
+        while True:
+            time.sleep(tick)
+            now = time.time()
+            for asin in self.asins:
+                if self.random.random() < chance:
+                    self.in_stock[asin] = not self.in_stock[asin]
+                    self.flips[asin].append((now, self.in_stock[asin]))
+
+
+class CatalogHandler(Handler):
+    """bench.server's store, with the catalog's products on /dp/<ASIN>."""
+
+    catalog = None
+
+    def do_GET(self):
+        m = _DP_PATH.match(self.path.split("?")[0])
+        if m and m.group(1) in self.catalog.in_stock:
+            time.sleep(self.latency)
+            in_stock = self.catalog.in_stock[m.group(1)]
+            return self._page("pdp_in_stock.html" if in_stock else "pdp_out_of_stock.html", m.group(1))
+        super().do_GET()
+
+
+class TelegramStub(BaseHTTPRequestHandler):
+    """Accepts sendMessage like the Bot API and records (time, text) of every message."""
+
+    messages = None
+    latency = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        time.sleep(self.latency)
+        self.messages.append((time.time(), form.get("text", [""])[0]))
+        body = b'{"ok":true,"result":{}}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(handler, **attrs) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), type(handler.__name__, (handler,), attrs))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name=handler.__name__, daemon=True).start()
+    return server
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Sampler(threading.Thread):
+    """Once a second: process count and RSS of our process tree, and the scheduler's report."""
+
+    def __init__(self, main):
+        super().__init__(name="sampler", daemon=True)
+        self.main = main
+        self.samples = []  # (time, processes, rss bytes, scheduler report or None)
+
+    def run(self):
+        pid = os.getpid()
+        while True:
+            scheduler = self.main._SERVICES.get("scheduler")
+            report = scheduler.report() if scheduler is not None else None
+            self.samples.append(
+                (time.time(), len(self.main.process_tree(pid)), self.main._process_tree_rss(pid), report)
+            )
+            time.sleep(1)
+
+
+def alert_latencies(catalog: Catalog, messages, product_of: dict, since: float, until: float) -> dict:
+    """
+    Match each alert to the restock that caused it: the product's last flip
+    into stock before the alert. Only the first alert per link and restock
+    counts; later ones are repeats after a cool-down. Restocks after `since`
+    are counted as alerted, missed (out of stock again before any alert), or
+    pending (still in stock at `until` with no alert).
+    """
+    latencies, repeats, alerted = [], 0, set()
+    for sent_at, text in messages:
+        for doc_id in _LINK_REF.findall(text):
+            restocks = [t for t, in_stock in catalog.flips[product_of[doc_id]] if in_stock and t <= sent_at]
+            if not restocks or (doc_id, restocks[-1]) in alerted:
+                repeats += 1
+                continue
+            alerted.add((doc_id, restocks[-1]))
+            if restocks[-1] >= since:
+                latencies.append(sent_at - restocks[-1])
+    links_of = {}
+    for doc_id, asin in product_of.items():
+        links_of.setdefault(asin, []).append(doc_id)
+    missed = pending = 0
+    for asin, flips in catalog.flips.items():
+        for i, (t, in_stock) in enumerate(flips):
+            if not in_stock or t < since or t > until:
+                continue
+            unalerted = sum(1 for d in links_of.get(asin, ()) if (d, t) not in alerted)
+            if i + 1 < len(flips) and flips[i + 1][0] <= until:
+                missed += unalerted
+            else:
+                pending += unalerted
+    return {
+        "alerts": len(latencies),
+        "repeats": repeats,
+        "missed": missed,
+        "pending": pending,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "max": max(latencies, default=None),
+    }
+
+
+def run_load(args) -> dict:
+    catalog = Catalog(args.products, args.flip_every, args.seed)
+    store = serve(CatalogHandler, catalog=catalog, latency=args.latency / 1000)
+    messages = []
+    telegram = serve(TelegramStub, messages=messages, latency=args.telegram_latency / 1000)
+    base = f"http://127.0.0.1:{store.server_port}"
+    tmp = tempfile.mkdtemp(prefix="aw-load-")
+    os.environ.update(
+        AMAZON_BASE=base,
+        TELEGRAM_API=f"http://127.0.0.1:{telegram.server_port}",
+        HTTP_TIER="false" if args.chrome else "true",
+        MAX_WORKERS=str(args.workers),
+        CHECK_INTERVAL=str(args.interval),
+        CHECK_INTERVAL_MIN=str(min(args.interval, float(os.environ.get("CHECK_INTERVAL_MIN", 30)))),
+        REQUESTS_PER_MINUTE=str(args.requests_per_minute),
+        PORT=str(free_port()),
+        LOCATION_STORE=os.path.join(tmp, "location.json"),
+        HISTORY_DB=os.path.join(tmp, "history.sqlite3"),
+        LOG="true" if args.verbose else "false",
+        SHARDING="false",
+    )
+    sys.path.insert(0, ROOT)
+    import main
+    from bench.fake_firestore import FakeFirestore
+
+    db = main._DB = FakeFirestore()
+    db.collection("config").document("settings").set(
+        {"token": "load", "chat_id": "load", "cool_time": args.cool_time}
+    )
+    product_of = {}
+    for i in range(args.links):
+        doc_id, asin = f"link{i}", catalog.asins[i % len(catalog.asins)]
+        product_of[doc_id] = asin
+        db.collection("links").document(doc_id).set({
+            "name": doc_id, "url": f"{base}/dp/{asin}?ref={doc_id}", "target_price": TARGET_PRICE,
+            "check_shipped": True, "check_sold": True, "available": False,
+        })
+
+    if not args.chrome:
+        # what Chrome's location setup would have stored; the static tier needs it
+        main.save_location_state(
+            [{"name": "aw-zip", "value": main.DELIVERY_POSTCODE, "domain": "127.0.0.1", "path": "/"}]
+        )
+
+    sampler = Sampler(main)
+    sampler.start()
+    started = time.time()
+    catalog.start()
+    stop = threading.Event()
+    threading.Timer(args.duration, stop.set).start()
+    main.run_watcher(stop)
+    ended = time.time()
+
+    since = started + args.warmup
+    window = [s for s in sampler.samples if s[3] is not None and since <= s[0] <= ended]
+    if len(window) < 2:
+        sys.exit("run too short for its warm-up; raise --duration or lower --warmup")
+    first, last = window[0][3], window[-1][3]
+    checks = lambda r: sum(n for outcome, n in r["outcomes"].items() if outcome != "removed")
+    minutes = (window[-1][0] - window[0][0]) / 60
+    dispatched = last["dispatched"] - first["dispatched"]
+    lag_total = last["lag_avg"] * last["dispatched"] - first["lag_avg"] * first["dispatched"]
+    return {
+        "revision": git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "links": args.links, "products": args.products, "duration_s": args.duration,
+            "warmup_s": args.warmup, "interval_s": args.interval, "workers": args.workers,
+            "flip_every_s": args.flip_every, "cool_time_s": args.cool_time, "latency_ms": args.latency,
+            "tier": "chrome" if args.chrome else "static",
+        },
+        "checks_per_minute": (checks(last) - checks(first)) / minutes,
+        "outcomes": last["outcomes"],
+        "notify": alert_latencies(catalog, messages, product_of, since, ended),
+        "lag_s": {
+            "avg": lag_total / dispatched if dispatched else 0.0,
+            "max": last["lag_max"],
+            "overdue_avg": statistics.mean(s[3]["overdue"] for s in window),
+            "overdue_max": max(s[3]["overdue"] for s in window),
+        },
+        "peak_processes": max(s[1] for s in sampler.samples),
+        "peak_rss_mb": max(s[2] for s in sampler.samples) / (1024 * 1024),
+        "firestore": dict(db.stats),
+        "telegram_messages": len(messages),
+    }
+
+
+def _s(value) -> str:
+    return "-" if value is None else f"{value:.1f}s"
+
+
+def print_report(r: dict):
+    c, n, lag = r["config"], r["notify"], r["lag_s"]
+    print(
+        f"revision {r['revision'] or '?'}  {c['links']} links / {c['products']} products  "
+        f"{c['duration_s']:.0f}s (warm-up {c['warmup_s']:.0f}s)  interval {c['interval_s']:.0f}s  "
+        f"workers {c['workers']}  {c['tier']} tier"
+    )
+    print(f"  checks/min        {r['checks_per_minute']:.1f}   outcomes {r['outcomes']}")
+    print(
+        f"  restock → alert   p50 {_s(n['p50'])}  p95 {_s(n['p95'])}  max {_s(n['max'])}   "
+        f"({n['alerts']} alerts, {n['missed']} missed, {n['pending']} pending, {n['repeats']} repeats)"
+    )
+    print(
+        f"  scheduler lag     avg {lag['avg']:.1f}s  max {lag['max']:.1f}s   "
+        f"overdue avg {lag['overdue_avg']:.1f}  max {lag['overdue_max']}"
+    )
+    print(f"  peak              {r['peak_processes']} processes, {r['peak_rss_mb']:.0f} MB RSS")
+    print(f"  fake Firestore    {r['firestore']}   Telegram messages {r['telegram_messages']}")
+
+
+def compare(old: dict, new: dict):
+    print(f"{old['revision'] or 'old'} ({old['created']}) → {new['revision'] or 'new'} ({new['created']})")
+    rows = [
+        ("checks/min", old["checks_per_minute"], new["checks_per_minute"]),
+        ("alert p50 s", old["notify"]["p50"], new["notify"]["p50"]),
+        ("alert p95 s", old["notify"]["p95"], new["notify"]["p95"]),
+        ("lag avg s", old["lag_s"]["avg"], new["lag_s"]["avg"]),
+        ("lag max s", old["lag_s"]["max"], new["lag_s"]["max"]),
+        ("processes", old["peak_processes"], new["peak_processes"]),
+        ("RSS MB", old["peak_rss_mb"], new["peak_rss_mb"]),
+    ]
+    for name, a, b in rows:
+        if a is None or b is None:
+            print(f"  {name:<12} {a} → {b}")
+            continue
+        delta = f" ({(b - a) / a * 100:+.0f}%)" if a else ""
+        print(f"  {name:<12} {a:9.1f} → {b:9.1f}{delta}")
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the watcher against fake Firestore, Telegram and store.")
+    parser.add_argument("--links", type=int, default=500)
+    parser.add_argument("--products", type=int, help="distinct products (default: links / 2)")
+    parser.add_argument("--duration", type=float, default=600, help="seconds to run")
+    parser.add_argument("--warmup", type=float, default=60, help="seconds left out of rates and latencies")
+    parser.add_argument("--interval", type=int, default=300, help="CHECK_INTERVAL for the run")
+    parser.add_argument("--workers", type=int, default=20, help="MAX_WORKERS for the run")
+    parser.add_argument("--flip-every", type=float, default=900, help="mean seconds between a product's stock flips")
+    parser.add_argument("--cool-time", type=float, default=300, help="cool_time in config/settings")
+    parser.add_argument("--latency", type=float, default=100, help="ms the store adds per response")
+    parser.add_argument("--telegram-latency", type=float, default=50, help="ms the Telegram stub adds")
+    parser.add_argument("--requests-per-minute", type=float, default=0, help="REQUESTS_PER_MINUTE (0 = no ceiling)")
+    parser.add_argument("--chrome", action="store_true", help="check with Chrome instead of the static tier")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the stock flips")
+    parser.add_argument("--save", metavar="NAME", help="results file name (default: load-<timestamp>)")
+    parser.add_argument("--compare", nargs="+", metavar="RESULT", help="compare a saved run with another or a new one")
+    parser.add_argument("--verbose", action="store_true", help="show the watcher's own log")
+    args = parser.parse_args()
+    args.products = args.products or max(1, args.links // 2)
+
+    if args.compare and len(args.compare) >= 2:
+        compare(load(args.compare[0]), load(args.compare[1]))
+        sys.exit(0)
+
+    result = run_load(args)
+    print_report(result)
+    os.makedirs(RESULTS, exist_ok=True)
+    path = os.path.join(RESULTS, f"{args.save or time.strftime('load-%Y%m%d-%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"\nSaved {path}")
+    if args.compare:
+        print()
+        compare(load(args.compare[0]), result)
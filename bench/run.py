@@ -0,0 +1,281 @@
+"""
+Offline benchmark of the check pipeline. Starts the fixture server, points
+the watcher at it and runs the real check_links() against each scenario,
+reporting p50/p95 per stage, WebDriver round trips and peak Chrome RSS.
+Results are saved as JSON so two runs can be compared.
+
+    python -m bench.run [--runs 10] [--latency 40] [--tabs 1] [--http-tier]
+    python -m bench.run --compare bench/results/before.json [bench/results/after.json]
+"""
+
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench.server import start_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, "bench", "results")
+
+# name -> (ASIN, link fields, expected outcome)
+SCENARIOS = {
+    "in_stock": (
+        "B0BENCH001",
+        {"target_price": 95.0, "check_shipped": True, "check_sold": True},
+        "core_match",
+    ),
+    "out_of_stock": (
+        "B0BENCH002",
+        {"target_price": 300.0, "check_shipped": True, "check_sold": True},
+        "out_of_stock",
+    ),
+    "pinned_only": (
+        "B0BENCH003",
+        {"target_price": 330.0, "check_shipped": True, "check_sold": True},
+        "pinned_match",
+    ),
+    "offers_50": (
+        "B0BENCH004",
+        {"target_price": 400.0, "check_shipped": True, "check_sold": True},
+        "list_match",
+    ),
+}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile; None for no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+
+class RoundTrips:
+    """Count WebDriver commands by wrapping the remote connection."""
+
+    def __init__(self):
+        from selenium.webdriver.remote.remote_connection import RemoteConnection
+
+        self.count = 0
+        original = RemoteConnection.execute
+
+        def execute(conn, command, params):
+            self.count += 1
+            return original(conn, command, params)
+
+        RemoteConnection.execute = execute
+
+
+class PeakRss(threading.Thread):
+    """Sample the RSS of every pooled Chrome tree; keeps the peak since reset()."""
+
+    def __init__(self, main, interval=0.05):
+        super().__init__(name="peak-rss", daemon=True)
+        self.main = main
+        self.interval = interval
+        self.peak = 0
+
+    def reset(self):
+        self.peak = 0
+
+    def run(self):
+        while True:
+            pids = self.main._browser_pids()
+            rss = sum(self.main._process_tree_rss(p) for p in pids)
+            self.peak = max(self.peak, rss)
+            time.sleep(self.interval)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def run_benchmark(args) -> dict:
+    server = start_server(latency_ms=args.latency)
+    base = f"http://127.0.0.1:{server.server_port}"
+    store = tempfile.NamedTemporaryFile(prefix="aw-bench-", suffix=".json", delete=False).name
+    os.unlink(store)
+    os.environ.update(
+        AMAZON_BASE=base,
+        LOCATION_STORE=store,
+        HTTP_TIER="true" if args.http_tier else "false",
+        LOG="true" if args.verbose else "false",
+    )
+    sys.path.insert(0, ROOT)
+    import main
+
+    links, generations = {}, {}
+    main.init_worker({
+        "links": links,
+        "state": queue.Queue(),  # link state writes and alerts stay local
+        "notify": queue.Queue(),
+        "generations": generations,
+        "registry": {},
+        "recycle": {},
+    })
+    trips = RoundTrips()
+    rss = PeakRss(main)
+    rss.start()
+
+    names = [n for n in args.scenarios.split(",") if n] if args.scenarios else list(SCENARIOS)
+    for name in names:
+        asin, fields, _ = SCENARIOS[name]
+        links[name] = {"name": name, "url": f"{base}/dp/{asin}", **fields}
+        generations[name] = 0
+    batches = [names[i : i + args.tabs] for i in range(0, len(names), args.tabs)]
+
+    samples = {name: [] for name in names}
+    startup = None
+    try:
+        for run in range(args.warmup + args.runs):
+            for batch in batches:
+                rss.reset()
+                before = trips.count
+                t0 = time.monotonic()
+                results = main.check_links([(n, 0) for n in batch], "bench", "bench")
+                elapsed = time.monotonic() - t0
+                if startup is None:
+                    startup = elapsed  # includes browser start and location setup
+                if run < args.warmup:
+                    continue
+                for r in results:
+                    samples[r["doc_id"]].append({
+                        "outcome": r["outcome"],
+                        "total": r["timing"]["total"] / len(batch),
+                        "waiting": r["timing"]["waiting"] / len(batch),
+                        "stages": r["stages"],
+                        "round_trips": (trips.count - before) / len(batch),
+                        "examined": r["examined"],
+                        "rss": rss.peak,
+                    })
+    finally:
+        main.shutdown_driver_pool()
+        server.shutdown()
+        if os.path.exists(store):
+            os.unlink(store)
+
+    return {
+        "revision": git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "runs": args.runs, "latency_ms": args.latency, "tabs": args.tabs,
+            "http_tier": args.http_tier,
+        },
+        "startup_s": startup,
+        "scenarios": {name: summarize(name, samples[name]) for name in names},
+    }
+
+
+def summarize(name: str, samples: list) -> dict:
+    expected = SCENARIOS[name][2]
+    stages = {}
+    for s in samples:
+        for stage, seconds in s["stages"].items():
+            stages.setdefault(stage, []).append(seconds)
+    stat = lambda values: {"p50": percentile(values, 50), "p95": percentile(values, 95)}
+    return {
+        "expected": expected,
+        "outcomes": {o: sum(1 for s in samples if s["outcome"] == o) for o in {s["outcome"] for s in samples}},
+        "total_s": stat([s["total"] for s in samples]),
+        "waiting_s": stat([s["waiting"] for s in samples]),
+        "stages_s": {stage: stat(values) for stage, values in stages.items()},
+        "round_trips": stat([s["round_trips"] for s in samples]),
+        "examined": stat([s["examined"] for s in samples]),
+        "peak_rss_mb": max((s["rss"] for s in samples), default=0) / (1024 * 1024),
+    }
+
+
+def _ms(value) -> str:
+    return "-" if value is None else f"{value * 1000:.0f}"
+
+
+def print_report(result: dict):
+    cfg = result["config"]
+    print(
+        f"revision {result['revision'] or '?'}  runs {cfg['runs']}  latency {cfg['latency_ms']}ms  "
+        f"tabs {cfg['tabs']}  http tier {'on' if cfg['http_tier'] else 'off'}  "
+        f"first check {result['startup_s'] or 0:.1f}s"
+    )
+    for name, s in result["scenarios"].items():
+        ok = s["outcomes"].get(s["expected"], 0) == sum(s["outcomes"].values())
+        mark = "" if ok else f"  ✗ expected {s['expected']}"
+        print(f"\n{name}: {s['outcomes']}{mark}")
+        print(f"  {'stage':<10} {'p50 ms':>8} {'p95 ms':>8}")
+        for stage, st in [("total", s["total_s"]), ("waiting", s["waiting_s"]), *s["stages_s"].items()]:
+            print(f"  {stage:<10} {_ms(st['p50']):>8} {_ms(st['p95']):>8}")
+        rt = s["round_trips"]
+        print(f"  round trips p50 {rt['p50']}  p95 {rt['p95']}   peak Chrome RSS {s['peak_rss_mb']:.0f} MB")
+        if s.get("examined", {}).get("p50"):
+            print(f"  offers examined p50 {s['examined']['p50']}  p95 {s['examined']['p95']}")
+
+
+def compare(old: dict, new: dict):
+    print(f"{old['revision'] or 'old'} ({old['created']}) → {new['revision'] or 'new'} ({new['created']})")
+    for name in new["scenarios"]:
+        if name not in old["scenarios"]:
+            continue
+        a, b = old["scenarios"][name], new["scenarios"][name]
+        print(f"\n{name}")
+        rows = [("total", a["total_s"], b["total_s"])]
+        for stage in b["stages_s"]:
+            rows.append((stage, a["stages_s"].get(stage, {"p50": None, "p95": None}), b["stages_s"][stage]))
+        for stage, x, y in rows:
+            line = f"  {stage:<10}"
+            for pct in ("p50", "p95"):
+                if x[pct] and y[pct] is not None:
+                    delta = (y[pct] - x[pct]) / x[pct] * 100
+                    line += f"  {pct} {_ms(x[pct]):>6} → {_ms(y[pct]):>6} ms ({delta:+.0f}%)"
+                else:
+                    line += f"  {pct} {_ms(x[pct]):>6} → {_ms(y[pct]):>6} ms"
+            print(line)
+        print(
+            f"  round trips p50 {a['round_trips']['p50']} → {b['round_trips']['p50']}   "
+            f"peak RSS {a['peak_rss_mb']:.0f} → {b['peak_rss_mb']:.0f} MB"
+        )
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the check pipeline against local fixtures.")
+    parser.add_argument("--runs", type=int, default=10, help="measured runs per scenario")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured runs first")
+    parser.add_argument("--latency", type=float, default=40, help="ms the server adds per response")
+    parser.add_argument("--tabs", type=int, default=1, help="scenarios checked together, one tab each")
+    parser.add_argument("--http-tier", action="store_true", help="let the static HTTP tier settle checks")
+    parser.add_argument("--scenarios", help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--save", metavar="NAME", help="results file name (default: timestamp)")
+    parser.add_argument("--compare", nargs="+", metavar="RESULT", help="compare a saved run with another or a new one")
+    parser.add_argument("--verbose", action="store_true", help="show the watcher's own log")
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) >= 2:
+        compare(load(args.compare[0]), load(args.compare[1]))
+        sys.exit(0)
+
+    result = run_benchmark(args)
+    print_report(result)
+    os.makedirs(RESULTS, exist_ok=True)
+    path = os.path.join(RESULTS, f"{args.save or time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"\nSaved {path}")
+    if args.compare:
+        print()
+        compare(load(args.compare[0]), result)
@@ -0,0 +1,145 @@
+"""
+Local stand-in for www.amazon.it, serving the saved fixtures at the paths
+the watcher uses, so the check pipeline can run offline:
+
+    /-/en/ref=nav_logo                  home page with the location popover
+    /dp/<ASIN>, /-/en/dp/<ASIN>         product page (PDP)
+    /gp/product/ajax/aodAjaxMain/       all-offers panel, first page
+    /gp/aod/ajax/?pageno=N              further pages of offers
+    /portal-migration/hz/glow/address-change   sets the delivery postcode
+
+Point the watcher at it with AMAZON_BASE=http://127.0.0.1:<port> and use
+product URLs from PRODUCTS.
+
+    python -m bench.server [--port 8765] [--latency 40]
+"""
+
+import argparse
+import os
+import re
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+OFFERS_PER_PAGE = 10
+
+# ASIN -> (PDP fixture, AOD fixture or None)
+PRODUCTS = {
+    "B0BENCH001": ("pdp_in_stock.html", None),
+    "B0BENCH002": ("pdp_out_of_stock.html", None),
+    "B0BENCH003": ("pdp_pinned_only.html", "aod_pinned_only.html"),
+    "B0BENCH004": ("pdp_offers_50.html", "aod_offers_50.html"),
+}
+
+_DP_PATH = re.compile(r"^(?:/-/[a-z]{2})?(?:/[^/]+)?/dp/([A-Z0-9]{10})")
+_CACHE = {}
+
+
+def fixture(name: str) -> str:
+    if name not in _CACHE:
+        with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+            _CACHE[name] = f.read()
+    return _CACHE[name]
+
+
+def aod_page(name: str, page: int) -> str:
+    """Page `page` (1-based) of an AOD fixture; page 1 includes the panel around it."""
+    text = fixture(name)
+    head, sep, rest = text.partition("<!-- aod-offer -->")
+    if not sep:
+        return text if page == 1 else ""
+    body, _, tail = rest.partition("<!-- /aod-offers -->")
+    offers = ["<!-- aod-offer -->" + o for o in body.split("<!-- aod-offer -->")]
+    chunk = "".join(offers[(page - 1) * OFFERS_PER_PAGE : page * OFFERS_PER_PAGE])
+    return head + chunk + "<!-- /aod-offers -->" + tail if page == 1 else chunk
+
+
+class Handler(BaseHTTPRequestHandler):
+    latency = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _postcode(self) -> str:
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        return cookie["aw-zip"].value if "aw-zip" in cookie else ""
+
+    def _send(self, status: int, body: str, ctype="text/html; charset=utf-8", headers=()):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-store")
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _page(self, name: str, asin: str = ""):
+        postcode = self._postcode()
+        location = f"Roma {postcode}" if postcode else "Italia"
+        body = fixture(name).replace("{{location}}", location).replace("{{asin}}", asin)
+        self._send(200, body)
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        asin = query.get("asin", [""])[0]
+
+        if url.path in ("/", "/-/en/ref=nav_logo", "/ref=nav_logo"):
+            return self._page("home.html")
+        if url.path == "/bench/aod.js":
+            return self._send(200, fixture("aod.js"), "application/javascript")
+        m = _DP_PATH.match(url.path)
+        if m and m.group(1) in PRODUCTS:
+            return self._page(PRODUCTS[m.group(1)][0], m.group(1))
+        if url.path.startswith(("/gp/product/ajax/aodAjaxMain", "/gp/aod/ajax")):
+            aod = PRODUCTS.get(asin, (None, None))[1]
+            if aod is None:
+                return self._send(404, "")
+            page = int(query.get("pageno", ["1"])[0])
+            return self._send(200, aod_page(aod, page))
+        self._send(404, "<html><body>Page not found</body></html>")
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        if urlsplit(self.path).path != "/portal-migration/hz/glow/address-change":
+            return self._send(404, "")
+        postcode = form.get("zipCode", [""])[0]
+        self._send(
+            200,
+            '{"isValidAddress":1}',
+            "application/json",
+            [("Set-Cookie", f"aw-zip={postcode}; Path=/; Max-Age=31536000")],
+        )
+
+
+def start_server(port: int = 0, latency_ms: float = 0.0) -> ThreadingHTTPServer:
+    """Serve in a daemon thread; the base URL is http://127.0.0.1:<server.server_port>."""
+    handler = type("BenchHandler", (Handler,), {"latency": latency_ms / 1000})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bench-server", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the Amazon fixtures locally.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=40, help="ms added to every response")
+    args = parser.parse_args()
+    server = start_server(args.port, args.latency)
+    print(f"Serving fixtures on http://127.0.0.1:{server.server_port}")
+    for asin, (pdp, _) in PRODUCTS.items():
+        print(f"  http://127.0.0.1:{server.server_port}/dp/{asin}  ({pdp})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
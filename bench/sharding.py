@@ -0,0 +1,207 @@
+"""
+Lease sharding against the Firestore emulator: seeds links, runs several
+LeaseManagers in this process (one per simulated instance, each with its own
+snapshot listener), then lets an instance join, one die without releasing
+and one leave cleanly. After each step it reports how long until every link
+was held by exactly one instance, and the split. Throughout, it samples
+whether any link is checked by two instances at once. Last, one instance
+with a real Scheduler loses and reclaims its leases while a check is
+running, and reports whether those links are still scheduled afterwards.
+
+    gcloud emulators firestore start --host-port=127.0.0.1:8686
+    FIRESTORE_EMULATOR_HOST=127.0.0.1:8686 python -m bench.sharding [--links 200] [--instances 3]
+
+It wipes the emulator's links and instances collections first and refuses
+to run without FIRESTORE_EMULATOR_HOST.
+"""
+
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Instance:
+    """One simulated watcher: a LeaseManager fed by its own listener; `checking` is what it would schedule."""
+
+    def __init__(self, main, name: str):
+        self.name = name
+        self.checking = set()
+        self.leases = main.LeaseManager(self.checking.add, self.checking.discard, instance_id=name)
+        self.leases.start()
+        self.listener = main.get_db().collection("links").on_snapshot(self.on_snapshot)
+
+    def on_snapshot(self, col_snapshot, changes, read_time):
+        for change in changes:
+            doc = change.document
+            item = None if change.type.name == "REMOVED" else doc.to_dict()
+            self.leases.observe(doc.id, item, doc.update_time)
+
+    def stop(self, release: bool):
+        self.listener.unsubscribe()
+        self.leases.stop(release=release)
+        self.checking.clear()
+
+
+class Overlaps(threading.Thread):
+    """Sample the instances' link sets; remember any link seen in two at once."""
+
+    def __init__(self, instances):
+        super().__init__(name="overlaps", daemon=True)
+        self.instances = instances
+        self.seen = set()
+
+    def run(self):
+        while True:
+            owner = {}
+            for inst in list(self.instances):
+                for doc_id in list(inst.checking):
+                    if doc_id in owner:
+                        self.seen.add(doc_id)
+                    owner[doc_id] = inst.name
+            time.sleep(0.02)
+
+
+def wait_settled(instances, links: int, timeout: float) -> float:
+    """Seconds until every link is held exactly once and the split stopped moving; None on timeout."""
+    t0 = time.monotonic()
+    last, since = None, None
+    while time.monotonic() - t0 < timeout:
+        split = [len(inst.checking) for inst in instances]
+        covered = len(set().union(*(inst.checking for inst in instances))) == links == sum(split)
+        if covered and split == last:
+            if time.monotonic() - since >= 2 * float(os.environ["LEASE_HEARTBEAT"]):
+                return since - t0
+        else:
+            last, since = (split if covered else None), time.monotonic()
+        time.sleep(0.05)
+    return None
+
+
+class HeldChecks:
+    """Executor stand-in: every check stays running until the test finishes it."""
+
+    def __init__(self):
+        self.futures = queue.Queue()
+
+    def submit(self, fn, jobs, *args):
+        future = Future()
+        self.futures.put((future, [doc_id for doc_id, _ in jobs]))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+def reclaim_during_check(main) -> bool:
+    """
+    Lease expiry and reclaim while a check runs: the links of that check
+    must be scheduled again once it finishes.
+    """
+    db = main.get_db()
+    links = {doc.id: doc.to_dict() for doc in db.collection("links").stream()}
+    shared = {
+        "links": links, "state": queue.Queue(), "notify": queue.Queue(),
+        "generations": {}, "registry": {}, "recycle": {},
+    }
+    main.init_worker(shared)
+    pool = HeldChecks()
+    scheduler = main.Scheduler(lambda: pool, 1, "", "", 0.0, shared)
+
+    def released(doc_id):  # as run_watcher's lease_released
+        shared["generations"][doc_id] = shared["generations"].get(doc_id, 0) + 1
+        scheduler.remove(doc_id)
+
+    leases = main.LeaseManager(scheduler.add, released, instance_id="reclaimer")
+
+    def observe_all():
+        for doc in db.collection("links").stream():
+            leases.observe(doc.id, doc.to_dict(), doc.update_time)
+
+    scheduler.start()
+    try:
+        observe_all()
+        leases.rebalance(time.time())  # sole member: claims every link
+        future, doc_ids = pool.futures.get(timeout=30)
+        leases.expire(time.time() + 2 * float(os.environ["LEASE_TTL"]))  # every lease runs out
+        observe_all()
+        leases.rebalance(time.time())  # and is claimed again
+        future.set_result([{"doc_id": d, "outcome": "cancelled", "timing": None} for d in doc_ids])
+        with scheduler.cond:
+            return all(d in scheduler.due for d in doc_ids)
+    finally:
+        scheduler.stop()
+        main._commit_link_states({d: main._LEASE_RELEASE for d in leases.held})
+
+
+def wipe(db):
+    for name in ("links", "instances"):
+        for doc in db.collection(name).stream():
+            doc.reference.delete()
+
+
+def run(args):
+    import main
+
+    db = main.get_db()
+    wipe(db)
+    links = db.collection("links")
+    urls = {}
+    for i in range(args.links):
+        # two links per product, so grouping can be checked too
+        urls[f"link{i}"] = f"https://www.amazon.it/item/dp/B0SHARD{i % (args.links // 2 or 1):03d}"
+        links.document(f"link{i}").set({
+            "url": urls[f"link{i}"], "target_price": 10.0, "check_shipped": True, "check_sold": True,
+        })
+
+    instances = [Instance(main, f"watcher-{n}") for n in range(args.instances)]
+    overlaps = Overlaps(instances)
+    overlaps.start()
+
+    def step(label):
+        took = wait_settled(instances, args.links, args.timeout)
+        split = ", ".join(f"{inst.name}={len(inst.checking)}" for inst in instances)
+        print(f"{label:<22} {'timeout' if took is None else f'{took:5.1f}s'}  {split}")
+
+    step("start")
+    instances.append(Instance(main, f"watcher-{len(instances)}"))
+    step("instance joined")
+    dead = instances.pop(0)
+    dead.stop(release=False)
+    step(f"{dead.name} died")
+    gone = instances.pop(0)
+    gone.stop(release=True)
+    step(f"{gone.name} left")
+
+    holders = {}
+    for inst in instances:
+        for doc_id in inst.checking:
+            holders.setdefault(main.product_key(urls[doc_id]), set()).add(inst.name)
+    split = sum(1 for names in holders.values() if len(names) > 1)
+    print(f"\nlinks checked twice at some point: {len(overlaps.seen)}")
+    print(f"products split across instances: {split}")
+    for inst in instances:
+        inst.stop(release=True)
+
+    ok = reclaim_during_check(main)
+    print(f"reclaimed during a check: {'rescheduled' if ok else 'DROPPED from the schedule'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exercise lease sharding against the Firestore emulator.")
+    parser.add_argument("--links", type=int, default=200)
+    parser.add_argument("--instances", type=int, default=3)
+    parser.add_argument("--ttl", type=float, default=6, help="LEASE_TTL for the run, seconds")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for each step")
+    args = parser.parse_args()
+    if not os.environ.get("FIRESTORE_EMULATOR_HOST"):
+        sys.exit("FIRESTORE_EMULATOR_HOST is not set; this wipes collections, so it only runs against the emulator")
+    os.environ.pop("FIREBASE_SERVICE_ACCOUNT_JSON", None)
+    os.environ.update(LEASE_TTL=str(args.ttl), LEASE_HEARTBEAT=str(args.ttl / 5), LOG="false")
+    sys.path.insert(0, ROOT)
+    run(args)
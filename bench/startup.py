@@ -0,0 +1,141 @@
+"""
+Startup cost of the two process roles, without Chrome or Firestore:
+
+  worker  spawn a pool process the way the watcher does (spawn context,
+          init_worker initializer) and time it until it ran its first task;
+          reports its RSS and which heavy packages it ended up loading
+  parent  import main, then what the parent adds on top: firebase_admin
+          (as get_db() would import it), the Flask app and the Manager
+
+plus a breakdown of `import main` by top-level package (-X importtime).
+
+    python -m bench.startup [--runs 5] [--top 12]
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ("selenium", "firebase_admin", "google.cloud.firestore", "grpc", "flask", "lxml", "prometheus_client")
+
+_IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def rss_mb(pid="self") -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def probe() -> dict:
+    """Runs in the worker: what did its startup leave behind?"""
+    return {
+        "rss_mb": rss_mb(),
+        "modules": len(sys.modules),
+        "loaded": [name for name in HEAVY if name in sys.modules],
+    }
+
+
+def time_worker() -> dict:
+    import main
+
+    ctx = mp.get_context("spawn")
+    shared = {
+        "links": {}, "state": ctx.Queue(), "notify": ctx.Queue(),
+        "generations": {}, "registry": {}, "recycle": {},
+    }
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=1, mp_context=ctx, initializer=main.init_worker, initargs=(shared,)
+    ) as pool:
+        result = pool.submit(probe).result()
+    result["seconds"] = time.perf_counter() - t0
+    return result
+
+
+def time_parent() -> dict:
+    """Parent stages, each in a fresh interpreter so nothing is cached."""
+    script = r"""
+import json, sys, time
+t0 = time.perf_counter()
+import main
+t1 = time.perf_counter()
+import firebase_admin, firebase_admin.firestore, firebase_admin.credentials
+t2 = time.perf_counter()
+main.create_app()
+t3 = time.perf_counter()
+import multiprocessing as mp
+manager = mp.get_context("spawn").Manager()
+t4 = time.perf_counter()
+manager.shutdown()
+print(json.dumps({"import main": t1 - t0, "firebase_admin": t2 - t1, "flask app": t3 - t2, "manager": t4 - t3}))
+"""
+    out = subprocess.run(
+        [sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True,
+        env={**os.environ, "LOG": "false"},
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def import_breakdown() -> dict:
+    """Cumulative microseconds per top-level package imported by `import main`."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT, capture_output=True, text=True, check=True,
+        env={**os.environ, "LOG": "false"},
+    )
+    # post-order: a module's imports are listed before it, one level deeper
+    totals = {}
+    for line in out.stderr.splitlines():
+        m = _IMPORT_LINE.match(line)
+        if not m:
+            continue
+        self_us, cumulative, depth, name = int(m[1]), int(m[2]), len(m[3]), m[4]
+        if depth == 1 and name == "main":
+            totals["main (own code)"] = self_us
+            totals["total"] = cumulative
+            return totals
+        if depth == 1:
+            totals = {}  # the interpreter's own imports, not main's
+        elif depth == 3:
+            top = name.split(".")[0]
+            totals[top] = totals.get(top, 0) + cumulative
+    return totals
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time parent and worker startup.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=12, help="packages shown in the import breakdown")
+    args = parser.parse_args()
+    sys.path.insert(0, ROOT)
+    os.environ["LOG"] = "false"
+
+    workers = [time_worker() for _ in range(args.runs)]
+    print(f"worker (spawn → first task), {args.runs} runs")
+    print(f"  seconds   median {statistics.median(w['seconds'] for w in workers):.3f}  "
+          f"max {max(w['seconds'] for w in workers):.3f}")
+    print(f"  RSS       {statistics.median(w['rss_mb'] for w in workers):.0f} MB, "
+          f"{workers[0]['modules']} modules")
+    print(f"  loaded    {', '.join(workers[0]['loaded']) or '-'}")
+
+    parents = [time_parent() for _ in range(args.runs)]
+    print(f"\nparent, {args.runs} runs (median seconds)")
+    for stage in parents[0]:
+        print(f"  {stage:<16} {statistics.median(p[stage] for p in parents):.3f}")
+
+    totals = import_breakdown()
+    total = totals.pop("total", 0)
+    print(f"\nimport main: {total / 1000:.0f} ms")
+    for name, us in sorted(totals.items(), key=lambda kv: -kv[1])[: args.top]:
+        print(f"  {name:<24} {us / 1000:7.1f} ms")
@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 import os
+import re
 import json
 import time
+import hashlib
 import random
+import heapq
+import bisect
+import fcntl
+import sqlite3
+import signal
+import socket
+import logging
 from datetime import datetime
-
-import firebase_admin
-from firebase_admin import credentials, firestore
-
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+from lxml import html as lxml_html
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
@@ -17,19 +26,101 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.common.exceptions import (
+    JavascriptException,
+    TimeoutException,
+    WebDriverException,
+)
 from threading import Thread
-from flask import Flask, jsonify
+from queue import Empty, Full, Queue
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    Counter,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import GaugeMetricFamily
 import multiprocessing as mp
+from multiprocessing.util import Finalize
 from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import threading
 
-app = Flask(__name__)
-
 # ─── CONFIG ─────────────────────────────────────────────
 CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", 300))
 LOG = os.getenv("LOG", "true").lower() in ("1", "true", "yes")
 CHROMEDRIVER = os.getenv("CHROMEDRIVER_PATH", "/usr/local/bin/chromedriver")
+DRIVER_POOL_SIZE = int(os.getenv("DRIVER_POOL_SIZE", 1))
+DRIVER_MAX_USES = int(os.getenv("DRIVER_MAX_USES", 50))
+DRIVER_MAX_AGE = int(os.getenv("DRIVER_MAX_AGE", 3600))
+DRIVER_MAX_RSS_MB = int(os.getenv("DRIVER_MAX_RSS_MB", 800))
+WAIT_ELEMENT_TIMEOUT = float(os.getenv("WAIT_ELEMENT_TIMEOUT", 5))
+WAIT_PAGE_TIMEOUT = float(os.getenv("WAIT_PAGE_TIMEOUT", 30))
+WAIT_IDLE_TIMEOUT = float(os.getenv("WAIT_IDLE_TIMEOUT", 8))
+WAIT_IDLE_QUIET = float(os.getenv("WAIT_IDLE_QUIET", 0.5))
+WAIT_SCROLL_TIMEOUT = float(os.getenv("WAIT_SCROLL_TIMEOUT", 10))
+CHECK_INTERVAL_MIN = float(os.getenv("CHECK_INTERVAL_MIN", 30))
+CHECK_INTERVAL_MAX = float(os.getenv("CHECK_INTERVAL_MAX", 3600))
+CHECKS_PER_MINUTE = float(os.getenv("CHECKS_PER_MINUTE", 0))  # 0 = no budget
+FULL_CHECK_EVERY = max(1, int(os.getenv("FULL_CHECK_EVERY", 6)))  # 1 = never skip
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", 20))
+TABS_PER_BROWSER = max(1, int(os.getenv("TABS_PER_BROWSER", 1)))
+CANCEL_GRACE = float(os.getenv("CANCEL_GRACE", 30))
+CHECK_HARD_TIMEOUT = float(os.getenv("CHECK_HARD_TIMEOUT", 300))
+POLICE_INTERVAL = float(os.getenv("POLICE_INTERVAL", 5))
+MEMORY_LIMIT_MB = int(os.getenv("MEMORY_LIMIT_MB", 0))  # 0 = cgroup limit
+MEMORY_RESERVE_MB = int(os.getenv("MEMORY_RESERVE_MB", 512))
+MEMORY_CRITICAL = float(os.getenv("MEMORY_CRITICAL", 0.95))
+BROWSER_MEM_MB = int(os.getenv("BROWSER_MEM_MB", 350))
+DELIVERY_POSTCODE = os.getenv("DELIVERY_POSTCODE", "00049")
+LOCATION_STORE = os.getenv("LOCATION_STORE", "/tmp/amazon_watcher_location.json")
+LOCATION_TTL = int(os.getenv("LOCATION_TTL", 6 * 3600))
+STATE_FLUSH_SIZE = int(os.getenv("STATE_FLUSH_SIZE", 50))
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", 2))
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", 1000))
+NOTIFY_BATCH_WINDOW = float(os.getenv("NOTIFY_BATCH_WINDOW", 3))
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", 5))
+TELEGRAM_API = os.getenv("TELEGRAM_API", "https://api.telegram.org").rstrip("/")
+AMAZON_BASE = os.getenv("AMAZON_BASE", "https://www.amazon.it").rstrip("/")
+BLOCK_RESOURCES = os.getenv("BLOCK_RESOURCES", "true").lower() in ("1", "true", "yes")
+BLOCK_RESOURCE_TYPES = [
+    t.strip() for t in os.getenv("BLOCK_RESOURCE_TYPES", "image,font,media").split(",") if t.strip()
+]
+BLOCK_HOSTS = [
+    h.strip()
+    for h in os.getenv(
+        "BLOCK_HOSTS",
+        "amazon-adsystem.com,doubleclick.net,googlesyndication.com,"
+        "fls-eu.amazon.it,unagi-eu.amazon.com,unagi.amazon.com,aax-eu.amazon.it",
+    ).split(",")
+    if h.strip()
+]
+ALLOW_URLS = [
+    u.strip()
+    for u in os.getenv(
+        "ALLOW_URLS",
+        f"{AMAZON_BASE}/gp/product/ajax/aodAjaxMain/*,{AMAZON_BASE}/gp/aod/ajax/*",
+    ).split(",")
+    if u.strip()
+]
+REQUESTS_PER_MINUTE = float(os.getenv("REQUESTS_PER_MINUTE", 60))  # 0 = no ceiling
+REQUEST_BURST = float(os.getenv("REQUEST_BURST", 10))
+THROTTLE_BACKOFF = float(os.getenv("THROTTLE_BACKOFF", 30))
+THROTTLE_BACKOFF_MAX = float(os.getenv("THROTTLE_BACKOFF_MAX", 900))
+HTTP_TIER = os.getenv("HTTP_TIER", "true").lower() in ("1", "true", "yes")
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 10))
+STATIC_COOLDOWN = float(os.getenv("STATIC_COOLDOWN", 600))
+HTTP_PORT = int(os.getenv("PORT", 8080))
+HEALTH_STALE = float(os.getenv("HEALTH_STALE", 900))
+HISTORY_DB = os.getenv("HISTORY_DB", "/tmp/amazon_watcher_history.sqlite3")  # empty = off
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", 5))
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "")  # file path or OTLP/HTTP URL; empty = off
+TRACE_SERVICE = os.getenv("TRACE_SERVICE", "amazon-watcher")
+SHARDING = os.getenv("SHARDING", "false").lower() in ("1", "true", "yes")
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEASE_TTL = float(os.getenv("LEASE_TTL", 300))
+LEASE_HEARTBEAT = float(os.getenv("LEASE_HEARTBEAT", LEASE_TTL / 5))
 # ───────────────────────────────────────────────────────
 
 
@@ -40,30 +131,479 @@ def log(msg: str):
 
 
 # ─── Firebase init ─────────────────────────────────────
-svc_json = os.environ.get("FIREBASE_SERVICE_ACCOUNT_JSON")
-if not svc_json:
-    raise RuntimeError("FIREBASE_SERVICE_ACCOUNT_JSON must be set")
-cred_dict = json.loads(svc_json)
-cred = credentials.Certificate(cred_dict)
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+# Imported and created on first use. Spawned workers re-import this module
+# but read link state from the cache below and write through the parent, so
+# they never load firebase_admin or open a gRPC channel. With
+# FIRESTORE_EMULATOR_HOST set and no service account, the client talks to the
+# emulator (project GOOGLE_CLOUD_PROJECT) without credentials.
+_DB = None
+
+
+def get_db():
+    global _DB
+    if _DB is None and os.environ.get("FIRESTORE_EMULATOR_HOST") and not os.environ.get(
+        "FIREBASE_SERVICE_ACCOUNT_JSON"
+    ):
+        from google.cloud import firestore
+
+        _DB = firestore.Client()
+    if _DB is None:
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+
+        svc_json = os.environ.get("FIREBASE_SERVICE_ACCOUNT_JSON")
+        if not svc_json:
+            raise RuntimeError("FIREBASE_SERVICE_ACCOUNT_JSON must be set")
+        cred_dict = json.loads(svc_json)
+        cred = credentials.Certificate(cred_dict)
+        firebase_admin.initialize_app(cred)
+        _DB = firestore.client()
+    return _DB
 
 
 def load_config():
-    doc = db.collection("config").document("settings").get()
+    with FIRESTORE_SECONDS.labels("get").time():
+        doc = get_db().collection("config").document("settings").get()
     return doc.to_dict() if doc.exists else {}
 
 
 def load_links():
-    return [(doc.id, doc.to_dict()) for doc in db.collection("links").stream()]
+    return [(doc.id, doc.to_dict()) for doc in get_db().collection("links").stream()]
+
+
+# ─── Metrics ───────────────────────────────────────────
+# Only the parent's metrics are served; checks run in worker processes, so
+# their counts and latencies are recorded when the scheduler gets the result.
+FIRESTORE_SECONDS = Histogram(
+    "amazon_watcher_firestore_call_seconds", "Firestore call latency", ["op"]
+)
+TELEGRAM_SECONDS = Histogram(
+    "amazon_watcher_telegram_call_seconds", "Telegram sendMessage latency", ["status"]
+)
+CHECKS = Counter("amazon_watcher_checks", "Finished checks by outcome", ["outcome"])
+CHECK_SECONDS = Histogram(
+    "amazon_watcher_check_duration_seconds",
+    "Check latency per link",
+    ["link"],
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300),
+)
+OFFERS_EXAMINED = Histogram(
+    "amazon_watcher_offers_examined",
+    "AOD list offers a check looked at before it matched or ran out",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200),
+)
+FETCHES = Counter(
+    "amazon_watcher_page_fetches", "Product and home page loads by result", ["result"]
+)
+CHECK_SKIPS = Counter(
+    "amazon_watcher_check_skips",
+    "Checks that skipped the offer list on an unchanged fingerprint",
+    ["fingerprint"],
+)
+
+
+# ─── Link state cache ──────────────────────────────────
+# The parent's on_snapshot listener is the only reader of the links
+# collection. It mirrors every document into a Manager dict that the worker
+# processes receive through init_worker(), so a check does no Firestore read.
+# Writes go the other way through a queue to the parent's StateWriter, so
+# workers never need a Firestore client of their own.
+_LINK_CACHE = None
+_LINK_LOCK = None  # held around every read-modify-write of a _LINK_CACHE entry
+_STATE_QUEUE = None
+# Pass as a field value to delete the field; becomes firestore.DELETE_FIELD
+# when the parent commits (which doesn't survive pickling anyway).
+_DELETE = "__delete_field__"
+
+# Fields that define what a check does; changing one cancels a running check.
+CHECK_FIELDS = ("url", "name", "target_price", "check_shipped", "check_sold")
+
+
+def init_worker(shared: dict):
+    """
+    Wire a process to the parent's shared objects: "links" (link cache) and
+    "links_lock" (its writers' lock), "state" and "notify" (queues), "generations", "registry" and "recycle"
+    (worker control), "budget" (request budget).
+    """
+    global _LINK_CACHE, _LINK_LOCK, _STATE_QUEUE, _NOTIFY_QUEUE, _GENERATIONS, _REGISTRY, _RECYCLE, _BUDGET
+    _LINK_CACHE = shared["links"]
+    _LINK_LOCK = shared.get("links_lock")
+    _STATE_QUEUE = shared["state"]
+    _NOTIFY_QUEUE = shared["notify"]
+    _GENERATIONS = shared["generations"]
+    _REGISTRY = shared["registry"]
+    _RECYCLE = shared.get("recycle")
+    _BUDGET = shared.get("budget")
+
+
+def check_fields_changed(old, new) -> bool:
+    if old is None or new is None:
+        return True
+    return any(old.get(k) != new.get(k) for k in CHECK_FIELDS)
+
+
+def cached_link(doc_id: str):
+    """Latest known state of a link, or None once it has been removed."""
+    return _LINK_CACHE.get(doc_id)
+
+
+# Links to the same product (same marketplace and ASIN, whatever the slug,
+# language prefix or query string) are fetched once and share the offers.
+_ASIN_PATH = re.compile(r"/(?:dp|gp/product|gp/aw/d|gp/offer-listing)/([A-Z0-9]{10})(?=[/?#]|$)", re.I)
+# language override, e.g. /-/en/ on amazon.it; it also decides the number format
+_LANGUAGE_PATH = re.compile(r"^/-/[a-z]{2}(?:[_-][a-z]{2})?(?=/)", re.I)
+
+
+def product_key(url: str) -> str:
+    """"host/ASIN" of an Amazon product URL; the URL itself if it has no ASIN."""
+    parts = urlsplit(url)
+    m = _ASIN_PATH.search(parts.path)
+    if not m:
+        return url
+    return f"{parts.netloc.lower().removeprefix('www.')}/{m.group(1).upper()}"
+
+
+def product_url(url: str) -> str:
+    """Canonical /dp/ASIN URL for the product `url` points at, keeping its language."""
+    parts = urlsplit(url)
+    m = _ASIN_PATH.search(parts.path)
+    if not m:
+        return url
+    lang = _LANGUAGE_PATH.match(parts.path)
+    prefix = lang.group(0).lower() if lang else ""
+    return f"{parts.scheme}://{parts.netloc}{prefix}/dp/{m.group(1).upper()}"
 
 
 def save_link_state(doc_id: str, fields: dict):
     # if we're marking it available now, and no timestamp was provided, add one
     if fields.get("available") is True and "available_since" not in fields:
         fields["available_since"] = time.time()
-    # allow callers to explicitly delete available_since by passing firestore.DELETE_FIELD
-    db.collection("links").document(doc_id).update(fields)
+    # reflect the change locally right away; the snapshot echo will agree.
+    # The lock keeps a snapshot landing between get and set from being undone.
+    if _LINK_CACHE is not None:
+        with _LINK_LOCK or nullcontext():
+            item = _LINK_CACHE.get(doc_id)
+            if item is not None:
+                for key, value in fields.items():
+                    if value == _DELETE:
+                        item.pop(key, None)
+                    else:
+                        item[key] = value
+                _LINK_CACHE[doc_id] = item
+
+    if _STATE_QUEUE is not None:
+        _STATE_QUEUE.put((doc_id, fields))
+    else:
+        _commit_link_states({doc_id: fields})
+
+
+def _firestore_fields(fields: dict) -> dict:
+    from firebase_admin import firestore
+
+    return {k: firestore.DELETE_FIELD if v == _DELETE else v for k, v in fields.items()}
+
+
+def _commit_link_states(pending: dict) -> set:
+    """Write {doc_id: fields} in batches of up to 500, falling back per doc; returns the doc_ids written."""
+    links = get_db().collection("links")
+    doc_ids = list(pending)
+    written = set()
+    for i in range(0, len(doc_ids), 500):
+        chunk = doc_ids[i : i + 500]
+        batch = get_db().batch()
+        for doc_id in chunk:
+            batch.update(links.document(doc_id), _firestore_fields(pending[doc_id]))
+        try:
+            with FIRESTORE_SECONDS.labels("batch_commit").time():
+                batch.commit()
+            written.update(chunk)
+        except Exception as e:
+            # one missing doc fails the whole batch; retry the rest one by one
+            log(f"→ State batch failed ({e}); writing {len(chunk)} docs individually")
+            for doc_id in chunk:
+                try:
+                    with FIRESTORE_SECONDS.labels("update").time():
+                        links.document(doc_id).update(_firestore_fields(pending[doc_id]))
+                    written.add(doc_id)
+                except Exception as e:
+                    log(f"[{doc_id}] State write failed: {e}")
+    return written
+
+
+class StateWriter(Thread):
+    """
+    Write-behind queue for link state. Updates from the workers are merged
+    per document, changes that match what Firestore already holds (or is
+    about to, once the flush under way lands) are dropped, and the rest is
+    committed as a batch once STATE_FLUSH_SIZE docs are pending or the
+    oldest has waited STATE_FLUSH_INTERVAL seconds.
+    """
+
+    def __init__(self, queue):
+        super().__init__(name="state-writer", daemon=True)
+        self.queue = queue
+        self.stored = {}  # doc_id -> fields as Firestore last reported them
+        self.pending = {}
+        self.inflight = {}  # doc_id -> fields of the commit under way
+        self.first_pending = None
+        self.lock = threading.Lock()
+        self.stats = {"queued": 0, "dropped": 0, "written": 0, "batches": 0}
+
+    def observe(self, doc_id: str, item):
+        """Record a document as seen by the snapshot listener (None = removed)."""
+        with self.lock:
+            if item is None:
+                self.stored.pop(doc_id, None)
+                self.pending.pop(doc_id, None)
+            else:
+                self.stored[doc_id] = dict(item)
+
+    def _merge(self, doc_id: str, fields: dict):
+        with self.lock:
+            self.stats["queued"] += 1
+            if doc_id not in self.stored:
+                return  # removed meanwhile; nothing to update
+            merged = self.pending.setdefault(doc_id, {})
+            merged.update(fields)
+            # what Firestore will hold once the commit under way lands
+            current = {**self.stored[doc_id], **self.inflight.get(doc_id, {})}
+            for key in list(merged):
+                if current.get(key, _DELETE) == merged[key]:
+                    del merged[key]
+            if not merged:
+                del self.pending[doc_id]
+                self.stats["dropped"] += 1
+            elif self.first_pending is None:
+                self.first_pending = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            first_pending, self.first_pending = self.first_pending, None
+            self.inflight = pending
+        if not pending:
+            return
+        try:
+            written = _commit_link_states(pending)
+        except Exception as e:
+            log(f"→ State flush failed: {e}")
+            written = set()
+        with self.lock:
+            self.inflight = {}
+            failed = 0
+            for doc_id, fields in pending.items():
+                stored = self.stored.get(doc_id)
+                if stored is None:
+                    continue  # removed meanwhile
+                if doc_id in written:
+                    for key, value in fields.items():
+                        if value == _DELETE:
+                            stored.pop(key, None)
+                        else:
+                            stored[key] = value
+                else:
+                    # retry with the next flush, under anything queued since
+                    self.pending[doc_id] = {**fields, **self.pending.get(doc_id, {})}
+                    failed += 1
+            if failed:
+                self.first_pending = min(filter(None, (first_pending, self.first_pending)))
+        self.stats["written"] += len(written)
+        self.stats["batches"] += 1
+        log(
+            f"→ Flushed state for {len(written)} links"
+            + (f", {failed} kept for retry" if failed else "")
+            + f" (queued={self.stats['queued']} dropped={self.stats['dropped']} "
+            f"written={self.stats['written']} batches={self.stats['batches']})"
+        )
+
+    def _due(self) -> bool:
+        if self.first_pending is None:
+            return False
+        return (
+            len(self.pending) >= STATE_FLUSH_SIZE
+            or time.monotonic() - self.first_pending >= STATE_FLUSH_INTERVAL
+        )
+
+    def run(self):
+        while True:
+            try:
+                msg = self.queue.get(timeout=STATE_FLUSH_INTERVAL / 4)
+            except Empty:
+                msg = ()
+            if msg is None:
+                break
+            if msg:
+                self._merge(*msg)
+            if self._due():
+                try:
+                    self.flush()
+                except Exception as e:
+                    log(f"→ State flush failed: {e}")
+        self.flush()
+
+    def stop(self):
+        """Drain everything still queued, flush it and stop the thread."""
+        self.queue.put(None)
+        self.join()
+
+
+# ─── Price history ─────────────────────────────────────
+# Every priced offer a check reads goes to a local SQLite file (WAL mode) in
+# the parent. An offer seen again at the same price by the next check only
+# extends its row (last_seen, hits), so a stable listing costs one row, not
+# one per check. Sellers and links are interned to small integers.
+_SOURCES = {"core": 0, "pinned": 1, "list": 2}
+
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS links (id INTEGER PRIMARY KEY, doc_id TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS sellers (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS offers (
+    id INTEGER PRIMARY KEY,
+    link INTEGER NOT NULL,
+    source INTEGER NOT NULL,
+    ships_from INTEGER NOT NULL,
+    sold_by INTEGER NOT NULL,
+    price INTEGER NOT NULL,  -- cents
+    first_seen INTEGER NOT NULL,  -- unix seconds
+    last_seen INTEGER NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS offers_link_seen ON offers (link, last_seen);
+"""
+
+
+def _history_connect(path: str):
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class HistoryStore(Thread):
+    """
+    Write-behind recorder for observed offers. record() only queues; the
+    thread commits one transaction per HISTORY_FLUSH_INTERVAL. price_stats()
+    may be called from any thread and reads through its own connection.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(name="history", daemon=True)
+        self.path = path
+        self.queue = Queue()
+        self.links = {}
+        self.sellers = {}
+        # link -> {(source, ships_from, sold_by, price): [row id, …]} of its
+        # previous recorded check; a list, as identical offers can repeat
+        self.last = {}
+        self.stats = {"observed": 0, "inserted": 0, "extended": 0}
+        conn = _history_connect(path)
+        conn.executescript(_HISTORY_SCHEMA)
+        conn.close()
+
+    def record(self, doc_id: str, checked_at: float, offers: list):
+        self.queue.put((doc_id, checked_at, offers))
+
+    def _intern(self, conn, table: str, cache: dict, column: str, value: str) -> int:
+        if value not in cache:
+            conn.execute(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", (value,))
+            cache[value] = conn.execute(
+                f"SELECT id FROM {table} WHERE {column} = ?", (value,)
+            ).fetchone()[0]
+        return cache[value]
+
+    def _write(self, conn, batch):
+        for doc_id, checked_at, offers in batch:
+            link = self._intern(conn, "links", self.links, "doc_id", doc_id)
+            now = int(checked_at)
+            previous = self.last.get(link, {})
+            seen = self.last[link] = {}
+            for offer in offers:
+                self.stats["observed"] += 1
+                key = (
+                    _SOURCES[offer["source"]],
+                    self._intern(conn, "sellers", self.sellers, "name", offer["ships_from"]),
+                    self._intern(conn, "sellers", self.sellers, "name", offer["sold_by"]),
+                    round(offer["price"] * 100),
+                )
+                rows = previous.get(key)
+                # extend a row of the previous check that no other offer has taken yet
+                if rows:
+                    row = rows.pop()
+                    conn.execute(
+                        "UPDATE offers SET last_seen = ?, hits = hits + 1 WHERE id = ?",
+                        (now, row),
+                    )
+                    self.stats["extended"] += 1
+                else:
+                    row = conn.execute(
+                        "INSERT INTO offers (link, source, ships_from, sold_by, price, first_seen, last_seen)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (link, *key, now, now),
+                    ).lastrowid
+                    self.stats["inserted"] += 1
+                seen.setdefault(key, []).append(row)
+
+    def run(self):
+        conn = _history_connect(self.path)
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+            while True:
+                try:
+                    msg = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if msg is None:
+                    stopping = True
+                    break
+                batch.append(msg)
+            if not batch:
+                continue
+            try:
+                with conn:
+                    self._write(conn, batch)
+            except Exception as e:
+                self.last.clear()  # rows may not exist; start new runs
+                log(f"→ History write failed: {e}")
+        conn.close()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join(timeout=30)
+
+    def price_stats(self, doc_id: str, since: float, until: float = None) -> dict:
+        """
+        Min and median price of a link's offers seen between since and until,
+        each offer weighted by the checks that saw it, plus that sighting count.
+        """
+        until = time.time() if until is None else until
+        conn = _history_connect(self.path)
+        try:
+            row = conn.execute("SELECT id FROM links WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row is None:
+                return {"min": None, "median": None, "sightings": 0}
+            args = (row[0], int(since), int(until))
+            lo, n = conn.execute(
+                "SELECT MIN(price), SUM(hits) FROM offers"
+                " WHERE link = ? AND last_seen >= ? AND first_seen <= ?",
+                args,
+            ).fetchone()
+            median = conn.execute(
+                "SELECT price FROM ("
+                "  SELECT price, SUM(hits) OVER (ORDER BY price ROWS UNBOUNDED PRECEDING) AS cum"
+                "  FROM offers WHERE link = ? AND last_seen >= ? AND first_seen <= ?"
+                ") WHERE cum >= ? ORDER BY cum LIMIT 1",
+                (*args, (n or 0) / 2),
+            ).fetchone()
+        finally:
+            conn.close()
+        return {
+            "min": lo / 100 if lo is not None else None,
+            "median": median[0] / 100 if median else None,
+            "sightings": n or 0,
+        }
+
 
 def init_driver():
     opts = Options()
@@ -98,7 +638,13 @@ def init_driver():
     opts.add_argument(f"--lang=en-US,en;q=0.{random.randint(5,9)}")
     opts.add_argument("--disable-webgl")
     opts.add_argument("--disable-popup-blocking")
+    # background tabs keep loading and running timers at full speed
+    opts.add_argument("--disable-background-timer-throttling")
+    opts.add_argument("--disable-backgrounding-occluded-windows")
+    opts.add_argument("--disable-renderer-backgrounding")
     opts.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    # hand control back at DOMContentLoaded; the waits below decide the rest
+    opts.page_load_strategy = "eager"
 
     try:
         service = Service(CHROMEDRIVER)
@@ -180,6 +726,34 @@ def init_driver():
             "Page.addScriptToEvaluateOnNewDocument", {"source": stealth_script}
         )
 
+        # Count in-flight fetch/XHR requests for wait_network_idle()
+        _driver.execute_cdp_cmd(
+            "Page.addScriptToEvaluateOnNewDocument",
+            {
+                "source": """
+                    window.__awPending = 0;
+                    const _fetch = window.fetch;
+                    window.fetch = function () {
+                        window.__awPending++;
+                        return _fetch.apply(this, arguments).finally(() => {
+                            window.__awPending--;
+                        });
+                    };
+                    const _send = XMLHttpRequest.prototype.send;
+                    XMLHttpRequest.prototype.send = function () {
+                        window.__awPending++;
+                        this.addEventListener('loadend', () => {
+                            window.__awPending--;
+                        });
+                        return _send.apply(this, arguments);
+                    };
+                """
+            },
+        )
+        apply_resource_policy(_driver)
+        _driver.set_page_load_timeout(WAIT_PAGE_TIMEOUT)
+        _driver.set_script_timeout(_SCRIPT_TIMEOUT)
+
         # Disable automation flags
         _driver.execute_cdp_cmd(
             "Page.addScriptToEvaluateOnNewDocument",
@@ -199,483 +773,2890 @@ def init_driver():
         raise
 
 
+# ─── Resource policy ───────────────────────────────────
+# The watcher reads a handful of DOM nodes, so images, fonts, media and
+# ad/tracking hosts are blocked through CDP. Patterns that could catch a URL
+# matching one of ALLOW_URLS (the AOD ajax panel) are left out, since
+# Network.setBlockedURLs has no exceptions of its own. Per-check savings come from the performance log.
+_TYPE_PATTERNS = {
+    "image": ("jpg", "jpeg", "png", "gif", "webp", "avif", "svg", "ico"),
+    "font": ("woff", "woff2", "ttf", "otf", "eot"),
+    "media": ("mp4", "webm", "m3u8", "m4s", "mp3"),
+    "stylesheet": ("css",),
+}
+# typical transfer sizes, refined from what we actually see load
+_TYPE_BYTES = {"Image": 40_000, "Font": 60_000, "Media": 500_000, "Stylesheet": 30_000, "Script": 50_000}
+_CHECK_RESOURCES = {"requests": 0, "bytes": 0, "blocked": 0, "bytes_saved": 0}
+
+
+def _patterns_overlap(blocked: str, allowed: str) -> bool:
+    """
+    Whether some URL matches both patterns. A "*" in `blocked` is any run of
+    characters; in `allowed` it stands for path or query words without a
+    ".", so "…/ajax/*" isn't taken to end in ".jpg" or lead to another host.
+    """
+    a, b = blocked, allowed
+    todo, seen = [(0, 0)], set()
+    while todo:
+        i, j = todo.pop()
+        if (i, j) in seen:
+            continue
+        seen.add((i, j))
+        if i == len(a) and j == len(b):
+            return True
+        if i < len(a) and a[i] == "*":
+            todo.append((i + 1, j))  # the star ends here
+            if j < len(b):
+                todo.append((i, j + 1))  # or takes b's next character
+        if j < len(b) and b[j] == "*":
+            todo.append((i, j + 1))
+            if i < len(a) and a[i] != ".":
+                todo.append((i + 1, j))
+        if i < len(a) and j < len(b) and a[i] == b[j] != "*":
+            todo.append((i + 1, j + 1))
+    return False
+
+
+def blocked_url_patterns() -> list:
+    patterns = []
+    for rtype in BLOCK_RESOURCE_TYPES:
+        for ext in _TYPE_PATTERNS.get(rtype, ()):
+            patterns += [f"*.{ext}", f"*.{ext}?*"]
+    for host in BLOCK_HOSTS:
+        patterns.append(f"*://{host}/*")
+        patterns.append(f"*.{host}/*")
+    return [
+        p for p in patterns if not any(_patterns_overlap(p, allowed) for allowed in ALLOW_URLS)
+    ]
+
+
+def apply_resource_policy(drv):
+    drv.execute_cdp_cmd("Network.enable", {})
+    if BLOCK_RESOURCES:
+        drv.execute_cdp_cmd("Network.setBlockedURLs", {"urls": blocked_url_patterns()})
+
+
+def collect_resource_stats(drv) -> dict:
+    """
+    Drain the browser's performance log (it grows until read) and add up
+    requests and bytes loaded vs blocked since the last call.
+    """
+    types, seen = {}, {"requests": 0, "bytes": 0, "blocked": 0, "bytes_saved": 0}
+    try:
+        entries = drv.get_log("performance")
+    except Exception:
+        return seen
+    for entry in entries:
+        try:
+            msg = json.loads(entry["message"])["message"]
+        except (KeyError, ValueError):
+            continue
+        method, params = msg.get("method"), msg.get("params", {})
+        if method == "Network.requestWillBeSent":
+            types[params.get("requestId")] = params.get("type", "Other")
+        elif method == "Network.loadingFinished":
+            size = int(params.get("encodedDataLength", 0))
+            rtype = types.get(params.get("requestId"), "Other")
+            seen["requests"] += 1
+            seen["bytes"] += size
+            if rtype in _TYPE_BYTES and size:
+                _TYPE_BYTES[rtype] = int(0.9 * _TYPE_BYTES[rtype] + 0.1 * size)
+        elif method == "Network.loadingFailed" and params.get("blockedReason"):
+            rtype = params.get("type") or types.get(params.get("requestId"), "Other")
+            seen["blocked"] += 1
+            seen["bytes_saved"] += _TYPE_BYTES.get(rtype, 0)
+    for key, value in seen.items():
+        _CHECK_RESOURCES[key] += value
+    return seen
+
+
+def reset_resource_stats():
+    for key in _CHECK_RESOURCES:
+        _CHECK_RESOURCES[key] = 0
+
+
+# ─── Driver pool ────────────────────────────────────────
+# Each worker process keeps its own warm browsers; a driver is handed out per
+# check and recycled once it is too old, too used or too big.
+# idle entries: {"driver", "created", "uses", "located"}; "located" is the
+# saved_at of the location state the browser carries, or False
+_DRIVER_POOL = []
+_IN_USE = []  # entries currently handed out
+_POOL_STATS = {"hits": 0, "misses": 0, "recycles": 0}
+_POOL_FINALIZER = None
+
+
+def _proc_table():
+    """({ppid: [child pids]}, {pid: rss pages}) for every process, via /proc."""
+    children = {}
+    rss_pages = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command name may contain spaces, so split after its closing paren
+        fields = stat[stat.rfind(")") + 2 :].split()
+        children.setdefault(int(fields[1]), []).append(int(name))
+        rss_pages[int(name)] = int(fields[21])
+    return children, rss_pages
+
+
+def process_tree(pid: int, children=None) -> list:
+    """pid followed by all of its descendants."""
+    if children is None:
+        children, _ = _proc_table()
+    tree, stack = [], [pid]
+    while stack:
+        p = stack.pop()
+        tree.append(p)
+        stack.extend(children.get(p, []))
+    return tree
+
+
+def _process_tree_rss(pid: int) -> int:
+    """Resident memory (bytes) of pid and all its descendants."""
+    children, rss_pages = _proc_table()
+    pages = sum(rss_pages.get(p, 0) for p in process_tree(pid, children))
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def kill_process_tree(pid: int) -> int:
+    """SIGKILL pid and every descendant at once; returns how many were hit."""
+    killed = 0
+    for p in process_tree(pid):
+        try:
+            os.kill(p, signal.SIGKILL)
+            killed += 1
+        except OSError:
+            pass
+    return killed
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def _driver_rss(drv) -> int:
+    try:
+        return _process_tree_rss(drv.service.process.pid)
+    except Exception:
+        return 0
+
+
+def _quit_driver(drv):
+    try:
+        drv.quit()
+    except:
+        pass
+
+
+def _reset_driver(drv):
+    """
+    Bring a used browser back to a neutral state. Cookies are kept on purpose:
+    they carry the delivery location we already paid for.
+    """
+    handles = drv.window_handles
+    for handle in handles[1:]:
+        drv.switch_to.window(handle)
+        drv.close()
+    drv.switch_to.window(handles[0])
+    drv.execute_cdp_cmd(
+        "Storage.clearDataForOrigin",
+        {
+            "origin": AMAZON_BASE,
+            "storageTypes": "local_storage,indexeddb,cache_storage,service_workers",
+        },
+    )
+    drv.get("about:blank")
+
+
+def _needs_recycle(entry) -> str:
+    if _RECYCLE is not None:
+        try:
+            reason = _RECYCLE.pop(entry["driver"].service.process.pid, None)
+        except Exception:
+            reason = None
+        if reason:
+            return reason
+    if entry["uses"] >= DRIVER_MAX_USES:
+        return f"{entry['uses']} checks"
+    age = time.time() - entry["created"]
+    if age >= DRIVER_MAX_AGE:
+        return f"age {age:.0f}s"
+    rss_mb = _driver_rss(entry["driver"]) / (1024 * 1024)
+    if rss_mb >= DRIVER_MAX_RSS_MB:
+        return f"RSS {rss_mb:.0f}MB"
+    return ""
+
+
+def shutdown_driver_pool():
+    while _DRIVER_POOL:
+        _quit_driver(_DRIVER_POOL.pop()["driver"])
+
+
+def acquire_driver():
+    """
+    Hand out a warm browser from this process' pool, or start a new one.
+    Returns the pool entry; a truthy entry["located"] means the delivery
+    location has already been set in it.
+    """
+    global _POOL_FINALIZER
+    if _POOL_FINALIZER is None:
+        # pool workers skip atexit, but multiprocessing runs its finalizers
+        _POOL_FINALIZER = Finalize(None, shutdown_driver_pool, exitpriority=10)
+
+    while _DRIVER_POOL:
+        entry = _DRIVER_POOL.pop()
+        try:
+            entry["driver"].current_window_handle  # still alive?
+        except Exception:
+            _quit_driver(entry["driver"])
+            _POOL_STATS["recycles"] += 1
+            continue
+        _POOL_STATS["hits"] += 1
+        break
+    else:
+        _POOL_STATS["misses"] += 1
+        with span("driver.start"):
+            drv = init_driver()
+        entry = {"driver": drv, "created": time.time(), "uses": 0, "located": False}
+
+    _IN_USE.append(entry)
+    publish_registry()
+    return entry
+
+
+def release_driver(entry, healthy: bool = True):
+    """Return a browser to the pool, or quit it if it is broken or worn out."""
+    if entry in _IN_USE:
+        _IN_USE.remove(entry)
+    entry["uses"] += 1
+    reason = "unhealthy" if not healthy else _needs_recycle(entry)
+    if not reason:
+        try:
+            _reset_driver(entry["driver"])
+        except Exception as e:
+            reason = f"reset failed: {e}"
+
+    if reason or len(_DRIVER_POOL) >= DRIVER_POOL_SIZE:
+        _quit_driver(entry["driver"])
+        if reason:
+            _POOL_STATS["recycles"] += 1
+            log(f"→ Recycled browser ({reason})")
+    else:
+        _DRIVER_POOL.append(entry)
+
+    publish_registry()
+    log(
+        f"→ Driver pool: hits={_POOL_STATS['hits']} misses={_POOL_STATS['misses']} "
+        f"recycles={_POOL_STATS['recycles']} idle={len(_DRIVER_POOL)}"
+    )
+
+
+# ─── Worker control ────────────────────────────────────
+# Every check carries the link's generation. The parent bumps it when a link
+# is edited or removed, and the check gives up at its next checkpoint. Each
+# worker also publishes what it is doing and which browsers it owns, so the
+# parent can count them per link and kill them if a check will not stop.
+_GENERATIONS = None
+_REGISTRY = None
+_RECYCLE = None  # browser pid -> reason the parent wants it recycled
+_JOB = {"links": {}, "started": None}  # doc_id -> generation being checked here
+
+
+class CheckCancelled(Exception):
+    pass
+
+
+def _browser_pids(entries=None) -> list:
+    pids = []
+    for entry in _IN_USE + _DRIVER_POOL if entries is None else entries:
+        try:
+            pids.append(entry["driver"].service.process.pid)
+        except Exception:
+            pass
+    return pids
+
+
+def publish_registry():
+    if _REGISTRY is None:
+        return
+    try:
+        _REGISTRY[os.getpid()] = {
+            **_JOB,
+            "browsers": _browser_pids(),
+            "idle": _browser_pids(_DRIVER_POOL),
+        }
+    except Exception:
+        pass
+
+
+def begin_job(links: dict):
+    _JOB.update(links=dict(links), started=time.time())
+    publish_registry()
+
+
+def end_job():
+    _JOB.update(links={}, started=None)
+    publish_registry()
+
+
+def checkpoint(doc_id: str):
+    """Raise CheckCancelled if the link was edited or removed since the check began."""
+    if _GENERATIONS is None or doc_id not in _JOB["links"]:
+        return
+    if _GENERATIONS.get(doc_id) != _JOB["links"][doc_id]:
+        raise CheckCancelled(f"{doc_id} changed while being checked")
+
+
+def registry_report(registry) -> dict:
+    """{doc_id or "idle": {"workers": n, "browsers": n}} over live workers."""
+    report = {}
+    for pid, job in list(registry.items()):
+        if not pid_alive(pid):
+            continue
+        browsers = sum(1 for b in job["browsers"] if pid_alive(b))
+        for doc_id in job["links"] or ["idle"]:
+            row = report.setdefault(doc_id, {"workers": 0, "browsers": 0})
+            row["workers"] += 1
+            row["browsers"] += browsers
+    return report
+
+
+# ─── Tracing ───────────────────────────────────────────
+# Spans around the stages of a check. A worker keeps the spans of the job it
+# is running and returns them with the results; the parent's TraceExporter
+# writes them out as OTLP JSON. With TRACE_EXPORT unset no trace is started
+# and span() hands out one shared no-op object.
+_TRACE = {"trace_id": None, "spans": [], "stack": []}
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start", "end", "attrs", "error")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = None
+        self.attrs = attrs
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def __enter__(self):
+        stack = _TRACE["stack"]
+        self.parent_id = stack[-1].span_id if stack else None
+        self.start = time.time_ns()
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.time_ns()
+        stack = _TRACE["stack"]
+        if stack and stack[-1] is self:
+            stack.pop()
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        _TRACE["spans"].append({
+            "trace_id": _TRACE["trace_id"],
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "end": self.end,
+            "attrs": self.attrs,
+            "error": self.error,
+        })
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name: str, **attrs):
+    """A span to use as a context manager; a no-op when no trace is running."""
+    if _TRACE["trace_id"] is None:
+        return _NO_SPAN
+    return Span(name, attrs)
+
+
+def begin_trace():
+    if TRACE_EXPORT:
+        _TRACE.update(trace_id=os.urandom(16).hex(), spans=[], stack=[])
+
+
+def end_trace() -> list:
+    """The finished trace's spans (plain dicts), or [] when tracing is off."""
+    spans = _TRACE["spans"]
+    _TRACE.update(trace_id=None, spans=[], stack=[])
+    return spans
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_payload(spans: list) -> dict:
+    """Spans from end_trace() as an OTLP/JSON ExportTraceServiceRequest."""
+    out = []
+    for s in spans:
+        record = {
+            "traceId": s["trace_id"],
+            "spanId": s["span_id"],
+            "name": s["name"],
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(s["start"]),
+            "endTimeUnixNano": str(s["end"]),
+            "attributes": [
+                {"key": k, "value": _otlp_value(v)} for k, v in s["attrs"].items() if v is not None
+            ],
+            "status": {"code": 2, "message": s["error"]} if s["error"] else {"code": 1},
+        }
+        if s["parent_id"]:
+            record["parentSpanId"] = s["parent_id"]
+        out.append(record)
+    return {
+        "resourceSpans": [{
+            "resource": {
+                "attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE}}]
+            },
+            "scopeSpans": [{"scope": {"name": "amazon_watcher"}, "spans": out}],
+        }]
+    }
+
+
+class TraceExporter(Thread):
+    """
+    Ships the traces returned by checks: one OTLP/JSON request per line
+    appended to a file, or POSTed to an OTLP/HTTP collector when
+    TRACE_EXPORT is a URL (e.g. http://collector:4318/v1/traces).
+    """
+
+    def __init__(self, target: str, maxsize: int = 1000):
+        super().__init__(name="trace-exporter", daemon=True)
+        self.target = target
+        self.queue = Queue(maxsize=maxsize)
+        self.stats = {"exported": 0, "dropped": 0, "failed": 0}
+
+    def submit(self, spans: list):
+        try:
+            self.queue.put_nowait(spans)
+        except Full:
+            self.stats["dropped"] += len(spans)
+
+    def _export(self, spans: list):
+        payload = otlp_payload(spans)
+        try:
+            if self.target.startswith(("http://", "https://")):
+                requests.post(self.target, json=payload, timeout=5).raise_for_status()
+            else:
+                with open(self.target, "a") as f:
+                    f.write(json.dumps(payload) + "\n")
+            self.stats["exported"] += len(spans)
+        except Exception as e:
+            self.stats["failed"] += len(spans)
+            log(f"Trace export failed: {e}")
+
+    def run(self):
+        while True:
+            spans = self.queue.get()
+            if spans is None:
+                return
+            try:
+                while True:  # everything already waiting goes in one request
+                    more = self.queue.get_nowait()
+                    if more is None:
+                        self._export(spans)
+                        return
+                    spans = spans + more
+            except Empty:
+                pass
+            self._export(spans)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join(timeout=10)
+
+
+# ─── Request budget ────────────────────────────────────
+# One token bucket for every process: REQUESTS_PER_MINUTE page loads of the
+# store (static fetches and Chrome navigations), bursts of up to
+# REQUEST_BURST. It lives in shared memory the parent creates, so workers
+# coordinate without a round trip to the parent. A throttling answer (429,
+# 503 or the "automated access" robot check) to Chrome pauses all of them:
+# the pause starts at THROTTLE_BACKOFF, doubles while throttling continues up
+# to THROTTLE_BACKOFF_MAX, and halves again with each clean page. The same
+# answer to a static fetch only turns the static tier off for STATIC_COOLDOWN;
+# Chrome may well still get through.
+_BUDGET = None  # mp.Array("d", [tokens, refilled_at, paused_until, backoff, static_off_until])
+_STATIC_OFF_UNTIL = 0.0  # without a shared budget
+_FETCHES = {"ok": 0, "throttled": 0}  # this job's page loads
+_ROBOT_MARKERS = ("validateCaptcha", "api-services-support@amazon.com")
+_THROTTLED_STATUSES = (429, 503)
+
+_THROTTLED_JS = r"""
+const nav = performance.getEntriesByType('navigation')[0];
+if (nav && [429, 503].includes(nav.responseStatus)) { return 'HTTP ' + nav.responseStatus; }
+if (document.querySelector('form[action*="validateCaptcha"]')) { return 'robot check'; }
+const body = document.body ? document.body.innerHTML : '';
+return body.includes('api-services-support@amazon.com') ? 'robot check' : '';
+"""
+
+
+class Throttled(Exception):
+    """The store is throttling us, or we are backing off because it did."""
+
+
+def new_budget(ctx):
+    """The shared bucket, created full by the parent and passed in `shared`."""
+    return ctx.Array("d", [REQUEST_BURST, time.time(), 0.0, 0.0, 0.0])
+
+
+def backoff_remaining() -> float:
+    """Seconds until the global backoff ends; 0 when none is in force."""
+    if _BUDGET is None:
+        return 0.0
+    return max(0.0, _BUDGET[2] - time.time())
+
+
+def take_request():
+    """
+    Take a token for one page load, waiting for the bucket to refill if need
+    be. Raises Throttled while a backoff is in force instead of sleeping it
+    out, so checks end and the scheduler holds new ones.
+    """
+    if _BUDGET is None:
+        return
+    while True:
+        with _BUDGET.get_lock():
+            now = time.time()
+            if now < _BUDGET[2]:
+                raise Throttled(f"backing off for another {_BUDGET[2] - now:.0f}s")
+            if REQUESTS_PER_MINUTE <= 0:
+                return
+            tokens = min(REQUEST_BURST, _BUDGET[0] + (now - _BUDGET[1]) * REQUESTS_PER_MINUTE / 60)
+            _BUDGET[1] = now
+            if tokens >= 1:
+                _BUDGET[0] = tokens - 1
+                return
+            _BUDGET[0] = tokens
+            delay = (1 - tokens) * 60 / REQUESTS_PER_MINUTE
+        with waiting():
+            time.sleep(delay)
+
+
+def note_fetched():
+    _FETCHES["ok"] += 1
+    if _BUDGET is None or not _BUDGET[3]:
+        return
+    with _BUDGET.get_lock():
+        if time.time() >= _BUDGET[2]:
+            _BUDGET[3] = _BUDGET[3] / 2 if _BUDGET[3] > THROTTLE_BACKOFF else 0.0
+
+
+def note_throttled(reason: str):
+    """Start (or extend) the global backoff; raises Throttled for the caller's check."""
+    _FETCHES["throttled"] += 1
+    if _BUDGET is not None:
+        with _BUDGET.get_lock():
+            now = time.time()
+            # answers already in flight when the backoff began don't double it
+            if now >= _BUDGET[2]:
+                backoff = min(THROTTLE_BACKOFF_MAX, max(THROTTLE_BACKOFF, _BUDGET[3] * 2))
+                _BUDGET[3], _BUDGET[2], _BUDGET[0] = backoff, now + backoff, 0.0
+                log(f"→ Throttled ({reason}); all workers back off for {backoff:.0f}s")
+    raise Throttled(reason)
+
+
+def static_off() -> bool:
+    """Whether a throttled static fetch has turned the static tier off for now."""
+    until = _BUDGET[4] if _BUDGET is not None else _STATIC_OFF_UNTIL
+    return time.time() < until
+
+
+def note_static_throttled(reason: str):
+    """Turn the static tier off for STATIC_COOLDOWN; checks go straight to Chrome meanwhile."""
+    global _STATIC_OFF_UNTIL
+    _FETCHES["throttled"] += 1
+    until = time.time() + STATIC_COOLDOWN
+    if _BUDGET is not None:
+        with _BUDGET.get_lock():
+            if _BUDGET[4] >= time.time():
+                return
+            _BUDGET[4] = until
+    else:
+        _STATIC_OFF_UNTIL = until
+    log(f"→ Static fetch throttled ({reason}); static tier off for {STATIC_COOLDOWN:.0f}s")
+
+
+def check_throttled(drv):
+    """After a Chrome page load: raise Throttled on a throttling answer, else count it."""
+    reason = drv.execute_script(_THROTTLED_JS)
+    if reason:
+        note_throttled(reason)
+    note_fetched()
+
+
+# ─── Waiting ───────────────────────────────────────────
+# Every step waits for a condition (DOM ready, network idle, an element)
+# with an upper bound instead of sleeping a fixed amount. The time spent in
+# those waits is booked on a per-check clock so we can see waiting vs working.
+_CHECK_CLOCK = {"start": 0.0, "wait": 0.0}
+_SCRIPT_TIMEOUT = max(WAIT_IDLE_TIMEOUT, WAIT_SCROLL_TIMEOUT) + 5
+
+# Resolves once no request has been in flight (or started) for quietMs, or
+# after maxMs. Relies on the fetch/XHR counter installed by init_driver().
+_NETWORK_IDLE_JS = r"""
+const quietMs = arguments[0], maxMs = arguments[1];
+const done = arguments[arguments.length - 1];
+const start = performance.now();
+let last = start;
+let seen = performance.getEntriesByType('resource').length;
+const timer = setInterval(() => {
+    const now = performance.now();
+    const n = performance.getEntriesByType('resource').length;
+    if (n !== seen || (window.__awPending || 0) > 0 || document.readyState === 'loading') {
+        seen = n;
+        last = now;
+    }
+    if (now - last >= quietMs || now - start >= maxMs) {
+        clearInterval(timer);
+        done(now - last >= quietMs);
+    }
+}, 50);
+"""
+
+
+def start_check_clock():
+    _CHECK_CLOCK["start"] = time.monotonic()
+    _CHECK_CLOCK["wait"] = 0.0
+
+
+def check_clock_report() -> dict:
+    total = time.monotonic() - _CHECK_CLOCK["start"]
+    waited = min(_CHECK_CLOCK["wait"], total)
+    return {"total": total, "waiting": waited, "working": total - waited}
+
+
+@contextmanager
+def waiting():
+    """Book the enclosed time as waiting."""
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        _CHECK_CLOCK["wait"] += time.monotonic() - t0
+
+
+@contextmanager
+def timed(tab: dict, stage: str, **attrs):
+    """Add the enclosed time to tab["stages"][stage] (seconds), inside a span."""
+    t0 = time.monotonic()
+    try:
+        with span(stage, link_id=tab["doc_id"], **attrs) as sp:
+            yield sp
+    finally:
+        stages = tab.setdefault("stages", {})
+        stages[stage] = stages.get(stage, 0.0) + time.monotonic() - t0
+
+
+class TimedWait(WebDriverWait):
+    """WebDriverWait that polls quickly and books its time as waiting."""
+
+    def __init__(self, drv, timeout=None, poll_frequency=0.1, ignored_exceptions=None):
+        super().__init__(
+            drv,
+            WAIT_ELEMENT_TIMEOUT if timeout is None else timeout,
+            poll_frequency,
+            ignored_exceptions,
+        )
+
+    def until(self, method, message=""):
+        with waiting():
+            return super().until(method, message)
+
+
+def wait_dom_ready(drv, timeout=None):
+    TimedWait(drv, WAIT_PAGE_TIMEOUT if timeout is None else timeout).until(
+        lambda d: d.execute_script("return document.readyState") != "loading"
+    )
+
+
+def wait_network_idle(drv, quiet=None, timeout=None) -> bool:
+    """True once the page went quiet, False if the upper bound was hit first."""
+    quiet = WAIT_IDLE_QUIET if quiet is None else quiet
+    timeout = WAIT_IDLE_TIMEOUT if timeout is None else timeout
+    timeout = min(timeout, _SCRIPT_TIMEOUT - 1)
+    with waiting():
+        try:
+            return bool(
+                drv.execute_async_script(_NETWORK_IDLE_JS, int(quiet * 1000), int(timeout * 1000))
+            )
+        except TimeoutException:
+            return False
+
+
+def start_navigation(drv, url: str):
+    """Send the current tab to url without waiting for it (see await_page)."""
+    take_request()
+    drv.execute_script("window.__awLeaving = true; window.location.assign(arguments[0]);", url)
+
+
+def await_page(drv):
+    """Wait for a navigation begun by start_navigation() to reach DOM ready and settle."""
+    TimedWait(drv, WAIT_PAGE_TIMEOUT, ignored_exceptions=[JavascriptException]).until(
+        lambda d: d.execute_script(
+            "return !window.__awLeaving && document.readyState !== 'loading'"
+        )
+    )
+    wait_network_idle(drv)
+
+
+def load_page(drv, url: str):
+    """Navigate (returns at DOMContentLoaded under the eager strategy) and let the page settle."""
+    take_request()
+    with waiting():
+        drv.get(url)
+    wait_dom_ready(drv)
+    wait_network_idle(drv)
+
+
+# ─── Offers ────────────────────────────────────────────
+# Every offer we look at (core PDP, pinned AOD offer, AOD list entry, static
+# HTML) is reduced to the same record so one filter decides them all:
+#   {"source": "core"|"pinned"|"list", "price": float|None,
+#    "ships_from": str, "sold_by": str}
+
+
+def _parse_price(raw: str, whole: str = "", fraction: str = ""):
+    """
+    Price from "€1,299.00" or "1.299,00 €" alike: the last separator is the
+    decimal one, unless three digits follow it, as in "1.299".
+    """
+    raw = re.sub(r"[^\d.,]", "", raw or "")
+    if not raw and whole:
+        raw = re.sub(r"\D", "", whole) + "." + (re.sub(r"\D", "", fraction or "") or "00")
+    cut = max(raw.rfind("."), raw.rfind(","))
+    if cut >= 0 and len(raw) - cut - 1 != 3:
+        raw = raw[:cut].replace(".", "").replace(",", "") + "." + raw[cut + 1:]
+    else:
+        raw = raw.replace(".", "").replace(",", "")
+    try:
+        return float(raw)
+    except ValueError:
+        return None
+
+
+def make_offer(source: str, price, ships_from: str = "", sold_by: str = "") -> dict:
+    return {
+        "source": source,
+        "price": price,
+        "ships_from": (ships_from or "").strip(),
+        "sold_by": (sold_by or "").strip(),
+    }
+
+
+def offer_matches(item: dict, offer: dict) -> bool:
+    """The link's criteria: price ≤ target, optionally shipped / sold by Amazon."""
+    if offer["price"] is None or offer["price"] > item["target_price"]:
+        return False
+    if item.get("check_shipped") and "amazon" not in offer["ships_from"].lower():
+        return False
+    if item.get("check_sold") and "amazon" not in offer["sold_by"].lower():
+        return False
+    return True
+
+
+def match_message(item: dict, offer: dict) -> str:
+    return (
+        f"✅ {item['name']} is back in stock!\n"
+        f"✅ AMAZON OFFER FOUND!\n{item['url']}\n"
+        f"💰 €{offer['price']:.2f} (≤ €{item['target_price']:.2f})\n"
+        f"🚚 Ships from: {offer['ships_from']}\n"
+        f"🏷️ Sold by: {offer['sold_by']}"
+    )
+
+
+# One execute_script round trip instead of several find_element calls per
+# offer. arguments[0] lists the parts to read: "core", "pinned", "list", and
+# "scroll" to scroll the offer list on for its next page once read;
+# arguments[1] skips that many list offers already read.
+_SNAPSHOT_JS = r"""
+const parts = arguments[0];
+const start = arguments[1] || 0;
+const txt = (root, sel) => {
+    const el = root && root.querySelector(sel);
+    return el ? el.textContent.replace(/\s+/g, ' ').trim() : '';
+};
+const out = {core: null, pinned: null, list: [], loaded: 0, total: null};
+
+if (parts.includes('core')) {
+    const price = document.getElementById('corePrice_feature_div');
+    const feat = document.getElementById('offer-display-features');
+    if (price) {
+        out.core = {
+            offscreen: txt(price, '.a-offscreen'),
+            ships: txt(feat, '#fulfillerInfoFeature_feature_div .offer-display-feature-text-message'),
+            sold: txt(feat, '#merchantInfoFeature_feature_div .offer-display-feature-text-message'),
+        };
+    }
+}
+
+if (parts.includes('pinned')) {
+    const pinned = document.getElementById('aod-pinned-offer');
+    if (pinned) {
+        const more = pinned.querySelector('#aod-pinned-offer-show-more-link');
+        if (more) { more.click(); }
+        const price = pinned.querySelector('#aod-price-0');
+        out.pinned = {
+            offscreen: txt(price, 'span.aok-offscreen'),
+            whole: txt(price, 'span.a-price-whole'),
+            fraction: txt(price, 'span.a-price-fraction'),
+            ships: txt(pinned, '#aod-offer-shipsFrom .a-fixed-left-grid .a-fixed-left-grid-inner .a-fixed-left-grid-col.a-col-right .a-size-small.a-color-base'),
+            sold: txt(pinned, '#aod-offer-soldBy .a-fixed-left-grid .a-fixed-left-grid-inner .a-fixed-left-grid-col.a-col-right a.a-size-small.a-link-normal'),
+        };
+    }
+}
+
+if (parts.includes('list')) {
+    const list = document.getElementById('aod-offer-list');
+    if (list) {
+        const offers = list.querySelectorAll('[id="aod-offer"]');
+        out.loaded = offers.length;
+        for (const offer of Array.from(offers).slice(start)) {
+            out.list.push({
+                offscreen: '',
+                whole: txt(offer, '.a-price-whole'),
+                fraction: txt(offer, '.a-price-fraction'),
+                ships: txt(offer, '[id="aod-offer-shipsFrom"] span.a-color-base'),
+                sold: txt(offer, '[id="aod-offer-soldBy"] a.a-link-normal, [id="aod-offer-soldBy"] span.a-color-base'),
+            });
+        }
+    }
+    const total = document.getElementById('aod-total-offer-count');
+    if (total && /^\d+$/.test(total.value)) { out.total = parseInt(total.value, 10); }
+}
+
+if (parts.includes('scroll')) {
+    const scroller = document.getElementById('all-offers-display-scroller');
+    if (scroller) { scroller.scrollTo(0, scroller.scrollHeight); }
+}
+return out;
+"""
+
+
+def _raw_to_offer(source: str, raw: dict) -> dict:
+    price = _parse_price(raw.get("offscreen", ""), raw.get("whole", ""), raw.get("fraction", ""))
+    return make_offer(source, price, raw.get("ships", ""), raw.get("sold", ""))
+
+
+def snapshot_offers(drv, parts=("core", "pinned", "list"), start: int = 0) -> dict:
+    """
+    Read the requested offers from the current page in one round trip.
+    Returns {"core": offer|None, "pinned": offer|None, "list": [offer, …],
+    "loaded": list offers on the page, "total": offer count the panel
+    announces, or None}; "list" starts at offer `start`.
+    """
+    raw = drv.execute_script(_SNAPSHOT_JS, list(parts), start) or {}
+    return {
+        "core": _raw_to_offer("core", raw["core"]) if raw.get("core") else None,
+        "pinned": _raw_to_offer("pinned", raw["pinned"]) if raw.get("pinned") else None,
+        "list": [_raw_to_offer("list", o) for o in raw.get("list") or []],
+        "loaded": raw.get("loaded") or 0,
+        "total": raw.get("total"),
+    }
+
+
+# Cheap signature of what a no-match depended on: total offer count, pinned
+# offer and the first page of the list (price, ships from and sold by of each
+# offer), which Amazon sorts by price. The PDP alone can't vouch for that, as
+# it only shows the offer count and the lowest price. Text, not HTML, so
+# per-request ids and tokens don't count as changes.
+_FINGERPRINT_JS = r"""
+const txt = (sel) => Array.from(document.querySelectorAll(sel))
+    .map(el => el.textContent.replace(/\s+/g, ' ').trim()).join('|');
+const total = document.getElementById('aod-total-offer-count');
+return [
+    total ? total.value : '',
+    document.querySelectorAll('#aod-offer-list [id="aod-offer"]').length,
+    txt('#aod-pinned-offer'),
+    txt('#aod-offer-list'),
+].join('#');
+"""
+
+
+def page_fingerprint(drv) -> str:
+    """Fingerprint of the open AOD panel."""
+    raw = drv.execute_script(_FINGERPRINT_JS) or ""
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def describe_offer(offer: dict) -> str:
+    return (
+        f"€{offer['price']:.2f}, Ships from “{offer['ships_from']}”, "
+        f"Sold by “{offer['sold_by']}”"
+    )
+
+
+# ─── Static HTTP tier ──────────────────────────────────
+# A plain GET of the PDP answers most checks (out of stock, core offer) in
+# milliseconds; Chrome is only needed when the page is inconclusive or the
+# offer list has to be expanded.
+_HTTP_SESSION = None
+
+
+def http_session():
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        s = requests.Session()
+        s.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        s.headers.update(
+            {
+                "User-Agent": (
+                    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+                    "(KHTML, like Gecko) Chrome/115.0.5790.170 Safari/537.36"
+                ),
+                "Accept-Language": "en-US,en;q=0.9",
+                "Accept": "text/html,application/xhtml+xml",
+            }
+        )
+        _HTTP_SESSION = s
+    return _HTTP_SESSION
+
+
+def _xpath_text(node, path):
+    found = node.xpath(path)
+    return found[0].text_content().strip() if found else ""
+
+
+def _class_xpath(cls):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {cls} ')"
+
+
+def parse_static_pdp(page: str) -> dict:
+    """Pull the fields the Selenium path reads from a PDP's static HTML."""
+    doc = lxml_html.fromstring(page)
+    info = {
+        "title": _xpath_text(doc, "//*[@id='productTitle']"),
+        "location": _xpath_text(doc, "//*[@id='glow-ingress-line2']"),
+        "out_of_stock": bool(doc.xpath("//*[@id='outOfStock']")),
+        "has_offers_link": bool(
+            doc.xpath("//*[@id='buybox-see-all-buying-choices' or @id='aod-ingress-link']")
+        ),
+    }
+    raw = _xpath_text(
+        doc, f"//*[@id='corePrice_feature_div']//*[{_class_xpath('a-offscreen')}]"
+    )
+    ships = _xpath_text(
+        doc,
+        "//*[@id='offer-display-features']//*[@id='fulfillerInfoFeature_feature_div']"
+        f"//*[{_class_xpath('offer-display-feature-text-message')}]",
+    )
+    sold = _xpath_text(
+        doc,
+        "//*[@id='offer-display-features']//*[@id='merchantInfoFeature_feature_div']"
+        f"//*[{_class_xpath('offer-display-feature-text-message')}]",
+    )
+    info["core"] = make_offer("core", _parse_price(raw), ships, sold)
+    return info
+
+
+def static_check(url: str):
+    """
+    Read a product page from static HTML alone. Returns None when Chrome is
+    needed, otherwise a dict with "status" out_of_stock, or in_stock plus the
+    core "offer" record and whether the page links to "more_offers". A
+    throttling answer turns the static tier off for a while and escalates;
+    only Chrome's answers start the global backoff. Raises Throttled while
+    that backoff is in force.
+    """
+    if not HTTP_TIER or static_off():
+        return None
+    sync_http_cookies()
+    take_request()
+    try:
+        with waiting():
+            resp = http_session().get(url, timeout=HTTP_TIMEOUT)
+    except requests.RequestException as e:
+        log(f"→ Static fetch failed: {e}")
+        return None
+    if resp.status_code in _THROTTLED_STATUSES:
+        note_static_throttled(f"HTTP {resp.status_code}")
+        return None
+    if any(marker in resp.text for marker in _ROBOT_MARKERS):
+        note_static_throttled("robot check")
+        return None
+    note_fetched()
+    if resp.status_code != 200:
+        log(f"→ Static fetch returned HTTP {resp.status_code}; escalating")
+        return None
+
+    info = parse_static_pdp(resp.text)
+    if not info["title"]:
+        log("→ Static page has no product (captcha?); escalating")
+        return None
+    if DELIVERY_POSTCODE not in info["location"]:
+        log(
+            f"→ Static page delivers to '{info['location']}', "
+            f"not {DELIVERY_POSTCODE}; escalating"
+        )
+        return None
+
+    if info["out_of_stock"]:
+        return {"status": "out_of_stock"}
+    core = info["core"]
+    if core["price"] is None:
+        log("→ Static page has no core price; escalating")
+        return None
+
+    log(f"→ Static core {describe_offer(core)}")
+    return {"status": "in_stock", "offer": core, "more_offers": info["has_offers_link"]}
+
+
 # ─── Telegram ───────────────────────────────────────────
+# Workers only enqueue alerts; the parent's TelegramNotifier thread sends
+# them over one keep-alive session, grouping alerts for the same chat that
+# arrive within NOTIFY_BATCH_WINDOW and honouring 429 retry_after.
+_NOTIFY_QUEUE = None
+TELEGRAM_MAX_LEN = 4096
+
+
 def send_telegram(token: str, chat_id: str, text: str):
-    payload = {"chat_id": chat_id, "text": text, "disable_web_page_preview": True}
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
+    if _NOTIFY_QUEUE is None:
+        _post_telegram(requests, token, chat_id, text)
+        return
     try:
-        resp = requests.post(url, data=payload, timeout=10)
-        resp.raise_for_status()
-        log(f"Telegram sent: {text}")
-    except Exception as e:
-        log(f"Telegram error: {e}")
+        _NOTIFY_QUEUE.put_nowait((token, chat_id, text))
+    except Full:
+        log(f"Telegram queue full; dropping alert: {text}")
+
+
+def _post_telegram(session, token: str, chat_id: str, text: str) -> bool:
+    """Send one message, retrying on 429 and transient errors. True when sent."""
+    payload = {"chat_id": chat_id, "text": text, "disable_web_page_preview": True}
+    url = f"{TELEGRAM_API}/bot{token}/sendMessage"
+    delay = 1.0
+    for attempt in range(1, NOTIFY_MAX_RETRIES + 1):
+        t0 = time.monotonic()
+        try:
+            resp = session.post(url, data=payload, timeout=10)
+            TELEGRAM_SECONDS.labels(str(resp.status_code)).observe(time.monotonic() - t0)
+            if resp.status_code == 429:
+                try:
+                    retry_after = resp.json()["parameters"]["retry_after"]
+                except Exception:
+                    retry_after = resp.headers.get("Retry-After", delay)
+                log(f"Telegram rate limited; retrying in {retry_after}s")
+                time.sleep(float(retry_after))
+                continue
+            if resp.status_code < 500:
+                resp.raise_for_status()
+                log(f"Telegram sent: {text}")
+                return True
+            log(f"Telegram error: HTTP {resp.status_code} (attempt {attempt})")
+        except requests.HTTPError as e:
+            log(f"Telegram error: {e}")
+            return False
+        except requests.RequestException as e:
+            TELEGRAM_SECONDS.labels("failed").observe(time.monotonic() - t0)
+            log(f"Telegram error: {e} (attempt {attempt})")
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
+    log(f"Telegram gave up after {NOTIFY_MAX_RETRIES} attempts: {text}")
+    return False
+
+
+def _chunk_messages(texts, limit=TELEGRAM_MAX_LEN):
+    """Join alerts into as few messages as fit Telegram's length limit."""
+    chunks, current = [], ""
+    for text in texts:
+        text = text[:limit]
+        if current and len(current) + 2 + len(text) > limit:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{text}" if current else text
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class TelegramNotifier(Thread):
+    """Sends queued alerts, one grouped message per chat and window."""
+
+    def __init__(self, queue):
+        super().__init__(name="telegram-notifier", daemon=True)
+        self.queue = queue
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self.groups = {}  # (token, chat_id) -> {"first": ts, "texts": [...]}
+        self.stats = {"sent": 0, "failed": 0}
+
+    def depth(self) -> int:
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            return -1
+
+    def _send_due(self, force=False):
+        now = time.monotonic()
+        for key in list(self.groups):
+            group = self.groups[key]
+            if not force and now - group["first"] < NOTIFY_BATCH_WINDOW:
+                continue
+            del self.groups[key]
+            token, chat_id = key
+            for text in _chunk_messages(group["texts"]):
+                if _post_telegram(self.session, token, chat_id, text):
+                    self.stats["sent"] += 1
+                else:
+                    self.stats["failed"] += 1
+            log(
+                f"→ Telegram: {len(group['texts'])} alerts sent to {chat_id}; "
+                f"queue depth={self.depth()}"
+            )
+
+    def run(self):
+        while True:
+            try:
+                msg = self.queue.get(timeout=0.25)
+            except Empty:
+                msg = ()
+            if msg is None:
+                break
+            if msg:
+                token, chat_id, text = msg
+                group = self.groups.setdefault(
+                    (token, chat_id), {"first": time.monotonic(), "texts": []}
+                )
+                group["texts"].append(text)
+            self._send_due()
+        # drain whatever is still queued, then send everything
+        while True:
+            try:
+                msg = self.queue.get_nowait()
+            except Empty:
+                break
+            if msg:
+                self.groups.setdefault((msg[0], msg[1]), {"first": 0, "texts": []})["texts"].append(msg[2])
+        self._send_due(force=True)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
 
 
 # ─── Set Italy Delivery ────────────────────────────────
 def set_italy_delivery_once(drv, wait):
     try:
         log("→ Refreshing Webpage")
-        drv.refresh()
-        time.sleep(5)
+        with waiting():
+            drv.refresh()
+        wait_network_idle(drv)
         try:
             current = wait.until(
                 EC.presence_of_element_located(
                     (By.ID, "glow-ingress-line2")
                 )
             ).text.strip()
-            if "00049" in current:
-                log("→ Delivery already set to Italy (00049); skipping")
+            if DELIVERY_POSTCODE in current:
+                log(f"→ Delivery already set to Italy ({DELIVERY_POSTCODE}); skipping")
                 return True
         except Exception:
             # element not found or no text → fall through to setting
             pass
             
-        log("→ Setting delivery to Italy (00049)…")
+        log(f"→ Setting delivery to Italy ({DELIVERY_POSTCODE})…")
         wait.until(
             EC.element_to_be_clickable((By.ID, "nav-global-location-popover-link"))
         ).click()
         log("→ Clicked popup to open")
-        time.sleep(8)
         zip_in = wait.until(
-            EC.presence_of_element_located((By.ID, "GLUXZipUpdateInput"))
+            EC.element_to_be_clickable((By.ID, "GLUXZipUpdateInput"))
         )
         log("→ Found Field")
         zip_in.clear()
         log("→ Field Cleared")
-        time.sleep(2)
-        zip_in.send_keys("00049", Keys.ENTER)
+        zip_in.send_keys(DELIVERY_POSTCODE, Keys.ENTER)
         log("→ Entered Adddress")
-        time.sleep(2)
-        pop = wait.until(
-            EC.presence_of_element_located((By.CLASS_NAME, "a-popover-footer"))
+        wait_network_idle(drv)
+        done = wait.until(
+            EC.element_to_be_clickable((By.CSS_SELECTOR, ".a-popover-footer > *"))
         )
         log("→ Found Footer")
-        pop.find_element(By.XPATH, "./*").click()
+        done.click()
         log("→ Clicked Done")
-        time.sleep(2)
-        log("→ Delivery set to Italy 00049")
+        try:
+            wait.until(EC.text_to_be_present_in_element((By.ID, "glow-ingress-line2"), DELIVERY_POSTCODE))
+        except TimeoutException:
+            log("→ Location header not refreshed yet")
+        log(f"→ Delivery set to Italy {DELIVERY_POSTCODE}")
         return True
     except Exception as e:
         log(f"→ Could not set Italy delivery (already set?). Problem: {e}")
         return False
 
 
-def check_single_link(doc_id, item, token, chat_id, cool_time):
+# ─── Delivery location store ───────────────────────────
+# The cookies of one successful location setup are shared on disk by every
+# worker. Browsers (and the static HTTP session) load them instead of driving
+# the location popover; the store is rebuilt only when it expires or a page
+# stops showing DELIVERY_POSTCODE.
+_HTTP_COOKIES_MTIME = None
+
+
+def load_location_state():
+    """The stored cookies, or None if missing, expired or for another postcode."""
+    try:
+        with open(LOCATION_STORE) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("postcode") != DELIVERY_POSTCODE:
+        return None
+    if time.time() - state.get("saved_at", 0) > LOCATION_TTL:
+        return None
+    return state
+
+
+def save_location_state(cookies):
+    state = {"postcode": DELIVERY_POSTCODE, "saved_at": time.time(), "cookies": cookies}
+    tmp = f"{LOCATION_STORE}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, LOCATION_STORE)
+
+
+def apply_location_state(drv, state):
+    """Install stored cookies before the first navigation (no page load needed)."""
+    cookies = []
+    for c in state["cookies"]:
+        cookie = {
+            "name": c["name"],
+            "value": c["value"],
+            "domain": c.get("domain", ".amazon.it"),
+            "path": c.get("path", "/"),
+            "secure": c.get("secure", False),
+            "httpOnly": c.get("httpOnly", False),
+        }
+        if "expiry" in c:
+            cookie["expires"] = c["expiry"]
+        if c.get("sameSite") in ("Strict", "Lax", "None"):
+            cookie["sameSite"] = c["sameSite"]
+        cookies.append(cookie)
+    drv.execute_cdp_cmd("Network.setCookies", {"cookies": cookies})
+
+
+def page_has_location(drv) -> bool:
+    return any(
+        DELIVERY_POSTCODE in el.text
+        for el in drv.find_elements(By.ID, "glow-ingress-line2")
+    )
+
+
+def setup_location(drv, stale_before: float = 0.0):
     """
-    Open a fresh browser for item['url'], run the exact same checks
-    you had in check_once() for one link, then quit & sleep 10s.
-    Loop forever.
+    Put the configured location into this browser: from the store if another
+    worker already paid for it, otherwise through the popover, saving the
+    result for everyone else. Only one process drives the popover at a time.
+    A stored state saved at or before stale_before is known bad and ignored.
+    Returns the store's saved_at timestamp, or None on failure.
     """
-    url = item["url"]
+    with open(f"{LOCATION_STORE}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            state = load_location_state()
+            if state is not None and state["saved_at"] > stale_before:
+                with span("location.restore"):
+                    apply_location_state(drv, state)
+                log("→ Delivery location restored from session store")
+                return state["saved_at"]
+
+            with span("location.popover") as sp:
+                load_page(drv, f"{AMAZON_BASE}/-/en/ref=nav_logo")
+                located = set_italy_delivery_once(drv, TimedWait(drv, 15))
+                sp.set(ok=located)
+            if not located:
+                return None
+            cookies = drv.get_cookies()
+            save_location_state(cookies)
+            log("→ Delivery location saved to session store")
+            return load_location_state()["saved_at"]
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
 
-    while True:
-        doc = db.collection("links").document(doc_id).get()
-        if not doc.exists:
-            log(f"[{doc_id}] Link deleted—shutting down worker")
-            return
-        item = doc.to_dict()
 
-        # Cool Down time checking
-        if item.get("available"):
-            now = time.time()
-            since = item.get("available_since")
-
-            # First time we see available=true: record timestamp and skip
-            if since is None:
-                log(f"→ {url} marked available; starting cool-down of {cool_time}s")
-                save_link_state(doc_id, {"available_since": now})
-                # we _just_ started cool-down, so sleep full duration
-                time.sleep(cool_time)
+def sync_http_cookies():
+    """Reload the static tier's cookies whenever the store file changes."""
+    global _HTTP_COOKIES_MTIME
+    try:
+        mtime = os.stat(LOCATION_STORE).st_mtime
+    except OSError:
+        return
+    if mtime == _HTTP_COOKIES_MTIME:
+        return
+    state = load_location_state()
+    if state is None:
+        return
+    jar = http_session().cookies
+    for c in state["cookies"]:
+        jar.set(c["name"], c["value"], domain=c.get("domain"), path=c.get("path", "/"))
+    _HTTP_COOKIES_MTIME = mtime
+
+
+# ─── Checks ────────────────────────────────────────────
+# Outcomes a check can end with (also what the scheduler counts).
+CHECK_OUTCOMES = (
+    "out_of_stock", "core_match", "pinned_match", "list_match", "no_match", "error",
+    "cancelled", "throttled",
+)
+
+
+def _report_match(doc_id, token, chat_id, item, offer) -> str:
+    save_link_state(doc_id, {"available": True})
+    send_telegram(token, chat_id, match_message(item, offer))
+    log(f"→ Notifying {offer['source']}-offer match")
+    return f"{offer['source']}_match"
+
+
+def check_links(jobs, token, chat_id, known=None):
+    """
+    Check a batch of links, [(doc_id, generation), …], in stages, each one
+    run only for the products the previous left undecided: a static GET of
+    the PDP (out of stock, or a core offer that settles it); then, in one
+    warm browser from the pool, a tab per remaining product loading at once
+    and the PDP stage of each (core offer, then the buying-choices click);
+    then the offers stage of each (pinned offer and full AOD list). Links to
+    the same product (product_key) share one fetch, and every offer is
+    checked against each of their criteria. `known` maps a doc_id to the
+    fingerprint of its last no-match check; the offer list is skipped where
+    it still matches. Returns one {"doc_id", "outcome", "timing",
+    "resources", "batch", "stages", "spans", "fetches", "offers",
+    "checked_at", "fingerprint", "skipped", "examined"} per link; "outcome" is one of
+    CHECK_OUTCOMES, or "removed" if the link no longer exists; "stages"
+    holds seconds per pipeline stage (static, pdp, core, …); "spans" is the
+    job's trace, and "fetches" its page loads by result, on the first link
+    only; "offers" lists every priced offer
+    the check read; "fingerprint" holds the "aod" fingerprint taken and
+    "skipped" which one matched, if any; "examined" counts the AOD list
+    offers looked at.
+    """
+    start_check_clock()
+    reset_resource_stats()
+    _FETCHES.update(ok=0, throttled=0)
+    begin_job(dict(jobs))
+    begin_trace()
+    known = known or {}
+    outcomes = {}
+    products = {}  # product key -> tab
+    checked = {}  # doc_id -> tab
+    checked_at = time.time()
+    with span("check", links=",".join(d for d, _ in jobs), batch=len(jobs)) as root:
+        try:
+            for doc_id, _ in jobs:
+                item = cached_link(doc_id)
+                if item is None:
+                    log(f"[{doc_id}] Link deleted—skipping check")
+                    outcomes[doc_id] = "removed"
+                    continue
+                key = product_key(item["url"])
+                tab = products.get(key)
+                if tab is None:
+                    tab = products[key] = {
+                        "doc_id": doc_id, "url": product_url(item["url"]), "subs": [],
+                        "outcome": None, "stages": {}, "offers": [],
+                        "known": known.get(doc_id), "fingerprint": {}, "skipped": None,
+                        "examined": 0,
+                    }
+                else:
+                    tab["doc_id"] += f",{doc_id}"
+                    if tab["known"] != known.get(doc_id):
+                        tab["known"] = None  # skip only if every link would
+                tab["subs"].append({"doc_id": doc_id, "item": item, "outcome": None})
+                checked[doc_id] = tab
+
+            tabs = []
+            for tab in products.values():
+                tab["subs"].sort(key=lambda sub: sub["item"]["target_price"])
+                tab["targets"] = [sub["item"]["target_price"] for sub in tab["subs"]]
+                _run_stage(None, None, tab, _static_stage, token, chat_id)
+                if tab["outcome"] is None:
+                    tabs.append(tab)
+
+            if tabs:
+                try:
+                    _check_in_tabs(tabs, token, chat_id)
+                except Exception as e:
+                    log(f"Browser check failed: {e}")
+            for tab in products.values():
+                for sub in tab["subs"]:
+                    outcomes[sub["doc_id"]] = sub["outcome"] or tab["outcome"] or "error"
+        finally:
+            end_job()
+        root.set(outcomes=",".join(outcomes[d] for d, _ in jobs), products=len(products))
+
+    timing = check_clock_report()
+    resources = dict(_CHECK_RESOURCES)
+    for doc_id, _ in jobs:
+        log(f"[{doc_id}] Check ended '{outcomes[doc_id]}'")
+    log(
+        f"→ {len(jobs)} check(s) of {len(products)} product(s) took {timing['total']:.1f}s "
+        f"({timing['waiting']:.1f}s waiting, {timing['working']:.1f}s working)"
+    )
+    if resources["requests"] or resources["blocked"]:
+        log(
+            f"→ Loaded {resources['requests']} requests / "
+            f"{resources['bytes'] / 1024:.0f} KB; blocked {resources['blocked']} "
+            f"(~{resources['bytes_saved'] / 1024:.0f} KB saved)"
+        )
+    spans = end_trace()
+    results = []
+    for i, (doc_id, _) in enumerate(jobs):
+        tab = checked.get(doc_id, {})
+        results.append({
+            "doc_id": doc_id,
+            "outcome": outcomes[doc_id],
+            "timing": timing,
+            "resources": resources,
+            "batch": len(jobs),
+            "stages": tab.get("stages", {}),
+            "spans": spans if i == 0 else [],
+            "fetches": dict(_FETCHES) if i == 0 else {},
+            "offers": tab.get("offers", []),
+            "checked_at": checked_at,
+            "fingerprint": tab.get("fingerprint") or None,
+            "skipped": tab.get("skipped"),
+            "examined": tab.get("examined", 0),
+        })
+    return results
+
+
+def _offer_found(tab, offer, token, chat_id) -> bool:
+    """
+    Check one offer against the tab's links still open and report each
+    match on its own. Links are sorted by target price, so only those from
+    the first target ≥ the offer's price on can match. True once no link is
+    left open.
+    """
+    if offer is not None and offer["price"] is not None:
+        first = bisect.bisect_left(tab["targets"], offer["price"])
+        for sub in tab["subs"][first:]:
+            if sub["outcome"] is not None or not offer_matches(sub["item"], offer):
                 continue
-
-            elapsed = now - since
-            if elapsed < cool_time:
-                remaining = cool_time - elapsed
-                log(
-                    f"→ {url} still in cool-down ({elapsed:.0f}/{cool_time}s); "
-                    f"sleeping {remaining:.0f}s before next check"
-                )
-                time.sleep(remaining)
-                # after sleeping, on next iteration 'available_since' is old
-                # so we'll fall through, reset it, and then loop back around
+            try:
+                checkpoint(sub["doc_id"])
+            except CheckCancelled as e:
+                log(f"[{sub['doc_id']}] Check cancelled: {e}")
+                sub["outcome"] = "cancelled"
                 continue
+            sub["outcome"] = _report_match(sub["doc_id"], token, chat_id, sub["item"], offer)
+    return all(sub["outcome"] is not None for sub in tab["subs"])
 
-            # Cool-down expired: reset flag and let the rest of your check run
-            log(
-                f"→ Cool-down expired for {url}; resetting availability and re-checking"
-            )
-            save_link_state(
-                doc_id,
-                {"available": False, "available_since": firestore.DELETE_FIELD},
-            )
-            # update our local copy so downstream logic sees available=False
-            item["available"] = False
-            
-        # 1) new browser instance
-        drv = init_driver()
-        wait = WebDriverWait(drv, 5)
 
-        drv.get("https://www.amazon.it/-/en/ref=nav_logo")
-        time.sleep(5)
-        if not set_italy_delivery_once(drv, WebDriverWait(drv, 15)):
+def checkpoint_tab(tab):
+    """
+    checkpoint() for each link still open on the tab: an edited or removed
+    one drops out as 'cancelled' and the others carry on. Raises
+    CheckCancelled once none is left.
+    """
+    for sub in tab["subs"]:
+        if sub["outcome"] is None:
             try:
-                drv.quit()
-            except:
-                pass
-            log(f"[{doc_id}] Browser closed; sleeping 10s")
-            time.sleep(5)
-            continue
+                checkpoint(sub["doc_id"])
+            except CheckCancelled as e:
+                log(f"[{sub['doc_id']}] Check cancelled: {e}")
+                sub["outcome"] = "cancelled"
+    if all(sub["outcome"] is not None for sub in tab["subs"]):
+        raise CheckCancelled(f"no link left to check on {tab['url']}")
+
+
+def _seen(tab, offer):
+    """Keep a priced offer for the price history."""
+    if offer is not None and offer["price"] is not None:
+        tab["offers"].append(offer)
+
+
+def _unchanged(drv, tab) -> bool:
+    """
+    Fingerprint the tab's offer list; True when it equals the one from the
+    link's last no-match check, so the rest can be skipped.
+    """
+    try:
+        fp = page_fingerprint(drv)
+    except WebDriverException as e:
+        log(f"→ Could not fingerprint offers: {e}")
+        return False
+    tab["fingerprint"]["aod"] = fp
+    if not tab["known"] or tab["known"].get("aod") != fp:
+        return False
+    tab["skipped"] = "aod"
+    return True
 
-        try:
-            url = item["url"]
-            log(f"Loading page: {url}")
 
+def _run_stage(drv, entry, tab, stage, token, chat_id):
+    """
+    Run one pipeline stage for one tab. Whatever goes wrong stays with that
+    tab: it ends 'error' (or 'cancelled') and the other tabs carry on.
+    """
+    doc_id, url = tab["doc_id"], tab["url"]
+    try:
+        if drv is not None:
+            drv.switch_to.window(tab["handle"])
+        checkpoint_tab(tab)
+        with timed(tab, stage.__name__.strip("_").removesuffix("_stage")) as sp:
+            tab["outcome"] = stage(drv, entry, tab, token, chat_id)
+            sp.set(outcome=tab["outcome"] or "continue")
+            if tab.get("skipped"):
+                sp.set(skipped=tab["skipped"])
+        if tab["outcome"] is None:
+            checkpoint_tab(tab)
+    except CheckCancelled as e:
+        log(f"[{doc_id}] Check cancelled: {e}")
+        tab["outcome"] = "cancelled"
+    except Throttled as e:
+        log(f"[{doc_id}] Check throttled: {e}")
+        tab["outcome"] = "throttled"
+    except TimeoutException as e:
+        log(f"Timeout on {url}: {e}")
+        tab["outcome"] = "error"
+    except Exception as e:
+        log(f"Error checking {url}: {e}")
+        tab["outcome"] = "error"
+        if entry is not None:
+            entry["broken"] = True
+
+
+def _check_in_tabs(tabs, token, chat_id):
+    with span("driver.acquire") as sp:
+        entry = acquire_driver()
+        sp.set(uses=entry["uses"], located=bool(entry["located"]))
+    drv = entry["driver"]
+    try:
+        if not entry["located"]:
+            try:
+                entry["located"] = setup_location(drv)
+            except Throttled as e:
+                log(f"→ Location setup throttled: {e}")
+                for tab in tabs:
+                    tab["outcome"] = "throttled"
+                return
+            if not entry["located"]:
+                return
+
+        # A) one tab per product, all loading at once
+        for i, tab in enumerate(tabs):
             try:
-                drv.get(url)
-                time.sleep(2)
+                with span("tab.open", link_id=tab["doc_id"]):
+                    if i:
+                        drv.switch_to.new_window("tab")
+                    tab["handle"] = drv.current_window_handle
+                    tab["located"] = entry["located"]
+                    log(f"Loading page: {tab['url']}")
+                    start_navigation(drv, tab["url"])
+            except Throttled as e:
+                log(f"[{tab['doc_id']}] Not loaded: {e}")
+                tab["outcome"] = "throttled"
+            except Exception as e:
+                log(f"[{tab['doc_id']}] Could not open tab: {e}")
+                tab["outcome"] = "error"
+
+        # B) PDP of each tab; the others keep loading meanwhile
+        for tab in tabs:
+            if tab["outcome"] is None:
+                _run_stage(drv, entry, tab, _pdp_stage, token, chat_id)
+
+        # C) offer lists, opened in B and loading in the background since
+        for tab in tabs:
+            if tab["outcome"] is None:
+                _run_stage(drv, entry, tab, _offers_stage, token, chat_id)
+    finally:
+        # hand the browser back (reset closes the extra tabs; quit if broken or worn out)
+        collect_resource_stats(drv)
+        broken = entry.pop("broken", False)
+        release_driver(entry, healthy=entry["located"] is not None and not broken)
+
+
+def _static_stage(drv, entry, tab, token, chat_id):
+    """Cheap static fetch; None means Chrome is needed."""
+    static = static_check(tab["url"])
+    if static is None:
+        return None
+    if static["status"] == "out_of_stock":
+        log("→ Still out of stock (static), skipping")
+        return "out_of_stock"
+    _seen(tab, static["offer"])
+    if _offer_found(tab, static["offer"], token, chat_id):
+        return "core_match"
+    if static["more_offers"]:
+        log("→ Static core offer did not meet criteria; offer list needs Chrome")
+        return None
+    log("→ Core offer did not meet criteria and no other offers (static)")
+    return "no_match"
+
+
+def _pdp_stage(drv, entry, tab, token, chat_id):
+    """Product page up to clicking 'see all buying choices'; None once clicked."""
+    url = tab["url"]
+    wait = TimedWait(drv)
+    with timed(tab, "load"):
+        await_page(drv)
+    check_throttled(drv)
+
+    # ─── Still delivering to our postcode? ─────────────
+    if not page_has_location(drv):
+        if entry["located"] == tab["located"]:
+            log("→ Delivery location lost; refreshing session store")
+            entry["located"] = setup_location(drv, stale_before=entry["located"])
+            if not entry["located"]:
+                return "error"
+        # else another tab already refreshed it after this one started loading
+        load_page(drv, url)
+    checkpoint_tab(tab)
+
+    # ─── Out of stock? ────────────────────────────────
+    # server-rendered, so present by DOMContentLoaded if at all
+    if drv.find_elements(By.ID, "outOfStock"):
+        log("→ Still out of stock, skipping")
+        return "out_of_stock"
+    log("→ Not marked out of stock")
+
+    # ─── Dismiss cookies ───────────────────────────────
+    try:
+        if not drv.find_elements(By.ID, "sp-cc-rejectall-link"):
+            raise LookupError
+        cookie = wait.until(
+            EC.element_to_be_clickable((By.ID, "sp-cc-rejectall-link"))
+        )
+        cookie.click()
+        log("→ Cookies dismissed")
+    except:
+        log("→ No cookie banner to dismiss")
 
-                # ─── Out of stock? ────────────────────────────────
-                try:
-                    wait.until(EC.presence_of_element_located((By.ID, "outOfStock")))
-                    log("→ Still out of stock, skipping")
-                    continue
-                except:
-                    log("→ Not marked out of stock")
+    # ─── Core PDP offer ────────────────────────────────
+    try:
+        with timed(tab, "core") as sp:
+            wait.until(
+                EC.presence_of_element_located((By.ID, "corePrice_feature_div"))
+            )
+            core = snapshot_offers(drv, ("core",))["core"]
+            _seen(tab, core)
+            sp.set(price=core["price"] if core else None)
+    except Exception as e:
+        log(f"→ Core PDP check failed: {e}")
+        core = None
+    if core and core["price"] is not None:
+        log(f"→ Core PDP {describe_offer(core)}")
+        if _offer_found(tab, core, token, chat_id):
+            return "core_match"
+        log("→ Core PDP offer did not meet criteria")
+    else:
+        log("→ Core PDP price not found")
+    checkpoint_tab(tab)
+
+    # ─── Open all buying choices ────────────────────────
+    try:
+        # primary button, or the aod-ingress-link fallback
+        with timed(tab, "buying_choices"):
+            aoc = wait.until(
+                EC.any_of(
+                    EC.element_to_be_clickable(
+                        (By.ID, "buybox-see-all-buying-choices")
+                    ),
+                    EC.element_to_be_clickable((By.ID, "aod-ingress-link")),
+                )
+            )
+        log(f"→ Found {aoc.get_attribute('id')}")
+    except TimeoutException:
+        log(
+            "→ No 'see all buying choices' link found, skipping full-list checks"
+        )
+        return "no_match"
 
-                # ─── Dismiss cookies ───────────────────────────────
-                try:
-                    cookie = wait.until(
-                        EC.element_to_be_clickable((By.ID, "sp-cc-rejectall-link"))
-                    )
-                    cookie.click()
-                    log("→ Cookies dismissed")
-                except:
-                    log("→ No cookie banner to dismiss")
+    try:
+        drv.execute_script("arguments[0].scrollIntoView(true);", aoc)
+        aoc.click()
+    except Exception as e:
+        log(f"→ Failed to open offers list: {e}")
+        return "error"
+    return None
 
-                # ─── Core PDP offer ────────────────────────────────
-                try:
-                    if _check_core_offer(drv, wait, item):
-                        save_link_state(doc_id, {"available": True})
-                        msg = (
-                            f"✅ {item['name']} is back in stock!\n"
-                            f"✅ AMAZON OFFER FOUND!\n{url}\n"
-                            f"💰 €{_CORE_PRICE:.2f} (≤ €{item['target_price']:.2f})\n"
-                            f"🚚 Ships from: {_CORE_SHIPS}\n"
-                            f"🏷️ Sold by: {_CORE_SOLD}"
-                        )
-                        send_telegram(token, chat_id, msg)
-                        log("→ Notifying core-offer match")
-                        continue
-                    else:
-                        log("→ Core PDP offer did not meet criteria")
-                except Exception as e:
-                    log(f"→ Core PDP check failed: {e}")
 
-                time.sleep(3)
+def _offers_stage(drv, entry, tab, token, chat_id):
+    """The AOD panel opened by _pdp_stage: pinned offer, then the full list."""
+    wait = TimedWait(drv)
 
-                # ─── Open all buying choices ────────────────────────
-                try:
-                    # try primary button
-                    aoc = wait.until(
-                        EC.element_to_be_clickable(
-                            (By.ID, "buybox-see-all-buying-choices")
-                        )
-                    )
-                    log("→ Found buybox-see-all-buying-choices")
-                except TimeoutException:
-                    try:
-                        aoc = wait.until(
-                            EC.element_to_be_clickable((By.ID, "aod-ingress-link"))
-                        )
-                        log("→ Found aod-ingress-link fallback")
-                    except Exception:
-                        log(
-                            "→ No 'see all buying choices' link found, skipping full-list checks"
-                        )
+    try:
+        with timed(tab, "aod_open"):
+            wait.until(
+                EC.any_of(
+                    EC.presence_of_element_located((By.ID, "aod-pinned-offer")),
+                    EC.presence_of_element_located((By.ID, "aod-offer-list")),
+                )
+            )
+            wait_network_idle(drv)
+        log("→ Offers list opened")
+    except Exception as e:
+        log(f"→ Failed to open offers list: {e}")
+        return "error"
+    checkpoint_tab(tab)
+
+    if _unchanged(drv, tab):
+        log("→ Offers unchanged since last check, skipping pinned offer and full list")
+        return "no_match"
+
+    # ─── Check pinned offer ─────────────────────────────
+    try:
+        # the AOD panel is already in, no need to wait for it again
+        with timed(tab, "pinned") as sp:
+            pinned = snapshot_offers(drv, ("pinned",))["pinned"]
+            _seen(tab, pinned)
+            sp.set(price=pinned["price"] if pinned else None)
+        if pinned is None or pinned["price"] is None:
+            log("→ Pinned-offer: price missing or parse failed")
+        else:
+            log(f"→ Pinned offer {describe_offer(pinned)}")
+            if _offer_found(tab, pinned, token, chat_id):
+                return "pinned_match"
+            log("→ Pinned offer did not meet criteria")
+    except CheckCancelled:
+        raise
+    except Exception:
+        log("→ Skipping pinned-offer")
+    checkpoint_tab(tab)
+
+    # ─── Stream the offer list ───────────────────────────
+    # Read the offers loaded so far, scroll for the next page and check each
+    # new offer while it loads; stop at the first match, when a page brings
+    # nothing new within WAIT_SCROLL_TIMEOUT, or once the panel's announced
+    # total is in.
+    try:
+        with timed(tab, "list") as sp:
+            wait.until(
+                EC.presence_of_element_located((By.ID, "aod-offer-list"))
+            )
+            start = time.time()
+            pages = 0
+            while True:
+                snap = snapshot_offers(drv, ("list", "scroll"), start=tab["examined"])
+                if pages and not snap["list"]:
+                    reason = "no more offers"
+                    break
+                pages += 1
+                for offer in snap["list"]:
+                    tab["examined"] += 1
+                    _seen(tab, offer)
+                    if offer["price"] is None:
+                        log("   – skipping offer: price not found")
                         continue
+                    log(f"   → Offer {describe_offer(offer)}")
+                    if _offer_found(tab, offer, token, chat_id):
+                        sp.set(offers=tab["examined"], pages=pages, end="match")
+                        log(f"→ Match after {tab['examined']} offers in {time.time() - start:.1f}s")
+                        return "list_match"
+                if snap["total"] is not None and snap["loaded"] >= snap["total"]:
+                    reason = "list complete"
+                    break
+                checkpoint_tab(tab)
+                wait_network_idle(drv, timeout=WAIT_SCROLL_TIMEOUT)
+            sp.set(offers=tab["examined"], pages=pages, end=reason)
+        log(
+            f"→ No offer met criteria in full list ({tab['examined']} offers, "
+            f"{pages} pages, {time.time() - start:.1f}s; {reason})"
+        )
+        return "no_match"
 
-                time.sleep(4)
+    except CheckCancelled:
+        raise
+    except Exception as e:
+        log(f"→ Offer-list not present or parsing failed: {e}")
+        return "error"
 
-                try:
-                    drv.execute_script("arguments[0].scrollIntoView(true);", aoc)
-                    time.sleep(2)
-                    aoc.click()
-                    time.sleep(2)
-                    log("→ Offers list opened")
-                except Exception as e:
-                    log(f"→ Failed to open offers list: {e}")
-                    continue
 
-                # ─── Check pinned offer ─────────────────────────────
-                try:
-                    pinned = wait.until(
-                        EC.presence_of_element_located((By.ID, "aod-pinned-offer"))
-                    )
-                    log("→ Found pinned-offer container")
-
-                    # 1) Price
-                    try:
-                        price_span = pinned.find_element(By.ID, "aod-price-0")
-                        # try offscreen
-                        raw = price_span.find_element(
-                            By.CSS_SELECTOR, "span.aok-offscreen"
-                        ).text.strip()
-                        if not raw:
-                            # fallback to whole + fraction
-                            whole = price_span.find_element(
-                                By.CSS_SELECTOR, "span.a-price-whole"
-                            ).text
-                            frac = price_span.find_element(
-                                By.CSS_SELECTOR, "span.a-price-fraction"
-                            ).text
-                            raw = f"{whole}.{frac}"
-                            log(
-                                f"→ Pinned-offer: offscreen empty, fallback raw='{raw}'"
-                            )
-                        else:
-                            log(f"→ Pinned-offer: offscreen raw='{raw}'")
-                        pinned_price = float(raw.replace("€", "").replace(",", ""))
-                        log(f"→ Parsed pinned price: €{pinned_price:.2f}")
-                    except:
-                        log(f"→ Pinned-offer: price missing or parse failed")
-                        raise  # stop pinned-check if we can’t get a price
-
-                    # 2) Ships from
-                    try:
-                        pinned.find_element(By.ID, "aod-pinned-offer-show-more-link").click()
-                        # look under the right-hand grid for the “aod-offer-shipsFrom” entry
-                        ships = pinned.find_elements(
-                            By.CSS_SELECTOR,
-                            "#aod-offer-shipsFrom .a-fixed-left-grid .a-fixed-left-grid-inner .a-fixed-left-grid-col.a-col-right .a-size-small.a-color-base",
-                        )
-                        if ships:
-                            sf = ships[0].text.strip()
-                            log(f"→ Parsed pinned ships-from: {sf}")
-                        else:
-                            sf = ""
-                            log("→ Pinned-offer: no ships-from element found")
-                    except Exception as e:
-                        sf = ""
-                        log(f"→ Pinned-offer: ships-from lookup failed: {e}")
-
-                    # 3) Sold by
-                    try:
-                        sellers = pinned.find_elements(
-                            By.CSS_SELECTOR,
-                            "#aod-offer-soldBy .a-fixed-left-grid .a-fixed-left-grid-inner .a-fixed-left-grid-col.a-col-right a.a-size-small.a-link-normal",
-                        )
-                        if sellers:
-                            sb = sellers[0].text.strip()
-                            log(f"→ Parsed pinned sold-by: {sb}")
-                        else:
-                            sb = ""
-                            log("→ Pinned-offer: no sold-by element found")
-                    except Exception as e:
-                        sb = ""
-                        log(f"→ Pinned-offer: sold-by lookup failed: {e}")
-
-                    # 4) Apply filters
-                    if (
-                        pinned_price <= item["target_price"]
-                        and (not item.get("check_shipped") or "amazon" in sf.lower())
-                        and (not item.get("check_sold") or "amazon" in sb.lower())
-                    ):
-                        msg = (
-                            f"✅ {item['name']} is back in stock!\n"
-                            f"✅ AMAZON OFFER FOUND!\n{url}\n"
-                            f"💰 €{pinned_price:.2f} (≤ €{item['target_price']:.2f})\n"
-                            f"🚚 Ships from: {sf}\n"
-                            f"🏷️ Sold by: {sb}"
-                        )
-                        save_link_state(doc_id, {"available": True})
-                        send_telegram(token, chat_id, msg)
-                        log("→ Notifying pinned-offer match")
-                        continue
-                    else:
-                        log("→ Pinned offer did not meet criteria")
+# ─── Memory governor ───────────────────────────────────
+# MAX_WORKERS is only a ceiling: a new browser is admitted only while the
+# container has room for one. Chrome's shared memory lives in /tmp
+# (--disable-dev-shm-usage), which the cgroup also counts, so the cgroup's own
+# usage is what we budget against rather than a sum of process RSS.
+_CGROUP_V2 = "/sys/fs/cgroup"
+_CGROUP_V1 = "/sys/fs/cgroup/memory"
 
-                except:
-                    log(f"→ Skipping pinned-offer")
 
-                # ─── Scroll to load offers for up to 20 s ─────────────────────
-                try:
-                    scroller = wait.until(
-                        EC.presence_of_element_located(
-                            (By.ID, "all-offers-display-scroller")
-                        )
-                    )
-                    start = time.time()
+def _read_int(path: str):
+    try:
+        with open(path) as f:
+            raw = f.read().strip()
+    except OSError:
+        return None
+    return None if raw == "max" else int(raw)
 
-                    while time.time() - start < 5:
-                        drv.execute_script(
-                            "arguments[0].scrollTo(0, arguments[0].scrollHeight);",
-                            scroller,
-                        )
-                        time.sleep(1)
 
-                    elapsed = time.time() - start
-                    log(f"→ Finished scrolling after {elapsed:.1f}s")
+def _stat_value(path: str, key: str) -> int:
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, value = line.partition(" ")
+                if name.rstrip(":") == key:
+                    return int(value.split()[0])
+    except OSError:
+        pass
+    return 0
 
-                except Exception as e:
-                    log(f"→ Scrolling container failed or not present: {e}")
 
-                # ─── Iterate full offer list ─────────────────────────
-                try:
-                    container = wait.until(
-                        EC.presence_of_element_located((By.ID, "aod-offer-list"))
-                    )
-                    sections = container.find_elements(By.CSS_SELECTOR, "div.a-section")
-                    log(f"→ Found {len(sections)} offer sections")
-
-                    found = False
-                    for idx, section in enumerate(sections, start=1):
-                        offers = section.find_elements(
-                            By.XPATH, ".//div[@id='aod-offer']"
-                        )
-                        log(f"→ Section {idx}: {len(offers)} offers")
-                        for offer in offers:
-                            # parse price
-                            try:
-                                whole = offer.find_element(
-                                    By.CSS_SELECTOR, ".a-price-whole"
-                                ).text.replace(".", "")
-                                frac = offer.find_element(
-                                    By.CSS_SELECTOR, ".a-price-fraction"
-                                ).text
-                                price = float(f"{whole}.{frac}")
-                            except Exception:
-                                log("   – skipping offer: price not found")
-                                continue
-
-                            # parse ships-from / sold-by
-                            sf = sb = ""
-                            try:
-                                sf = offer.find_element(
-                                    By.XPATH,
-                                    ".//div[@id='aod-offer-shipsFrom']//span[contains(@class,'a-color-base')]",
-                                ).text.strip()
-                            except:
-                                log("   – offer missing ships-from")
-                            try:
-                                # pick either the <a> or the <span> that carries the seller name
-                                sb_el = offer.find_element(
-                                    By.CSS_SELECTOR,
-                                    "#aod-offer-soldBy a.a-link-normal, #aod-offer-soldBy span.a-color-base",
-                                )
-                                sb = sb_el.text.strip()
-                            except:
-                                log("   – offer missing sold-by")
-
-                            log(
-                                f"   → Offer €{price:.2f}, Ships from “{sf}”, Sold by “{sb}”"
-                            )
-
-                            # apply filters
-                            if price > item["target_price"]:
-                                continue
-                            if item.get("check_shipped") and "amazon" not in sf.lower():
-                                continue
-                            if item.get("check_sold") and "amazon" not in sb.lower():
-                                continue
-
-                            # match!
-                            msg = (
-                                f"✅ {item['name']} is back in stock!\n"
-                                f"✅ AMAZON OFFER FOUND!\n{url}\n"
-                                f"💰 €{price:.2f} (≤ €{item['target_price']:.2f})\n"
-                                f"🚚 Ships from: {sf}\n"
-                                f"🏷️ Sold by: {sb}"
-                            )
-                            save_link_state(doc_id, {"available": True})
-                            send_telegram(token, chat_id, msg)
-                            log("→ Notifying list-offer match")
-                            found = True
-                            break
+def memory_usage():
+    """
+    (limit, used) in bytes for this container. The cgroup (v2, then v1) is
+    preferred; without one, the host's MemTotal / MemTotal - MemAvailable.
+    Reclaimable page cache is not counted as used.
+    """
+    total = _stat_value("/proc/meminfo", "MemTotal") * 1024
+    limit = _read_int(f"{_CGROUP_V2}/memory.max")
+    used = _read_int(f"{_CGROUP_V2}/memory.current")
+    inactive = _stat_value(f"{_CGROUP_V2}/memory.stat", "inactive_file")
+    if used is None:
+        limit = _read_int(f"{_CGROUP_V1}/memory.limit_in_bytes")
+        used = _read_int(f"{_CGROUP_V1}/memory.usage_in_bytes")
+        inactive = _stat_value(f"{_CGROUP_V1}/memory.stat", "total_inactive_file")
+    if MEMORY_LIMIT_MB:
+        limit = MEMORY_LIMIT_MB * 1024 * 1024
+    if limit is None or (total and limit > total):
+        limit = total  # no cgroup limit (v1 reports a huge number)
+    if used is None:
+        used = total - _stat_value("/proc/meminfo", "MemAvailable") * 1024
+    else:
+        used = max(0, used - inactive)
+    return limit, used
+
+
+class MemoryGovernor:
+    """
+    Samples container memory and the RSS of every worker's Chrome trees, and
+    decides whether one more check (= one more browser) fits. Under pressure
+    it frees memory largest browser first: idle pooled browsers are killed
+    outright, busy ones are asked to recycle when their check ends, and if
+    usage still reaches MEMORY_CRITICAL the largest busy one is killed.
+    """
 
-                        if found:
-                            break
+    def __init__(self, registry, recycle):
+        self.registry = registry
+        self.recycle = recycle  # browser pid -> reason, read by release_driver()
+        self.limit = 0
+        self.used = 0
+        self.browsers = {}  # browser pid -> (tree RSS bytes, idle?)
+        self.pending = 0  # admitted since the last sample, not yet measured
+        self.stats = {"deferred": 0, "freed_idle": 0, "recycled": 0, "killed": 0}
+
+    def sample(self):
+        self.limit, self.used = memory_usage()
+        children, rss_pages = _proc_table()
+        page = os.sysconf("SC_PAGE_SIZE")
+        self.browsers = {}
+        for pid, job in list(self.registry.items()):
+            idle = set(job.get("idle", ()))
+            for browser in job["browsers"]:
+                rss = sum(rss_pages.get(p, 0) for p in process_tree(browser, children))
+                if rss:
+                    self.browsers[browser] = (rss * page, browser in idle)
+        for pid in list(self.recycle.keys()):
+            if pid not in self.browsers:
+                self.recycle.pop(pid, None)  # already gone
+        self.pending = 0
+
+    def per_browser(self) -> int:
+        """Expected cost of one more browser: the mean measured one, or BROWSER_MEM_MB."""
+        floor = BROWSER_MEM_MB * 1024 * 1024
+        if not self.browsers:
+            return floor
+        return max(floor, sum(r for r, _ in self.browsers.values()) // len(self.browsers))
+
+    def headroom(self) -> int:
+        reserve = MEMORY_RESERVE_MB * 1024 * 1024
+        return self.limit - reserve - self.used - self.pending * self.per_browser()
+
+    def admit(self, running: int) -> bool:
+        """May one more check start? Always yes when nothing runs, so we never stall."""
+        if running and self.headroom() < self.per_browser():
+            self.stats["deferred"] += 1
+            return False
+        return True
 
-                    if not found:
-                        log("→ No offer met criteria in full list")
+    def admitted(self):
+        """Book a started check against headroom until the next sample sees it."""
+        self.pending += 1
+
+    def finished(self):
+        self.pending = max(0, self.pending - 1)
+
+    def concurrency(self, running: int) -> int:
+        """How many checks the current headroom supports, counting those running."""
+        return running + max(0, self.headroom() // self.per_browser())
+
+    def relieve(self) -> int:
+        """Free memory while over budget; returns how many browsers were acted on."""
+        acted = 0
+        deficit = -self.headroom()
+        largest = sorted(self.browsers.items(), key=lambda b: b[1][0], reverse=True)
+        for pid, (rss, idle) in largest:
+            if deficit <= 0:
+                break
+            if idle:
+                kill_process_tree(pid)
+                self.stats["freed_idle"] += 1
+            elif pid not in self.recycle:
+                self.recycle[pid] = f"memory pressure, {rss / 1048576:.0f}MB"
+                self.stats["recycled"] += 1
+            else:
+                continue
+            log(f"→ Memory pressure: {'killed idle' if idle else 'recycling'} browser {pid} ({rss / 1048576:.0f}MB)")
+            deficit -= rss
+            acted += 1
+
+        if self.limit and self.used >= self.limit * MEMORY_CRITICAL:
+            busy = [b for b in largest if not b[1][1] and pid_alive(b[0])]
+            if busy:
+                pid, (rss, _) = busy[0]
+                log(f"→ Memory critical ({self.used / self.limit:.0%}); killing browser {pid} ({rss / 1048576:.0f}MB)")
+                self.stats["killed"] += 1
+                kill_process_tree(pid)
+                acted += 1
+        return acted
+
+    def report(self, running: int) -> dict:
+        mb = 1024 * 1024
+        return {
+            "limit_mb": self.limit // mb,
+            "used_mb": self.used // mb,
+            "headroom_mb": self.headroom() // mb,
+            "browsers": len(self.browsers),
+            "browsers_mb": sum(r for r, _ in self.browsers.values()) // mb,
+            "per_browser_mb": self.per_browser() // mb,
+            "concurrency": min(MAX_WORKERS, self.concurrency(running)),
+            **self.stats,
+        }
+
+
+# ─── Polling intervals ─────────────────────────────────
+# How long a link waits for its next check, from what its checks saw:
+#   CHECK_INTERVAL
+#   × recency: hours since its price or stock last changed / RECENCY_HOURS, in [¼, 4]
+#   × proximity: its lowest price's gap above target_price / PROXIMITY_GAP, in [¼, 2]
+#   ÷ the link's optional "priority" field (default 1)
+# clamped to [CHECK_INTERVAL_MIN, CHECK_INTERVAL_MAX], then stretched for all
+# links alike while together they would exceed CHECKS_PER_MINUTE.
+RECENCY_HOURS = 6
+PROXIMITY_GAP = 0.2
+
+
+def _clamp(value, lo, hi):
+    return max(lo, min(hi, value))
+
+
+def lowest_eligible_price(item: dict, offers: list):
+    """Cheapest offer meeting the link's shipped/sold settings, at any price."""
+    anyprice = {**item, "target_price": float("inf")}
+    return min((o["price"] for o in offers if offer_matches(anyprice, o)), default=None)
+
+
+class PollPlanner:
+    """Per-link check intervals. Not locked: the scheduler calls it under its own."""
+
+    def __init__(self):
+        # doc_id -> {"price", "in_stock", "changed_at", "first_seen", "raw", "factors"}
+        self.links = {}
+        self.rate = 0.0  # checks per minute the raw intervals add up to
+
+    def observe(self, doc_id: str, item, result: dict, now: float = None) -> float:
+        """Take in a finished check; returns the seconds until the link's next one."""
+        now = time.time() if now is None else now
+        link = self.links.get(doc_id)
+        if link is None:
+            link = self.links[doc_id] = {
+                "price": None, "in_stock": None, "changed_at": None, "first_seen": now,
+                "raw": None, "factors": {},
+            }
+        outcome = result["outcome"]
+        # a fingerprint skip read only part of the page, but nothing changed
+        if (
+            item is not None
+            and outcome not in ("error", "cancelled", "removed", "throttled")
+            and not result.get("skipped")
+        ):
+            in_stock = outcome != "out_of_stock"
+            price = lowest_eligible_price(item, result.get("offers") or ()) if in_stock else None
+            if link["in_stock"] is not None and (in_stock, price) != (link["in_stock"], link["price"]):
+                link["changed_at"] = now
+            link["in_stock"], link["price"] = in_stock, price
+        if item is not None:
+            self._plan(link, item, now)
+        return self.interval(doc_id)
+
+    def _plan(self, link, item, now):
+        quiet = (now - (link["changed_at"] or link["first_seen"])) / 3600
+        recency = _clamp(quiet / RECENCY_HOURS, 0.25, 4.0)
+        if link["changed_at"] is None:
+            recency = max(1.0, recency)  # no change seen yet is not "hot"
+        proximity = 1.0
+        if link["price"] is not None and item.get("target_price"):
+            gap = (link["price"] - item["target_price"]) / item["target_price"]
+            proximity = _clamp(gap / PROXIMITY_GAP, 0.25, 2.0)
+        priority = item.get("priority")
+        if not isinstance(priority, (int, float)) or priority <= 0:
+            priority = 1
+        raw = _clamp(
+            CHECK_INTERVAL * recency * proximity / priority, CHECK_INTERVAL_MIN, CHECK_INTERVAL_MAX
+        )
+        if link["raw"]:
+            self.rate -= 60 / link["raw"]
+        self.rate += 60 / raw
+        link["raw"] = raw
+        link["factors"] = {"recency": recency, "proximity": proximity, "priority": priority}
+
+    def stretch(self) -> float:
+        """Factor all intervals get so the links stay within CHECKS_PER_MINUTE."""
+        if CHECKS_PER_MINUTE <= 0:
+            return 1.0
+        return max(1.0, self.rate / CHECKS_PER_MINUTE)
+
+    def interval(self, doc_id: str) -> float:
+        link = self.links.get(doc_id)
+        raw = link["raw"] if link and link["raw"] else CHECK_INTERVAL
+        return raw * self.stretch()
+
+    def forget(self, doc_id: str):
+        link = self.links.pop(doc_id, None)
+        if link and link["raw"]:
+            self.rate -= 60 / link["raw"]
+
+    def report(self) -> dict:
+        """{doc_id: {"interval", "recency", "proximity", "priority", "price", "changed_at"}}"""
+        stretch = self.stretch()
+        return {
+            doc_id: {
+                "interval": round(link["raw"] * stretch, 1),
+                **{k: round(v, 2) for k, v in link["factors"].items()},
+                "price": link["price"],
+                "changed_at": link["changed_at"],
+            }
+            for doc_id, link in self.links.items()
+            if link["raw"]
+        }
+
+
+# ─── Scheduler ─────────────────────────────────────────
+def cooldown_due(doc_id: str, item: dict, cool_time: float):
+    """
+    Cool-down handling for a link that is about to be checked. Returns the
+    time the link is next due while it is cooling down, or None when the
+    check may run now (resetting availability once the cool-down expired).
+    """
+    if not item.get("available"):
+        return None
+    url = item["url"]
+    now = time.time()
+    since = item.get("available_since")
+
+    # First time we see available=true: record timestamp and wait it out
+    if since is None:
+        log(f"→ {url} marked available; starting cool-down of {cool_time}s")
+        save_link_state(doc_id, {"available_since": now})
+        return now + cool_time
+
+    elapsed = now - since
+    if elapsed < cool_time:
+        log(f"→ {url} still in cool-down ({elapsed:.0f}/{cool_time}s)")
+        return since + cool_time
+
+    # Cool-down expired: reset flag and let the check run
+    log(f"→ Cool-down expired for {url}; resetting availability and re-checking")
+    save_link_state(
+        doc_id,
+        {"available": False, "available_since": _DELETE},
+    )
+    return None
 
-                except Exception as e:
-                    log(f"→ Offer-list not present or parsing failed: {e}")
 
-            except TimeoutException as e:
-                log(f"Timeout on {url}: {e}")
+class Scheduler(Thread):
+    """
+    Hands check jobs to the worker pool in order of each link's next-due
+    time, never more than `capacity` at once and never two for the same
+    link. Links that are due together go out as one job of up to
+    TABS_PER_BROWSER products, checked in tabs of the same browser; a link
+    takes every scheduled link to the same product along, so each product is
+    fetched once per cycle. Below
+    `capacity`, the MemoryGovernor decides whether another browser fits.
+    Cool-downs are just a later due time, not a sleeping worker. Tracks how
+    late each check starts compared to when it was due. The PollPlanner sets
+    how long each link waits after a check.
+
+    After a no-match, the link's page fingerprints go out with its next job
+    so an unchanged offer list isn't walked again; every FULL_CHECK_EVERY
+    cycles the check runs in full regardless.
+
+    Running checks whose link changed (generation bumped) are expected to
+    stop at their next checkpoint; if they haven't after CANCEL_GRACE, or any
+    check runs past CHECK_HARD_TIMEOUT, the worker's browsers are killed,
+    and if even that doesn't end it, the worker process itself.
+    """
 
+    def __init__(
+        self, executor_factory, capacity, token, chat_id, cool_time, shared,
+        traces=None, history=None,
+    ):
+        super().__init__(name="scheduler", daemon=True)
+        self.executor_factory = executor_factory
+        self.executor = executor_factory()
+        self.broken = False
+        self.capacity = capacity
+        self.token = token
+        self.chat_id = chat_id
+        self.cool_time = cool_time
+        self.generations = shared["generations"]
+        self.registry = shared["registry"]
+        self.traces = traces  # TraceExporter, or None when tracing is off
+        self.history = history  # HistoryStore, or None when HISTORY_DB is empty
+        self.governor = MemoryGovernor(self.registry, shared["recycle"])
+        self.planner = PollPlanner()
+        self.heap = []  # (due, seq, doc_id); stale entries are skipped
+        self.due = {}  # doc_id -> current due time
+        self.products = {}  # doc_id -> product_key of its URL
+        self.groups = {}  # product_key -> doc_ids
+        # doc_id -> {"future", "generation", "started", "cancelled_at", "killed_at"}
+        self.running = {}
+        self.jobs = 0  # submitted jobs still in flight
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.last_policed = 0.0
+        self.lag = {}  # doc_id -> seconds the last check started late
+        self.stats = {"dispatched": 0, "lag_total": 0.0, "lag_max": 0.0, "kills": 0}
+        self.outcomes = {}
+        self.started_at = time.time()
+        self.last_success = {}  # doc_id -> when its last check completed without error
+        # doc_id -> {"generation", "aod", "skips"} after a no-match
+        self.fingerprints = {}
+        self.skips = {"aod": 0}
+
+    def add(self, doc_id: str, due: float = None):
+        """(Re)schedule a link; a running link is rescheduled when it finishes."""
+        item = cached_link(doc_id)
+        with self.cond:
+            if item is not None:
+                self._group(doc_id, product_key(item["url"]))
+            if doc_id in self.running:
+                # remove() may have dropped it meanwhile; _finished pushes it again
+                self.due.setdefault(doc_id, time.time() if due is None else due)
+                return
+            self._push(doc_id, time.time() if due is None else due)
+
+    def remove(self, doc_id: str):
+        with self.cond:
+            self.due.pop(doc_id, None)
+            self.lag.pop(doc_id, None)
+            self.last_success.pop(doc_id, None)
+            self.fingerprints.pop(doc_id, None)
+            self._group(doc_id, None)
+            self.planner.forget(doc_id)
+            self.cond.notify()
+        try:
+            CHECK_SECONDS.remove(doc_id)
+        except KeyError:
+            pass
+
+    def _group(self, doc_id, key):
+        """Move a link to the group of product `key` (None: out of all)."""
+        old = self.products.pop(doc_id, None)
+        if old is not None:
+            self.groups[old].discard(doc_id)
+            if not self.groups[old]:
+                del self.groups[old]
+        if key is not None:
+            self.products[doc_id] = key
+            self.groups.setdefault(key, set()).add(doc_id)
+
+    def _siblings(self, doc_id, now) -> list:
+        """Take the other scheduled links to doc_id's product off the heap."""
+        taken = []
+        for other in self.groups.get(self.products.get(doc_id), ()):
+            if other != doc_id and other in self.due and other not in self.running:
+                taken.append((other, min(self.due.pop(other), now)))
+        return taken
+
+    def _push(self, doc_id, due):
+        self.seq += 1
+        self.due[doc_id] = due
+        heapq.heappush(self.heap, (due, self.seq, doc_id))
+        self.cond.notify()
+
+    def _finished(self, doc_ids, future):
+        items = {doc_id: cached_link(doc_id) for doc_id in doc_ids}
+        try:
+            results = {r["doc_id"]: r for r in future.result()}
+            spans = [sp for r in results.values() for sp in r.get("spans", ())]
+            if spans and self.traces is not None:
+                self.traces.submit(spans)
+            if self.history is not None:
+                for r in results.values():
+                    if r.get("offers"):
+                        self.history.record(r["doc_id"], r["checked_at"], r["offers"])
+            for r in results.values():
+                for kind, n in r.get("fetches", {}).items():
+                    if n:
+                        FETCHES.labels(kind).inc(n)
+        except BrokenProcessPool as e:
+            log(f"[{', '.join(doc_ids)}] Worker pool broke: {e}")
+            results = {}
+            self.broken = True
         except Exception as e:
-            log(f"Error checking {url}: {e}")
+            log(f"[{', '.join(doc_ids)}] Check crashed: {e}")
+            results = {}
+        with self.cond:
+            self.jobs -= 1
+            self.governor.finished()
+            for doc_id in doc_ids:
+                job = self.running.get(doc_id)
+                if job is None or job["future"] is not future:
+                    continue
+                del self.running[doc_id]
+                result = results.get(doc_id, {"outcome": "error", "timing": None})
+                outcome = result["outcome"]
+                self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+                if outcome != "removed":
+                    CHECKS.labels(outcome).inc()
+                if result["timing"] and outcome not in ("removed", "cancelled", "throttled"):
+                    CHECK_SECONDS.labels(doc_id).observe(result["timing"]["total"])
+                if result.get("examined"):
+                    OFFERS_EXAMINED.observe(result["examined"])
+                if outcome in CHECK_OUTCOMES and outcome not in ("error", "cancelled", "throttled"):
+                    self.last_success[doc_id] = time.time()
+                self._remember(doc_id, job["generation"], result)
+                if doc_id in self.due and (outcome != "removed" or items[doc_id] is not None):
+                    # an edited (or removed and re-added) link is checked again
+                    # right away, a throttled one once the backoff is over
+                    # (run() holds until then)
+                    if outcome in ("cancelled", "throttled", "removed"):
+                        pause = 0.0
+                    else:
+                        pause = self.planner.observe(doc_id, items[doc_id], result)
+                        log(f"[{doc_id}] Next check in {pause:.0f}s")
+                    self._push(doc_id, time.time() + pause)
+                else:
+                    self.due.pop(doc_id, None)
+            self.cond.notify()
+
+    def _remember(self, doc_id, generation, result):
+        """Keep the fingerprints of a no-match; anything else starts over."""
+        if result["outcome"] != "no_match" or not result.get("fingerprint"):
+            if result["outcome"] not in ("cancelled", "throttled"):
+                self.fingerprints.pop(doc_id, None)
+            return
+        prev = self.fingerprints.get(doc_id)
+        if prev is None or prev["generation"] != generation:
+            prev = {"generation": generation, "aod": None, "skips": 0}
+        skipped = result.get("skipped")
+        if skipped:
+            self.skips[skipped] += 1
+            CHECK_SKIPS.labels(skipped).inc()
+        self.fingerprints[doc_id] = {
+            **prev,
+            **result["fingerprint"],
+            "skips": prev["skips"] + 1 if skipped else 0,
+        }
+
+    def _known(self, jobs) -> dict:
+        """Fingerprints a job may skip on: same generation, full check not due."""
+        known = {}
+        for doc_id, generation in jobs:
+            fp = self.fingerprints.get(doc_id)
+            if fp and fp["generation"] == generation and fp["skips"] + 1 < FULL_CHECK_EVERY:
+                known[doc_id] = {"aod": fp["aod"]}
+        return known
+
+    def _pop_due(self, now):
+        """Next link whose due time has come, or None."""
+        while self.heap and self.heap[0][0] <= now:
+            due, _, doc_id = heapq.heappop(self.heap)
+            if self.due.get(doc_id) == due and doc_id not in self.running:
+                return doc_id, due
+        return None
+
+    def _kill_workers(self, doc_id, generation, browsers_only: bool) -> int:
+        killed = 0
+        for pid, job in list(self.registry.items()):
+            if job["links"].get(doc_id) != generation:
+                continue
+            for browser in job["browsers"]:
+                killed += kill_process_tree(browser)
+            if not browsers_only:
+                killed += kill_process_tree(pid)
+        self.stats["kills"] += killed
+        return killed
+
+    def _police(self, now):
+        """Escalate on checks that won't stop; reap browsers of dead workers."""
+        for doc_id, job in list(self.running.items()):
+            if job["cancelled_at"] is None and self.generations.get(doc_id) != job["generation"]:
+                job["cancelled_at"] = now
+            overdue = now - job["started"] > CHECK_HARD_TIMEOUT
+            ignored = job["cancelled_at"] is not None and now - job["cancelled_at"] > CANCEL_GRACE
+            if not (overdue or ignored):
+                continue
+            if job["killed_at"] is None:
+                n = self._kill_workers(doc_id, job["generation"], browsers_only=True)
+                log(f"[{doc_id}] Check would not stop; killed {n} browser processes")
+                job["killed_at"] = now
+            elif now - job["killed_at"] > CANCEL_GRACE:
+                n = self._kill_workers(doc_id, job["generation"], browsers_only=False)
+                log(f"[{doc_id}] Worker still stuck; killed its process tree ({n})")
+                job["killed_at"] = now
+
+        for pid, job in list(self.registry.items()):
+            if pid_alive(pid):
+                continue
+            for browser in job["browsers"]:
+                self.stats["kills"] += kill_process_tree(browser)
+            self.registry.pop(pid, None)
+
+    def run(self):
+        while True:
+            with self.cond:
+                if self.stopped:
+                    return
+                now = time.time()
+                if now - self.last_policed >= POLICE_INTERVAL:
+                    self.last_policed = now
+                    self._police(now)
+                    self.governor.sample()
+                    self.governor.relieve()
+                if self.broken and not self.running:
+                    log("→ Rebuilding worker pool")
+                    self.executor.shutdown(wait=False, cancel_futures=True)
+                    self.executor = self.executor_factory()
+                    self.broken = False
+                picked = []
+                held = False  # due work waiting for memory or a backoff, not for time
+                if (
+                    self.jobs < self.capacity
+                    and not self.broken
+                    and self.heap
+                    and self.heap[0][0] <= now
+                ):
+                    held = backoff_remaining() > 0 or not self.governor.admit(self.jobs)
+                if not held and self.jobs < self.capacity and not self.broken:
+                    products = 0
+                    while products < TABS_PER_BROWSER:
+                        nxt = self._pop_due(now)
+                        if nxt is None:
+                            break
+                        del self.due[nxt[0]]
+                        picked.append(nxt)
+                        picked.extend(self._siblings(nxt[0], now))
+                        products += 1
+                if not picked:
+                    timeout = POLICE_INTERVAL
+                    if self.heap and self.jobs < self.capacity and not held:
+                        timeout = min(timeout, max(0.0, self.heap[0][0] - now))
+                    self.cond.wait(timeout)
+                    continue
 
-        finally:
-            # 2) teardown
+            ready = []
+            for doc_id, due in picked:
+                item = cached_link(doc_id)
+                if item is None:
+                    continue
+                later = cooldown_due(doc_id, item, self.cool_time)
+                if later is not None:
+                    with self.cond:
+                        self._push(doc_id, later)
+                    continue
+                ready.append((doc_id, due))
+            if not ready:
+                continue
+
+            with self.cond:
+                jobs = []
+                for doc_id, due in ready:
+                    lag = max(0.0, time.time() - due)
+                    self.lag[doc_id] = lag
+                    self.stats["dispatched"] += 1
+                    self.stats["lag_total"] += lag
+                    self.stats["lag_max"] = max(self.stats["lag_max"], lag)
+                    self.due[doc_id] = due  # marks the link as still scheduled
+                    jobs.append((doc_id, self.generations.get(doc_id, 0)))
+                try:
+                    future = self.executor.submit(
+                        check_links, jobs, self.token, self.chat_id, self._known(jobs)
+                    )
+                except BrokenProcessPool:
+                    self.broken = True
+                    for doc_id, _ in jobs:
+                        self._push(doc_id, time.time())
+                    continue
+                self.jobs += 1
+                self.governor.admitted()
+                for doc_id, generation in jobs:
+                    self.running[doc_id] = {
+                        "future": future,
+                        "generation": generation,
+                        "started": time.time(),
+                        "cancelled_at": None,
+                        "killed_at": None,
+                    }
+            doc_ids = [doc_id for doc_id, _ in jobs]
+            future.add_done_callback(lambda f, d=doc_ids: self._finished(d, f))
+
+    def report(self) -> dict:
+        with self.cond:
+            dispatched = self.stats["dispatched"]
+            now = time.time()
+            return {
+                "links": len(self.due),
+                "products": len(self.groups),
+                "running": len(self.running),
+                "overdue": sum(1 for d in self.due.values() if d <= now) - len(self.running),
+                "dispatched": dispatched,
+                "lag_avg": self.stats["lag_total"] / dispatched if dispatched else 0.0,
+                "lag_max": self.stats["lag_max"],
+                "kills": self.stats["kills"],
+                "outcomes": dict(self.outcomes),
+                "skips": dict(self.skips),
+                "backoff": backoff_remaining(),
+                "memory": self.governor.report(self.jobs),
+            }
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ─── Sharding ──────────────────────────────────────────
+# With SHARDING on, several watcher instances split the links between them.
+# Each instance heartbeats a document in "instances" whose lease_until says
+# how long it counts as alive. Every link belongs to one live instance,
+# chosen by rendezvous hashing of its product key, so links to the same
+# product stay together. That instance claims the link by writing
+# lease_owner and lease_until on it; the claim only succeeds while nobody
+# else holds an unexpired lease. The owner renews its leases with its
+# heartbeat, only while lease_owner is still itself, and only schedules the
+# links it holds.
+# When an instance joins, the others release the links that now hash to it.
+# When one dies, its leases run out within LEASE_TTL and the links' new
+# targets claim them.
+_LEASE_RELEASE = {"lease_owner": _DELETE, "lease_until": _DELETE}
+
+
+def lease_target(key: str, members):
+    """The member that product `key` belongs to (highest rendezvous hash)."""
+    return max(members, key=lambda m: hashlib.sha1(f"{m}|{key}".encode()).digest(), default=None)
+
+
+class LeaseManager(Thread):
+    """
+    Claims, renews and releases this instance's link leases. observe() takes
+    every link document the snapshot listener sees. acquired(doc_id) and
+    released(doc_id) are called from this thread as the instance gains and
+    loses links.
+    """
+
+    def __init__(self, acquired, released, instance_id: str = INSTANCE_ID):
+        super().__init__(name="leases", daemon=True)
+        self.acquired = acquired
+        self.released = released
+        self.me = instance_id
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.links = {}  # doc_id -> {"key", "owner", "until", "updated"} as last seen
+        self.held = {}  # doc_id -> lease_until of our lease
+        self.members = [instance_id]
+        self.started_at = time.time()
+        self.stopped = False
+        self.stats = {"claimed": 0, "renewed": 0, "released": 0, "lost": 0, "conflicts": 0}
+
+    def observe(self, doc_id: str, item, updated=None):
+        """Record a link document (None = removed) and its update time."""
+        with self.lock:
+            if item is None:
+                self.links.pop(doc_id, None)
+                self.held.pop(doc_id, None)
+                return
+            owner, until = item.get("lease_owner"), item.get("lease_until") or 0.0
+            self.links[doc_id] = {
+                "key": product_key(item["url"]), "owner": owner, "until": until, "updated": updated,
+            }
+            if doc_id in self.held:
+                if owner not in (None, self.me) and until > time.time():
+                    self.wake.set()  # taken over; drop it now
+            elif owner is None or until <= time.time():
+                self.wake.set()  # free; maybe ours to claim
+
+    def holds(self, doc_id: str) -> bool:
+        with self.lock:
+            return self.held.get(doc_id, 0.0) > time.time()
+
+    def run(self):
+        next_beat = 0.0
+        while not self.stopped:
+            self.wake.clear()
+            now = time.time()
             try:
-                drv.quit()
-            except:
-                pass
-            log(f"[{doc_id}] Browser closed; sleeping 10s")
+                if now >= next_beat:
+                    next_beat = now + LEASE_HEARTBEAT
+                    self.heartbeat(now)
+                self.rebalance(now)
+            except Exception as e:
+                log(f"→ Lease round failed: {e}")
+            self.expire(time.time())
+            self.wake.wait(max(0.0, next_beat - time.time()))
+
+    def heartbeat(self, now: float):
+        """Renew our instance document and leases, and refresh the member list."""
+        instances = get_db().collection("instances")
+        with FIRESTORE_SECONDS.labels("set").time():
+            instances.document(self.me).set(
+                {"lease_until": now + LEASE_TTL, "started_at": self.started_at, "links": len(self.held)}
+            )
+        members = {self.me}
+        for doc in instances.stream():
+            until = (doc.to_dict() or {}).get("lease_until") or 0.0
+            if until > now:
+                members.add(doc.id)
+            elif until < now - LEASE_TTL:
+                doc.reference.delete()  # long dead; nobody will renew it
+        if sorted(members) != self.members:
+            log(f"→ Instances now {sorted(members)} (was {self.members})")
+        with self.lock:
+            self.members = sorted(members)
+            # renew once half the lease has gone, leaving a few heartbeats of margin
+            due = [d for d, until in self.held.items() if until - now < LEASE_TTL / 2]
+        until = now + LEASE_TTL
+        renewed = set(self._write_leases(due, {"lease_until": until}, self._ours))
+        dropped = []
+        with self.lock:
+            for doc_id in due:
+                if doc_id not in self.held:
+                    continue  # released meanwhile
+                if doc_id in renewed:
+                    self.held[doc_id] = until
+                else:
+                    del self.held[doc_id]  # someone else's now, or gone
+                    dropped.append(doc_id)
+        for doc_id in dropped:
+            log(f"[{doc_id}] Lease could not be renewed; no longer checking it")
+            self.released(doc_id)
+        self.stats["renewed"] += len(renewed)
+        self.stats["lost"] += len(dropped)
+
+    def rebalance(self, now: float):
+        """Release links that hash elsewhere, drop lost ones and claim free ones that hash here."""
+        with self.lock:
+            members = self.members
+            release, lost, claim = [], [], []
+            for doc_id, link in self.links.items():
+                target = lease_target(link["key"], members)
+                if doc_id in self.held:
+                    # an expired foreign lease is just the echo of our claim not being in yet
+                    if link["owner"] not in (None, self.me) and link["until"] > now:
+                        lost.append(doc_id)
+                    elif target != self.me:
+                        release.append(doc_id)
+                elif target == self.me and (
+                    link["owner"] is None or link["owner"] == self.me or link["until"] <= now
+                ):
+                    claim.append(doc_id)
+            for doc_id in release + lost:
+                del self.held[doc_id]
+        for doc_id in lost:
+            log(f"[{doc_id}] Lease taken over by {self.links.get(doc_id, {}).get('owner')}")
+            self.released(doc_id)
+        self.stats["lost"] += len(lost)
+        if release:
+            log(f"→ Handing over {len(release)} links to other instances")
+            for doc_id in release:
+                self.released(doc_id)  # stop checking before anyone else starts
+            self.stats["released"] += len(_commit_link_states({d: _LEASE_RELEASE for d in release}))
+        if claim:
+            until = now + LEASE_TTL
+            claimed = self._claim(claim, until)
+            with self.lock:
+                for doc_id in claimed:
+                    self.held[doc_id] = until
+            for doc_id in claimed:
+                self.acquired(doc_id)
+            self.stats["claimed"] += len(claimed)
+            self.stats["conflicts"] += len(claim) - len(claimed)
+            log(f"→ Claimed {len(claimed)} of {len(claim)} free links")
+
+    def _claim(self, doc_ids, until: float) -> list:
+        """Claim free links; returns the doc_ids claimed."""
+        return self._write_leases(doc_ids, {"lease_owner": self.me, "lease_until": until}, self._free)
+
+    def _free(self, owner, until: float) -> bool:
+        return owner in (None, self.me) or until <= time.time()
+
+    def _ours(self, owner, until: float) -> bool:
+        return owner == self.me
+
+    def _write_leases(self, doc_ids, fields: dict, allowed) -> list:
+        """
+        Write `fields` to the links whose lease_owner/lease_until pass
+        `allowed`. Links last seen passing it go in batches, each write
+        conditional on the document being as we saw it; a batch that fails on
+        a changed document, and any link not seen passing, fall back to one
+        transaction per link. Returns the doc_ids written.
+        """
+        db = get_db()
+        links = db.collection("links")
+        written = []
+        for i in range(0, len(doc_ids), 100):
+            chunk = doc_ids[i : i + 100]
+            with self.lock:
+                seen = {d: self.links.get(d, {}) for d in chunk}
+            updated = {d: link.get("updated") for d, link in seen.items()}
+            if all(updated.values()) and all(
+                allowed(link.get("owner"), link.get("until") or 0.0) for link in seen.values()
+            ):
+                batch = db.batch()
+                for doc_id in chunk:
+                    batch.update(
+                        links.document(doc_id), fields,
+                        option=db.write_option(last_update_time=updated[doc_id]),
+                    )
+                try:
+                    with FIRESTORE_SECONDS.labels("batch_commit").time():
+                        batch.commit()
+                    written.extend(chunk)
+                    continue
+                except Exception:
+                    pass  # someone wrote one of them meanwhile; go one by one
+            for doc_id in chunk:
+                try:
+                    if self._write_lease(db, links.document(doc_id), fields, allowed):
+                        written.append(doc_id)
+                except Exception as e:
+                    log(f"[{doc_id}] Lease write failed: {e}")
+        return written
+
+    def _write_lease(self, db, ref, fields: dict, allowed) -> bool:
+        from firebase_admin import firestore
+
+        @firestore.transactional
+        def write(transaction):
+            snap = ref.get(transaction=transaction)
+            if not snap.exists:
+                return False
+            data = snap.to_dict()
+            if not allowed(data.get("lease_owner"), data.get("lease_until") or 0.0):
+                return False
+            transaction.update(ref, fields)
+            return True
+
+        with FIRESTORE_SECONDS.labels("transaction").time():
+            return write(db.transaction())
+
+    def expire(self, now: float):
+        """Stop checking links whose lease we failed to renew in time."""
+        with self.lock:
+            gone = [d for d, until in self.held.items() if until <= now]
+            for doc_id in gone:
+                del self.held[doc_id]
+        for doc_id in gone:
+            log(f"[{doc_id}] Lease expired before renewal; no longer checking it")
+            self.released(doc_id)
+        self.stats["lost"] += len(gone)
+
+    def report(self) -> dict:
+        with self.lock:
+            return {"held": len(self.held), "links": len(self.links), "members": list(self.members), **self.stats}
+
+    def stop(self, release: bool = True):
+        """Stop the thread; by default also hand back our leases and leave the member list."""
+        self.stopped = True
+        self.wake.set()
+        self.join(timeout=LEASE_HEARTBEAT)
+        if not release:
+            return
+        with self.lock:
+            held, self.held = list(self.held), {}
+        try:
+            _commit_link_states({d: _LEASE_RELEASE for d in held})
+            get_db().collection("instances").document(self.me).delete()
+            log(f"→ Released {len(held)} leases")
+        except Exception as e:
+            log(f"→ Could not release leases: {e}")
 
-        time.sleep(5)
 
+# ─── HTTP: metrics & health ────────────────────────────
+# The Flask app runs in a background thread of the parent: /metrics for
+# Prometheus, /healthz for the container healthcheck, /history/<doc_id> for
+# price stats from the local history, /intervals for the polling plan.
+_SERVICES = {}  # "scheduler", "state_writer", "notifier", "registry", "history", "leases"
 
-def _safe_text(ctx, by, selector):
-    try:
-        return ctx.find_element(by, selector).text.strip()
-    except:
-        return ""
 
+class WatcherCollector:
+    """Gauges computed at scrape time from the scheduler and worker registry."""
 
-def _check_core_offer(drv, wait, item):
-    """
-    Returns True if the price / ships-from / sold-by read from the main PDP
-    meet the item’s criteria, setting globals _CORE_PRICE, _CORE_SHIPS, _CORE_SOLD.
-    """
-    global _CORE_PRICE, _CORE_SHIPS, _CORE_SOLD
-    try:
-        # 1) price
-        price_div = wait.until(
-            EC.presence_of_element_located((By.ID, "corePrice_feature_div"))
+    def collect(self):
+        scheduler = _SERVICES["scheduler"]
+        now = time.time()
+        since = GaugeMetricFamily(
+            "amazon_watcher_link_seconds_since_success",
+            "Seconds since the link's last check that did not error",
+            labels=["link"],
         )
-        offscreen = price_div.find_element(
-            By.CSS_SELECTOR, ".a-offscreen"
-        ).get_attribute("innerText")
-        # strip currency symbol, convert
-        _CORE_PRICE = float(offscreen.replace("€", "").replace(",", "").strip())
-
-        # 2) ships-from  / sold-by
-        feat = wait.until(
-            EC.presence_of_element_located((By.ID, "offer-display-features"))
+        interval = GaugeMetricFamily(
+            "amazon_watcher_link_check_interval_seconds",
+            "Interval the planner chose for the link's next check",
+            labels=["link"],
         )
-        # uses the “feature-text-message” spans
-        _CORE_SHIPS = _safe_text(
-            feat,
-            By.CSS_SELECTOR,
-            "#fulfillerInfoFeature_feature_div .offer-display-feature-text-message",
+        with scheduler.cond:
+            scheduled = list(scheduler.due)
+            running = len(scheduler.running)
+            last = dict(scheduler.last_success)
+            intervals = {d: p["interval"] for d, p in scheduler.planner.report().items()}
+        for doc_id in scheduled:
+            since.add_metric([doc_id], now - last.get(doc_id, scheduler.started_at))
+            if doc_id in intervals:
+                interval.add_metric([doc_id], intervals[doc_id])
+        yield since
+        yield interval
+
+        browsers = 0
+        for pid, job in list(_SERVICES["registry"].items()):
+            if pid_alive(pid):
+                browsers += sum(1 for b in job["browsers"] if pid_alive(b))
+        yield GaugeMetricFamily("amazon_watcher_browsers", "Live Chrome instances", value=browsers)
+        yield GaugeMetricFamily("amazon_watcher_links", "Links scheduled", value=len(scheduled))
+        yield GaugeMetricFamily("amazon_watcher_running_checks", "Checks in progress", value=running)
+        yield GaugeMetricFamily(
+            "amazon_watcher_notify_queue_depth", "Telegram alerts waiting",
+            value=_SERVICES["notifier"].depth(),
         )
-        _CORE_SOLD = _safe_text(
-            feat,
-            By.CSS_SELECTOR,
-            "#merchantInfoFeature_feature_div .offer-display-feature-text-message",
+        yield GaugeMetricFamily(
+            "amazon_watcher_throttle_backoff_seconds", "Seconds left in the throttling backoff",
+            value=backoff_remaining(),
         )
-
-        log(
-            f"→ Core PDP €{_CORE_PRICE:.2f}, Ships from “{_CORE_SHIPS}”, Sold by “{_CORE_SOLD}”"
-        )
-
-        # 3) apply filters
-        if _CORE_PRICE > item["target_price"]:
-            return False
-        if item.get("check_shipped") and "amazon" not in _CORE_SHIPS.lower():
-            return False
-        if item.get("check_sold") and "amazon" not in _CORE_SOLD.lower():
-            return False
-
-        return True
-    except Exception:
-        return False
+        leases = _SERVICES.get("leases")
+        if leases is not None:
+            r = leases.report()
+            yield GaugeMetricFamily("amazon_watcher_leased_links", "Links this instance holds a lease on", value=r["held"])
+            yield GaugeMetricFamily("amazon_watcher_instances", "Live watcher instances", value=len(r["members"]))
+
+
+def health_problems() -> list:
+    problems = [
+        f"{name} thread stopped"
+        for name in ("scheduler", "state_writer", "notifier", "leases")
+        if _SERVICES.get(name) is not None and not _SERVICES[name].is_alive()
+    ]
+    scheduler = _SERVICES["scheduler"]
+    with scheduler.cond:
+        if scheduler.due:
+            last = max(scheduler.last_success.values(), default=scheduler.started_at)
+            idle = time.time() - last
+            # quiet links may wait up to CHECK_INTERVAL_MAX by design
+            shortest = min(
+                (scheduler.planner.interval(d) for d in scheduler.due), default=0.0
+            )
+            if idle > HEALTH_STALE + shortest:
+                problems.append(f"no successful check for {idle:.0f}s")
+    return problems
 
 
-if __name__ == "__main__":
+def create_app():
+    """
+    The parent's Flask app, built on demand so that spawned workers, which
+    re-import this module, never load Flask.
+    """
+    from flask import Flask, Response, jsonify, request
+
+    app = Flask(__name__)
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(generate_latest(REGISTRY), mimetype=CONTENT_TYPE_LATEST)
+
+    @app.route("/healthz")
+    def healthz():
+        problems = health_problems()
+        status = 503 if problems else 200
+        return jsonify(ok=not problems, problems=problems), status
+
+    @app.route("/history/<doc_id>")
+    def price_history(doc_id):
+        """Min/median observed price of a link over the last ?hours= (default 24)."""
+        history = _SERVICES.get("history")
+        if history is None:
+            return jsonify(error="history disabled"), 404
+        hours = request.args.get("hours", 24, type=float)
+        return jsonify(doc_id=doc_id, hours=hours, **history.price_stats(doc_id, time.time() - hours * 3600))
+
+    @app.route("/intervals")
+    def intervals():
+        """Each link's current check interval and the factors behind it."""
+        scheduler = _SERVICES["scheduler"]
+        with scheduler.cond:
+            report = scheduler.planner.report()
+            stretch = scheduler.planner.stretch()
+        return jsonify(stretch=round(stretch, 2), links=report)
+
+    return app
+
+
+def serve_http(scheduler, state_writer, notifier, registry, history=None, leases=None):
+    """Start the metrics/health server on HTTP_PORT in a daemon thread."""
+    _SERVICES.update(
+        scheduler=scheduler, state_writer=state_writer, notifier=notifier,
+        registry=registry, history=history, leases=leases,
+    )
+    for outcome in CHECK_OUTCOMES:
+        CHECKS.labels(outcome)  # export zeros before the first check
+    for result in _FETCHES:
+        FETCHES.labels(result)
+    REGISTRY.register(WatcherCollector())
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no line per scrape
+    Thread(
+        target=create_app().run,
+        kwargs={"host": "0.0.0.0", "port": HTTP_PORT, "threaded": True, "use_reloader": False},
+        name="http",
+        daemon=True,
+    ).start()
+    log(f"→ Serving /metrics and /healthz on port {HTTP_PORT}")
+
+
+def run_watcher(stop=None):
+    """
+    The parent process: load the config, start the worker pool, scheduler and
+    background threads, follow the links collection and log a report every
+    60s until Ctrl+C or until `stop` (a threading.Event) is set.
+    """
     # Ensure fresh processes (no inherited gRPC threads)
     mp_ctx = mp.get_context("spawn")
 
@@ -687,12 +3668,57 @@ if __name__ == "__main__":
     chat_id = cfg.get("chat_id")
     cool    = cfg.get("cool_time", 300)
 
-    # 2) set up executor & tracking, using spawn context
-    executor       = ProcessPoolExecutor(
-        max_workers=20,
-        mp_context=mp_ctx
+    # 2) set up executor & scheduler, using spawn context; workers read link
+    #    state from the snapshot-fed cache instead of Firestore
+    manager        = mp_ctx.Manager()
+    shared         = {
+        "links": manager.dict(),
+        "links_lock": mp_ctx.Lock(),  # listener vs save_link_state on a cache entry
+        "state": mp_ctx.Queue(),
+        "notify": mp_ctx.Queue(maxsize=NOTIFY_QUEUE_SIZE),
+        "generations": manager.dict(),  # doc_id -> bumped on edit/removal
+        "registry": manager.dict(),  # worker pid -> current job & browsers
+        "recycle": manager.dict(),  # browser pid -> why the governor wants it gone
+        "budget": new_budget(mp_ctx),  # request token bucket & throttling backoff
+    }
+    link_cache     = shared["links"]
+    generations    = shared["generations"]
+    state_writer   = StateWriter(shared["state"])
+    state_writer.start()
+    notifier       = TelegramNotifier(shared["notify"])
+    notifier.start()
+    # the parent writes cool-down state through the same cache and queues
+    init_worker(shared)
+
+    def new_executor():
+        return ProcessPoolExecutor(
+            max_workers=MAX_WORKERS,
+            mp_context=mp_ctx,
+            initializer=init_worker,
+            initargs=(shared,),
+        )
+
+    traces         = TraceExporter(TRACE_EXPORT) if TRACE_EXPORT else None
+    if traces is not None:
+        traces.start()
+    history        = HistoryStore(HISTORY_DB) if HISTORY_DB else None
+    if history is not None:
+        history.start()
+    scheduler      = Scheduler(
+        new_executor, MAX_WORKERS, token, chat_id, cool, shared, traces, history
     )
-    active_workers = {}  # doc_id -> Future
+    scheduler.start()
+
+    # with SHARDING, only the links this instance holds a lease on are scheduled
+    def lease_released(doc_id):
+        generations[doc_id] = generations.get(doc_id, 0) + 1  # cancels a running check
+        scheduler.remove(doc_id)
+
+    leases         = LeaseManager(scheduler.add, lease_released) if SHARDING else None
+    if leases is not None:
+        log(f"→ Sharding as instance {INSTANCE_ID}")
+        leases.start()
+    serve_http(scheduler, state_writer, notifier, shared["registry"], history, leases)
 
     # 3) inline snapshot callback
     def on_links_snapshot(col_snapshot, changes, read_time):
@@ -701,36 +3727,88 @@ if __name__ == "__main__":
             doc_id = doc.id
             item   = doc.to_dict()
 
-            if change.type.name == "ADDED":
-                log(f"→ Link added: {doc_id}; spawning worker")
-                future = executor.submit(
-                    check_single_link, doc_id, item, token, chat_id, cool
-                )
-                active_workers[doc_id] = future
-
-            elif change.type.name == "MODIFIED":
-                log(f"→ Link modified: {doc_id}; restarting worker")
-                old = active_workers.get(doc_id)
-                if old and not old.done():
-                    old.cancel()
-                future = executor.submit(
-                    check_single_link, doc_id, item, token, chat_id, cool
-                )
-                active_workers[doc_id] = future
+            # keep the workers' cache current before any of them looks
+            if change.type.name == "REMOVED":
+                log(f"→ Link removed: {doc_id}; cancelling its check")
+                with shared["links_lock"]:
+                    link_cache.pop(doc_id, None)
+                generations[doc_id] = generations.get(doc_id, 0) + 1
+                state_writer.observe(doc_id, None)
+                if leases is not None:
+                    leases.observe(doc_id, None)
+                scheduler.remove(doc_id)
+                continue
 
-            elif change.type.name == "REMOVED":
-                log(f"→ Link removed: {doc_id}; cancelling worker")
-                old = active_workers.pop(doc_id, None)
-                if old and not old.done():
-                    old.cancel()
+            with shared["links_lock"]:
+                old = link_cache.get(doc_id)
+                link_cache[doc_id] = item
+            state_writer.observe(doc_id, item)
+            if leases is not None:
+                leases.observe(doc_id, item, doc.update_time)
+            mine = leases is None or leases.holds(doc_id)
+            if change.type.name == "ADDED":
+                generations.setdefault(doc_id, 0)
+                if mine:
+                    log(f"→ Link added: {doc_id}; scheduling")
+                    scheduler.add(doc_id)
+            elif check_fields_changed(old, item):
+                log(f"→ Link modified: {doc_id}; cancelling running check & rescheduling")
+                generations[doc_id] = generations.get(doc_id, 0) + 1
+                if mine:
+                    scheduler.add(doc_id)
+            elif not mine:
+                continue  # another instance's link (lease renewals land here too)
+            elif (old or {}).get("available") != item.get("available"):
+                scheduler.add(doc_id)
+            elif (old or {}).get("priority") != item.get("priority"):
+                log(f"→ Priority of {doc_id} changed; checking now and replanning")
+                scheduler.add(doc_id)
 
     # 4) attach real-time listener
-    listener = db.collection("links").on_snapshot(on_links_snapshot)
+    listener = get_db().collection("links").on_snapshot(on_links_snapshot)
 
-    # 5) block until Ctrl+C
+    # 5) report scheduler health until Ctrl+C or `stop`
+    stop = stop or threading.Event()
     try:
-        threading.Event().wait()
+        while not stop.wait(60):
+            r = scheduler.report()
+            log(
+                f"→ Scheduler: {r['links']} links ({r['products']} products), {r['running']} running, "
+                f"{r['overdue']} overdue; lag avg {r['lag_avg']:.1f}s "
+                f"max {r['lag_max']:.1f}s; outcomes {r['outcomes']}; "
+                f"offer list skipped {r['skips']}"
+                + (f"; throttled, backing off {r['backoff']:.0f}s" if r["backoff"] else "")
+            )
+            m = r["memory"]
+            log(
+                f"→ Memory: {m['used_mb']}/{m['limit_mb']}MB, headroom {m['headroom_mb']}MB; "
+                f"{m['browsers']} browsers ({m['browsers_mb']}MB, ~{m['per_browser_mb']}MB each); "
+                f"concurrency limit {m['concurrency']}; deferred {m['deferred']}, "
+                f"recycled {m['recycled']}, idle freed {m['freed_idle']}, killed {m['killed']}"
+            )
+            log(f"→ Workers/browsers per link: {registry_report(shared['registry'])}")
+            if leases is not None:
+                lr = leases.report()
+                log(
+                    f"→ Leases: holding {lr['held']} of {lr['links']} links; instances {lr['members']}; "
+                    f"claimed {lr['claimed']}, renewed {lr['renewed']}, released {lr['released']}, "
+                    f"lost {lr['lost']}, conflicts {lr['conflicts']}"
+                )
     except KeyboardInterrupt:
-        log("Shutting down…")
-        listener.unsubscribe()
-        executor.shutdown(wait=False)
+        pass
+    log("Shutting down…")
+    listener.unsubscribe()
+    scheduler.stop()
+    if leases is not None:
+        leases.stop()  # hand the links to the other instances right away
+    state_writer.stop()
+    notifier.stop()
+    if traces is not None:
+        traces.stop()
+    if history is not None:
+        history.stop()
+    manager.shutdown()
+
+
+if __name__ == "__main__":
+    run_watcher()
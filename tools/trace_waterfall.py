@@ -0,0 +1,107 @@
+"""
+Print the traces written by TRACE_EXPORT=<file> as one waterfall per check.
+
+    python tools/trace_waterfall.py /tmp/traces.jsonl [--last 5] [--link DOC_ID] [--slow 10]
+"""
+
+import argparse
+import json
+import sys
+
+
+def _attr(value: dict):
+    for kind in ("stringValue", "boolValue", "doubleValue"):
+        if kind in value:
+            return value[kind]
+    if "intValue" in value:
+        return int(value["intValue"])
+    return None
+
+
+def load_traces(path: str) -> dict:
+    """{trace_id: [span, …]} with times in seconds and attributes as a dict."""
+    traces = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for rs in json.loads(line).get("resourceSpans", []):
+                for ss in rs.get("scopeSpans", []):
+                    for s in ss.get("spans", []):
+                        traces.setdefault(s["traceId"], []).append({
+                            "id": s["spanId"],
+                            "parent": s.get("parentSpanId"),
+                            "name": s["name"],
+                            "start": int(s["startTimeUnixNano"]) / 1e9,
+                            "end": int(s["endTimeUnixNano"]) / 1e9,
+                            "attrs": {a["key"]: _attr(a["value"]) for a in s.get("attributes", [])},
+                            "error": s.get("status", {}).get("message") if s.get("status", {}).get("code") == 2 else None,
+                        })
+    return traces
+
+
+def _ordered(spans: list):
+    """Depth-first, children by start time: [(depth, span), …]."""
+    children = {}
+    ids = {s["id"] for s in spans}
+    for s in spans:
+        parent = s["parent"] if s["parent"] in ids else None
+        children.setdefault(parent, []).append(s)
+    out = []
+
+    def walk(parent, depth):
+        for s in sorted(children.get(parent, []), key=lambda s: s["start"]):
+            out.append((depth, s))
+            walk(s["id"], depth + 1)
+
+    walk(None, 0)
+    return out
+
+
+def render(trace_id: str, spans: list, width: int = 50) -> str:
+    t0 = min(s["start"] for s in spans)
+    total = max(s["end"] for s in spans) - t0 or 1e-9
+    roots = [s for s in spans if not s["parent"]]
+    head = roots[0] if roots else spans[0]
+    summary = " ".join(f"{k}={v}" for k, v in head["attrs"].items())
+    lines = [f"trace {trace_id[:16]}…  {head['name']}  {summary}  {total:.2f}s"]
+    for depth, s in _ordered(spans):
+        left = int((s["start"] - t0) / total * width)
+        length = max(1, round((s["end"] - s["start"]) / total * width))
+        bar = " " * left + "█" * min(length, width - left)
+        link = s["attrs"].get("link_id")
+        label = ("  " * depth + s["name"] + (f" [{link}]" if link and depth else ""))[:34]
+        extra = " ".join(f"{k}={v}" for k, v in s["attrs"].items() if k != "link_id") if depth else ""
+        if s["error"]:
+            extra = f"{extra} ✗ {s['error']}".strip()
+        lines.append(
+            f"  {s['start'] - t0:7.2f}s  {label:<34} |{bar:<{width}}| {s['end'] - s['start']:6.2f}s  {extra}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show exported check traces as waterfalls.")
+    parser.add_argument("file", help="file written with TRACE_EXPORT")
+    parser.add_argument("--last", type=int, default=5, help="how many of the latest traces")
+    parser.add_argument("--link", help="only checks of this link id")
+    parser.add_argument("--slow", type=float, default=0, help="only checks slower than this (s)")
+    parser.add_argument("--width", type=int, default=50)
+    args = parser.parse_args()
+
+    traces = load_traces(args.file)
+    selected = []
+    for trace_id, spans in traces.items():
+        duration = max(s["end"] for s in spans) - min(s["start"] for s in spans)
+        root = next((s for s in spans if not s["parent"]), spans[0])
+        links = str(root["attrs"].get("links", "")).split(",")
+        if args.link and args.link not in links:
+            continue
+        if duration < args.slow:
+            continue
+        selected.append((min(s["start"] for s in spans), trace_id, spans))
+    if not selected:
+        sys.exit("no matching traces")
+    for _, trace_id, spans in sorted(selected)[-args.last :]:
+        print(render(trace_id, spans, args.width))
+        print()